@@ -0,0 +1,1508 @@
+#! /usr/bin/env python2
+# -*- coding: utf-8 -*-
+## benchmark.py
+## See copyright notice at end of file
+
+import sys
+import time
+import re
+import random
+import zipfile
+import tempfile
+import os
+import json
+import shlex
+import shutil
+import subprocess
+import threading
+import collections
+import array
+import posixpath
+import xml.dom.minidom
+import socket
+import urllib2
+import multiprocessing
+import BaseHTTPServer
+import SocketServer
+
+import HTMLParser
+import BeautifulSoup
+from topshelf import Epub, TopShelf, Sanitizer, TextConverter, Prefilter
+from topshelf import make_parser, lxml_ok, FetchCache, VisitedSet
+
+class Quiet:
+  # Swallows the "extract ..." messages while timing
+  def write(self, s):
+    pass
+
+def timed(fn, *args):
+  saveout = sys.stdout
+  sys.stdout = Quiet()
+  try:
+    t = time.time()
+    res = fn(*args)
+    return res, time.time() - t
+  finally:
+    sys.stdout = saveout
+
+def legacy_translate_url_to_name(files, url, modify=True):
+  # translate_url_to_name as it was before the FileRegistry
+  for df in files:
+    if files[df]['url'] == url and files[df]['modify'] == modify:
+      return df
+  filename = "content/resources/%s" % url.rstrip('/').rpartition('/')[2]
+  base, dot, ext = filename.partition('.')
+  i = 2
+  while filename in files:
+    filename = base + "-" + str(i) + dot + ext
+    i = i + 1
+  files[filename] = {'url':url, 'modify':modify}
+  return filename
+
+def bench_registry(argv):
+  # Per-call cost of translate_url_to_name as the number of known files
+  # grows. Half the URLs share a basename to exercise the suffixes.
+  sizes = [int(a) for a in argv] or [1000, 5000, 10000, 20000]
+  probes = 500
+  print "%8s %16s %16s" % ("files", "registry us/call", "legacy us/call")
+  for n in sizes:
+    urls = ["http://example.com/%d/%s.jpg" % (i, i % 2 and "image" or i)
+            for i in range(n)]
+    ts = TopShelf()
+    legacy = {}
+    for u in urls:
+      ts.translate_url_to_name(u, False)
+    t = time.time()
+    for u in urls[-probes:]:
+      ts.translate_url_to_name(u, False)
+    for i in range(probes):
+      ts.translate_url_to_name("http://example.com/new/%d/image.jpg" % i, False)
+    registry = (time.time() - t) / (2 * probes) * 1e6
+    if n <= 5000:
+      for u in urls:
+        legacy_translate_url_to_name(legacy, u, False)
+      t = time.time()
+      for u in urls[-probes:]:
+        legacy_translate_url_to_name(legacy, u, False)
+      for i in range(probes):
+        legacy_translate_url_to_name(legacy, "http://example.com/new/%d/image.jpg" % i, False)
+      old = "%16.1f" % ((time.time() - t) / (2 * probes) * 1e6)
+    else:
+      old = "%16s" % "(skipped)"
+    print "%8d %16.1f %s" % (n, registry, old)
+
+def legacy_filter(parser, soup, allowed_tags, allowed_attrs, blacklist_tags, blacklist_attrs, keepSoup=False):
+  # TopShelf.sanitize_soup_filter as it was before the Sanitizer
+  if soup.__class__ != BeautifulSoup.Tag:
+    return soup
+  result = []
+  for e in soup.contents:
+    r = legacy_filter(parser, e, allowed_tags, allowed_attrs, blacklist_tags, blacklist_attrs)
+    if type(r) == type([]): result.extend(r)
+    else:                   result.append(r)
+  if soup.name not in allowed_tags and not keepSoup:
+    if soup.name not in blacklist_tags:
+      print "extract <%s>" % soup.name
+    return result
+  if '*' not in allowed_attrs: allowed_attrs['*'] = []
+  if soup.name not in allowed_attrs: allowed_attrs[soup.name] = []
+  if '*' not in blacklist_attrs: blacklist_attrs['*'] = []
+  if soup.name not in blacklist_attrs: blacklist_attrs[soup.name] = []
+  tag = BeautifulSoup.Tag(parser, soup.name)
+  for attr, val in soup.attrs:
+    if attr not in allowed_attrs[soup.name] and attr not in allowed_attrs['*']:
+      if attr not in blacklist_attrs[soup.name] and attr not in blacklist_attrs['*']:
+        print "extract <%s %s=\"%s\">" % (soup.name, attr, val)
+    else:
+      tag[attr] = val
+  for i in range(len(result)):
+    tag.insert(i, result[i])
+  return tag
+
+def legacy_sanitize(soup):
+  allowed_body = ['p', 'a', 'img', 'font', 'u', 'b', 'strong', 'i', 'em', 's', 'center', 'big', 'small', 'br', 'hr', 'ul', 'ol', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote']
+  not_allowed_body = ['div', 'span', 'table', 'tr', 'th', 'td', 'form', 'input']
+  allowed_body_attrs = {'a':['href', 'name', 'title'], 'img':['src', 'width', 'height', 'alt', 'align'], 'p':['align'], 'font':['size', 'color', 'face'], '*':['id', 'style', 'class']}
+  not_allowed_body_attrs = {'img':['border'], 'a':['onclick', 'rel']}
+  for body in soup.findAll('body'):
+    for tag in soup.findAll('script'):
+      tag.extract()
+    body.replaceWith(legacy_filter(soup, body, allowed_body, allowed_body_attrs, not_allowed_body, not_allowed_body_attrs, True))
+  return soup.prettify()
+
+def sanitizer_render(soup):
+  remove = ()
+  if soup.find('body'):
+    remove = Sanitizer.remove_body
+  return Sanitizer().render(soup, remove)
+
+def synthetic_page(paragraphs, nesting=0):
+  p = """<div class="content"><p align="center" onclick="x()">Some <b>bold</b> &amp;
+  <span class="s">spanned <i>text</i></span> <a href="../x" rel="nofollow" target="_blank">link</a>
+  <img src="resources/a.jpg" border="0" width="10"/></p>
+  <table><tr><td><font size="2" face="Arial">cell</font></td></tr></table></div>
+"""
+  return "<html><head><title>Page</title><script>x()</script></head><body>%s%s%s</body></html>" % (
+    "<div><span>" * nesting, p * paragraphs, "</span></div>" * nesting)
+
+def bench_sanitize(argv):
+  # Body filtering and serialization: the legacy recursive filter followed
+  # by prettify() against the Sanitizer. Pass saved TopShelf pages as
+  # arguments, synthetic pages are used otherwise.
+  pages = []
+  for filename in argv:
+    pages.append((filename, open(filename).read()))
+  if not pages:
+    pages = [("synthetic 10 paragraphs",  synthetic_page(10)),
+             ("synthetic 500 paragraphs", synthetic_page(500)),
+             ("synthetic nesting 2000",   synthetic_page(5, 2000))]
+  print "%-28s %10s %10s %8s" % ("page", "legacy ms", "new ms", "same")
+  for name, html in pages:
+    new, t_new = timed(sanitizer_render, BeautifulSoup.BeautifulSoup(html))
+    try:
+      old, t_old = timed(legacy_sanitize, BeautifulSoup.BeautifulSoup(html))
+      print "%-28s %10.1f %10.1f %8s" % (name, t_old * 1000, t_new * 1000, old == new)
+    except RuntimeError:
+      print "%-28s %10s %10.1f %8s" % (name, "recursion", t_new * 1000, "-")
+
+def legacy_text(data):
+  # The text/plain conversion of parse_url before the TextConverter
+  data = data.decode('utf-8', 'ignore').encode('ascii', 'xmlcharrefreplace')
+  for i in range(0, 9) + range(11, 13) + range(14, 32):
+    data = data.replace(chr(i),  "&#%x;" % i)
+  data = data.replace('&', '&amp;')
+  data = data.replace('<', '&lt;')
+  data = data.replace('>', '&gt;')
+  data = re.sub('\r?\n(\r?\n|  )', '</p>\n<p>', data)
+  data = re.sub('_([^_<>]+)_', '<em>\\1</em>', data)
+  data = re.sub('\*([^\*<>]+)\*', '<strong>\\1</strong>', data)
+  return """<html><body>\n<p>%s</p>\n</body></html>""" % (data)
+
+def text_in_chunks(data, size):
+  conv = TextConverter()
+  res = []
+  for i in range(0, len(data), size):
+    res.append(conv.feed(data[i:i+size]))
+  res.append(conv.close())
+  return ''.join(res)
+
+text_corpus = [
+  "", "a", "\n", "\n\n", "\r\n\r\n", "\n\n\n", "\n\r\n\r\nb", "a\r\n  b",
+  "a\n \nb", "a\n\n  b", "  indented\n  lines\n", "trailing\r",
+  "_em_ *strong* _a*b_c* *a _b_ c* _a *b* c_ __ ** _\n_ _x\n\ny_",
+  "<tag> &amp; a>b \x00\x01\x08\t\x0b\x0c\x1b\x1f\x7f",
+  "caf\xc3\xa9 \xe2\x82\xac \xf0\x9f\x98\x80 bad \xff\xfe \xc3 cut \xe2\x82",
+  "truncated at the end \xe2\x82",
+]
+
+def text_fuzz(n, length, seed=1):
+  # Random texts made of the characters the conversion cares about
+  alphabet = ["\r", "\n", "\n", " ", "  ", "_", "*", "<", ">", "&", "\x1b",
+              "\x00", "\t", "\xc3\xa9", "\xe2\x82\xac", "\xff", "\xc3", "a", "b c"]
+  rnd = random.Random(seed)
+  return ["".join(rnd.choice(alphabet) for j in range(rnd.randint(0, length)))
+          for i in range(n)]
+
+def check_text():
+  # The converter must give the same result as the legacy conversion,
+  # whole or fed in chunks of any size
+  failed = 0
+  for data in text_corpus + text_fuzz(2000, 60):
+    expected = legacy_text(data)
+    for size in (1, 2, 3, 7, 64, len(data) or 1):
+      if text_in_chunks(data, size) != expected:
+        print "MISMATCH (chunks of %d): %r" % (size, data)
+        failed += 1
+        break
+  return failed
+
+def synthetic_text(paragraphs):
+  rnd = random.Random(1)
+  words = ("the quick brown fox jumps over the lazy dog and her cat in "
+           "a caf\xc3\xa9 with na\xc3\xafve people who said it was").split()
+  rare = "_em_ *strong* a&b <x> \xe2\x80\x9cquoted\xe2\x80\x9d".split()
+  def word():
+    if rnd.random() < 0.02:
+      return rnd.choice(rare)
+    return rnd.choice(words)
+  lines = []
+  for i in range(paragraphs):
+    para = " ".join(word() for j in range(rnd.randint(20, 120)))
+    lines.append("\n".join(para[k:k+72] for k in range(0, len(para), 72)))
+  return "\n\n".join(lines)
+
+def bench_text(argv):
+  # text/plain to HTML conversion, legacy passes against the TextConverter
+  # (whole and in 64k chunks). Pass text files as arguments, synthetic
+  # stories are used otherwise. Checks the equivalence corpus first.
+  failed = check_text()
+  print "equivalence: %s" % (failed and "%d FAILED" % failed or "ok")
+  texts = []
+  for filename in argv:
+    texts.append((filename, open(filename).read()))
+  if not texts:
+    texts = [("synthetic 100 paragraphs",   synthetic_text(100)),
+             ("synthetic 20000 paragraphs", synthetic_text(20000))]
+  print "%-28s %8s %12s %12s %12s %6s" % ("text", "MB", "legacy MB/s", "new MB/s", "4k feed MB/s", "same")
+  for name, data in texts:
+    mb = len(data) / 1048576.0
+    old, t_old = timed(legacy_text, data)
+    new, t_new = timed(TextConverter().convert, data)
+    chunked, t_chunked = timed(text_in_chunks, data, 4096)
+    print "%-28s %8.2f %12.1f %12.1f %12.1f %6s" % (name, mb,
+      mb / t_old, mb / t_new, mb / t_chunked, old == new == chunked)
+
+def legacy_prefilter(rules, code):
+  # TopShelf.prefilter as it was before the Prefilter
+  for r1, r2 in rules:
+    code = re.sub(r1, r2, code)
+  return code
+
+def prefilter(rules):
+  p = Prefilter()
+  for r1, r2 in rules:
+    p.add(r1, r2)
+  return p
+
+def check_prefilter(n=3000, seed=1):
+  # Random rule sets over a small alphabet, so that search strings and
+  # replacements often overlap, must give the same result as re.sub
+  rnd = random.Random(seed)
+  word = lambda k: "".join(rnd.choice("ab.c") for i in range(rnd.randint(0, k)))
+  failed = 0
+  for i in range(n):
+    rules = [(word(3), word(3)) for j in range(rnd.randint(1, 5))]
+    if rnd.random() < 0.2:
+      rules.insert(rnd.randint(0, len(rules)), ("a+", "x\\g<0>"))
+    code = word(40)
+    if prefilter(rules).apply(code) != legacy_prefilter(rules, code):
+      print "MISMATCH %r on %r" % (rules, code)
+      failed += 1
+  return failed
+
+def cleanup_rules(n):
+  # A site cleanup profile: mostly literal rules, a few regexps
+  rules = [('<span class="ad%d">' % i, '<span>') for i in range(n)]
+  rules += [('&nbsp;', ' '), ('<br>', '<br/>'), ('<center>', '<p>'),
+            ('</center>', '</p>')]
+  rules += [(r'<font[^>]*>', ''), (r'</font>', ''), (r'\s+</p>', '</p>')]
+  return rules
+
+def bench_prefilter(argv):
+  # --replace rules on each page: one re.sub per rule against the
+  # Prefilter. Pass saved pages as arguments, a synthetic page is used
+  # otherwise. Checks the Prefilter against re.sub on random rules first.
+  failed = check_prefilter()
+  print "equivalence: %s" % (failed and "%d FAILED" % failed or "ok")
+  pages = []
+  for filename in argv:
+    pages.append((filename, open(filename).read()))
+  if not pages:
+    page = synthetic_page(500).replace("<p ", "<center><p ").replace("</p>", "</p></center>&nbsp;<br>")
+    pages = [("synthetic 500 paragraphs", page)]
+  print "%-28s %6s %10s %10s %6s" % ("page", "rules", "legacy ms", "new ms", "same")
+  for name, code in pages:
+    for n in (0, 10, 50, 200):
+      rules = cleanup_rules(n)
+      p = prefilter(rules)
+      t = time.time()
+      for i in range(10):
+        old = legacy_prefilter(rules, code)
+      t_old = (time.time() - t) / 10
+      t = time.time()
+      for i in range(10):
+        new = p.apply(code)
+      t_new = (time.time() - t) / 10
+      print "%-28s %6d %10.2f %10.2f %6s" % (name, len(rules),
+        t_old * 1000, t_new * 1000, old == new)
+
+def legacy_opf(epub):
+  # Epub.get_opf as it was before opf_chunks
+  metadata = u"""  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/"
+      xmlns:dcterms="http://purl.org/dc/terms/"
+      xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+      xmlns:opf="http://www.idpf.org/2007/opf">
+    <dc:title>%s</dc:title>
+    <dc:language xsi:type="dcterms:RFC3066">%s</dc:language>
+    <dc:identifier id="dcidid" opf:scheme="URI">%s</dc:identifier>
+    %s
+    <dc:description>%s</dc:description>
+    <dc:relation>%s</dc:relation>
+    %s
+    <dc:publisher>%s</dc:publisher>
+    <dc:date xsi:type="dcterms:W3CDTF">%s</dc:date>
+    <dc:rights>%s</dc:rights>
+  </metadata>""" % (
+    epub.get_metainfo("title"),
+    epub.get_metainfo("lang"),
+    epub.get_metainfo("ident"),
+    ["<dc:subject>%s</dc:subject>"%i for i in epub.get_metainfo("subject")],
+    epub.get_metainfo("description"),
+    epub.get_metainfo("relation"),
+    ["<dc:creator>%s</dc:creator>"%i for i in epub.get_metainfo("creator")],
+    epub.get_metainfo("publisher"),
+    epub.get_metainfo("date"),
+    epub.get_metainfo("rights"))
+
+  manifest  = '  <manifest>\n'
+  manifest += '    <item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>\n'
+  for filename in epub.all_files:
+    f = epub.all_files[filename]
+    manifest += '    <item id="item_%s" href="%s" media-type="%s"/>\n' % (
+      f['id'], filename, f['type'])
+  manifest += '  </manifest>\n'
+
+  spine  = '  <spine toc="ncx">\n'
+  spine += legacy_navigate_opf(epub, epub.navigation)
+  spine += '  </spine>\n'
+
+  return u"""<?xml version="1.0"?>
+<package xmlns="http://www.idpf.org/2007/opf" unique-identifier="dcidid"
+   version="2.0">
+
+%s
+
+%s
+
+%s
+
+</package>""" % (metadata, manifest, spine)
+
+def legacy_navigate_opf(epub, navigation, res = ""):
+  for nav in navigation:
+    type, a, b = epub.all_files[nav['file']]['type'].partition('/')
+    if type == "text" or type == "application":
+      res += '    <itemref idref="item_%s"/>\n' % epub.all_files[nav['file']]['id']
+      res = legacy_navigate_opf(epub, nav['sub'], res)
+  return res
+
+def legacy_toc(epub):
+  # Epub.get_toc as it was before toc_chunks
+  map = ""
+  depth = 0
+  order = 1
+  for nav in epub.navigation:
+    map, d, order = legacy_navigate_toc(nav, "    ", map, 0, order)
+    if d > depth:
+      depth = d
+  return u"""<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE ncx PUBLIC "-//NISO//DTD ncx 2005-1//EN" "http://www.daisy.org/z3986/2005/ncx-2005-1.dtd">
+<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1" xml:lang="en">
+  <head>
+    <meta name="dtb:uid" content="%s"/>
+    <meta name="dtb:depth" content="%d"/>
+    <!--meta name="dtb:generator" content=""/-->
+    <meta name="dtb:totalPageCount" content="0"/>
+    <meta name="dtb:maxPageNumber" content="0"/>
+  </head>
+  <docTitle><text>%s</text></docTitle>
+  <navMap>
+%s
+  </navMap>
+</ncx>""" % (epub.ncx_uid, depth, epub.ncx_title, map);
+
+def legacy_navigate_toc(nav, indent = "", res = "", depth = 0, order = 1):
+  depth += 1
+  final_depth = depth
+  indent2 = indent + "  "
+  res += indent + '<navPoint id="navPoint_%d" playOrder="%d">\n' % (order, order)
+  res += indent + '  <navLabel><text>%s</text></navLabel>\n' % nav["title"]
+  res += indent + '  <content src="%s"/>\n' % nav["file"]
+  order += 1
+  for n in nav["sub"]:
+    res, d, order = legacy_navigate_toc(n, indent2, res, depth, order)
+    if d > final_depth:
+      final_depth = d
+  res += indent + "</navPoint>\n"
+  return res, final_depth, order
+
+def navigation_book(entries, shape, seed=1):
+  # An Epub with `entries' navigation items as a flat list, a random tree
+  # or a chain. One file in ten is an image so that the spine skips some
+  # items.
+  rnd = random.Random(seed)
+  epub = Epub()
+  parents = [epub.navigation]
+  for i in range(entries):
+    filename = u"content/page-%d%s" % (i, i % 10 == 9 and ".jpg" or "")
+    epub.all_files[filename] = {
+      'data': None,
+      'type': i % 10 == 9 and "image/jpeg" or "application/xhtml+xml",
+      'id':   "file%d" % i}
+    nav = {'file': filename, 'title': u"Page \xe9 %d" % i, 'sub': []}
+    if shape == "tree":
+      parent = rnd.choice(parents)
+    elif shape == "chain":
+      parent = parents[-1]
+    else:
+      parent = epub.navigation
+    parent.append(nav)
+    parents.append(nav['sub'])
+  return epub
+
+def check_navigation():
+  # opf_chunks/toc_chunks against the legacy generators on random trees
+  failed = 0
+  for seed in range(50):
+    for shape in ("flat", "tree", "chain"):
+      epub = navigation_book(random.Random(seed).randint(0, 60), shape, seed)
+      if epub.get_opf() != legacy_opf(epub) or epub.get_toc() != legacy_toc(epub):
+        print "MISMATCH seed %d %s" % (seed, shape)
+        failed += 1
+  return failed
+
+def bench_toc(argv):
+  # metadata.opf and toc.ncx generation: the legacy recursive generators
+  # against opf_chunks/toc_chunks, and writing both into a zip. Pass the
+  # numbers of entries as arguments. The legacy generators are quadratic
+  # (about a minute at 10000 entries) and only run up to 2000 entries.
+  failed = check_navigation()
+  print "equivalence: %s" % (failed and "%d FAILED" % failed or "ok")
+  sizes = [int(a) for a in argv] or [1000, 2000, 10000]
+  trees = [(shape, n) for shape in ("flat", "tree") for n in sizes] + \
+          [("chain", 500)]
+  # the legacy generators recurse once per level
+  print "%-22s %12s %12s %12s %6s" % ("tree", "legacy ms", "new ms", "write ms", "same")
+  for shape, n in trees:
+    epub = navigation_book(n, shape)
+    (new_opf, new_toc), t_new = timed(lambda: (epub.get_opf(), epub.get_toc()))
+    fd, filename = tempfile.mkstemp(suffix='.zip')
+    os.close(fd)
+    z = zipfile.ZipFile(filename, 'w')
+    t = time.time()
+    epub.write_chunks(z, "metadata.opf", epub.opf_chunks())
+    epub.write_chunks(z, "toc.ncx", epub.toc_chunks())
+    t_write = time.time() - t
+    z.close()
+    z = zipfile.ZipFile(filename)
+    same = z.read("toc.ncx") == new_toc.encode('utf-8') and \
+           z.read("metadata.opf") == new_opf.encode('utf-8')
+    z.close()
+    os.remove(filename)
+    if n <= 2000:
+      (old_opf, old_toc), t_old = timed(lambda: (legacy_opf(epub), legacy_toc(epub)))
+      same = same and old_opf == new_opf and old_toc == new_toc
+      old = "%12.1f" % (t_old * 1000)
+    else:
+      old = "%12s" % "(skipped)"
+    print "%-22s %s %12.1f %12.1f %6s" % ("%s %d" % (shape, n), old,
+      t_new * 1000, t_write * 1000, same)
+
+class SyntheticSite:
+  # A TopShelf stand-in: a book index whose book-navigation footer lists
+  # `chapters' chapters of about `page_kb' KB, each with the author and
+  # tag fields, a submitted footer and `images' images. The first image of
+  # each chapter is the same banner under another URL, the others are
+  # different. Every request waits `latency' seconds first. The content
+  # only depends on the parameters.
+  #
+  # To test the retries, a `failures' share of the requests can be answered
+  # 503, and the requests over `limit' per second 429 with a Retry-After.
+  # A `tail' share of the requests waits `tail_latency' seconds more.
+  #
+  # With `variants', every chapter also shows the second image of the first
+  # chapter under another form of its URL, one of `forms'.
+  #
+  # With `ring', every chapter links to the next one and the last one to
+  # the first, so that a raw crawl goes round in circles.
+
+  forms = ["", "?utm_source=feed", "/", "?size=full&v=2", "?v=2&size=full",
+           "?utm_medium=rss&utm_source=feed"]
+
+  def __init__(self, chapters=20, page_kb=30, images=2, latency=0.05, seed=1,
+               failures=0.0, limit=None, tail=0.0, tail_latency=0.0,
+               variants=False, ring=False):
+    self.chapters = chapters
+    self.page_kb  = page_kb
+    self.images   = images
+    self.latency  = latency
+    self.seed     = seed
+    self.failures = failures
+    self.limit    = limit
+    self.tail     = tail
+    self.tail_latency = tail_latency
+    self.variants = variants
+    self.ring     = ring
+    self.requests = 0
+    self.bytes    = 0
+    self.refused  = 0
+    self.recent   = collections.deque()
+    self.rnd      = random.Random(seed)
+    self.lock     = threading.Lock()
+    self.images_data = {}
+
+  def image(self, name):
+    if name.endswith("-0"):
+      name = "banner"
+    if name not in self.images_data:
+      rnd = random.Random("%d-%s" % (self.seed, name))
+      self.images_data[name] = "".join(chr(rnd.getrandbits(8)) for i in range(20000))
+    return self.images_data[name]
+
+  def layout(self, title, body, nav):
+    return """<html><head><title>%s | BigCloset TopShelf</title>
+<script>track()</script><style>p { margin: 0 }</style></head><body>
+<div id="page"><div class="header">Site header</div>
+<span class="print-link"><a href="/print">Printer-friendly version</a></span>
+<section class="field field-name-author"><a href="/author/jane">Jane Doe</a></section>
+<section class="field field-name-tags"><a href="/tags/tg">TG</a> <a href="/tags/fantasy">Fantasy</a></section>
+<div class="content">%s</div>
+<div class="service-links"><a href="/share">Share</a></div>
+<footer class="submitted"><span rel="author">Jane Doe</span> on Mon, 2010-04-18</footer>
+<footer class="book-navigation">%s</footer>
+</div></body></html>""" % (title, body, nav)
+
+  def index(self):
+    items = ['<li class="leaf"><a href="/book/chapter-%d">Chapter %d</a></li>' % (i, i)
+             for i in range(1, self.chapters + 1)]
+    return self.layout("The Story", "<p>Introduction</p>",
+                       "<ul>%s</ul>" % "".join(items))
+
+  def chapter(self, n):
+    rnd = random.Random("%d-%d" % (self.seed, n))
+    words = "the story went on and she said it was <b>so</b> <i>very</i> caf\xc3\xa9".split()
+    imgs = "".join('<p><img src="/images/chapter-%d-%d.%s" border="0"/></p>' %
+                   (n, i, i % 2 and "png" or "jpg") for i in range(self.images))
+    if self.variants:
+      imgs += '<p><img src="/images/chapter-1-1.png%s" border="0"/></p>' % (
+        self.forms[(n - 1) % len(self.forms)])
+    if self.ring:
+      imgs += '<p><a href="/book/chapter-%d">Next</a></p>' % (n % self.chapters + 1)
+    paras = [imgs]
+    size = len(imgs)
+    while size < self.page_kb * 1024:
+      para = '<p class="text"><span>%s</span></p>\n' % " ".join(
+        rnd.choice(words) for i in range(rnd.randint(40, 120)))
+      paras.append(para)
+      size += len(para)
+    return self.layout("The Story - Chapter %d" % n, "".join(paras), "<ul></ul>")
+
+  def get(self, path):
+    # Returns (content type, data), or None for 404
+    if self.variants:
+      path = path.partition("?")[0].rstrip("/")
+    if path == "/book/index":
+      return "text/html; charset=utf-8", self.index()
+    m = re.match(r"/book/chapter-([0-9]+)$", path)
+    if m and 1 <= int(m.group(1)) <= self.chapters:
+      return "text/html; charset=utf-8", self.chapter(int(m.group(1)))
+    m = re.match(r"/images/(chapter-[0-9]+-[0-9]+)\.(jpg|png)$", path)
+    if m:
+      with self.lock:
+        data = self.image(m.group(1))
+      return m.group(2) == "png" and "image/png" or "image/jpeg", data
+    return None
+
+  def delay(self):
+    with self.lock:
+      slow = self.tail and self.rnd.random() < self.tail
+    time.sleep(self.latency + (slow and self.tail_latency or 0))
+
+  def refusal(self):
+    # The status to answer instead of the content, None to serve it
+    with self.lock:
+      now = time.time()
+      while self.recent and now - self.recent[0] >= 1.0:
+        self.recent.popleft()
+      if self.limit and len(self.recent) >= self.limit:
+        self.refused += 1
+        return 429
+      self.recent.append(now)
+      if self.failures and self.rnd.random() < self.failures:
+        self.refused += 1
+        return 503
+    return None
+
+  def serve(self):
+    # Starts the server in a thread, returns its base URL
+    site = self
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+      protocol_version = "HTTP/1.1"
+      wbufsize = -1
+      disable_nagle_algorithm = True
+      # the response is sent as soon as the request is handled, instead
+      # of one packet per header line or waiting for the client's ACK
+      def log_message(self, format, *args):
+        pass
+      def do_GET(self):
+        site.delay()
+        refusal = site.refusal()
+        res = site.get(self.path)
+        if refusal or res is None:
+          self.send_response(refusal or 404)
+          if refusal == 429:
+            self.send_header("Retry-After", "1")
+          self.send_header("Content-Length", "0")
+          self.end_headers()
+          return
+        ctype, data = res
+        with site.lock:
+          site.requests += 1
+          site.bytes    += len(data)
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+      daemon_threads = True
+      def handle_error(self, request, client_address):
+        # Clients going away mid-response (the loser of a hedged request)
+        pass
+    self.server = Server(("127.0.0.1", 0), Handler)
+    t = threading.Thread(target=self.server.serve_forever)
+    t.daemon = True
+    t.start()
+    return "http://127.0.0.1:%d" % self.server.server_address[1]
+
+  def shutdown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+def crawl(url, options, workdir):
+  # Runs topshelf.py with `options' against `url' in a process of its own
+  # and returns its --stats-json report, with its peak RSS in KB
+  script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "topshelf.py")
+  report = os.path.join(workdir, "stats.json")
+  if os.path.exists(report):
+    os.remove(report)
+  args = [sys.executable, script, "--stats-json", report,
+          "-o", os.path.join(workdir, "book.epub")] + options + [url]
+  p = subprocess.Popen(args, cwd=workdir, stdout=open(os.devnull, "w"),
+                       stderr=subprocess.STDOUT)
+  pid, status, rusage = os.wait4(p.pid, 0)
+  p.returncode = status
+  if status != 0 or not os.path.exists(report):
+    return None
+  res = json.loads(open(report).read().splitlines()[-1])
+  res['maxrss'] = rusage.ru_maxrss
+  return res
+
+def legacy_layout_page(paragraphs):
+  # The TopShelf layout without book-navigation: the text ends before the
+  # vote widget
+  return """<html><head><title>Old Story | TopShelf</title></head><body>
+<div class="header">header</div><span class="print-link">print</span>
+<footer class="submitted">Submitted by John &amp; Co on Tue</footer>
+<div class="content">%s<font size="1">end</font><div class="vote-wrap">vote</div>
+<p>after the vote</p></div><div class="footer">footer</div></body></html>""" % (
+    "<p>Some text, caf&eacute; &amp; t&#233;a.</p>\n" * paragraphs)
+
+parser_corpus = [
+  # BeautifulSoup reads the AT&T of "entities" as AT&T; so it differs
+  ("unclosed", "<html><body><p>one<p>two <b>bold <i>both</b> italic</i><li>item<br>line</body>"),
+  ("entities", "<p>&eacute; &nbsp;&amp; &lt;tag&gt; &#233; &#xe9; AT&T a & b</p>"),
+  ("comments", "<!DOCTYPE html><html><!-- top --><head><title>T &amp; T</title><!-- head --></head><body><!-- c --><p>x</p></body></html>"),
+  ("no body", "<p>no <a href='x.html' onclick='y'>html</a> or body</p>"),
+  ("quotes", """<html><body><a href="a?b=1&amp;c='2'" title='say "hi"'>q</a></body></html>"""),
+  ("script", "<html><head><script>var a = '<p>';</script></head><body><script>x()</script><p>t</p></body></html>"),
+  ("latin-1", "<html><head><meta http-equiv='Content-Type' content='text/html; charset=iso-8859-1'></head><body><p>caf\xe9</p></body></html>"),
+  ("text/plain", TextConverter().convert("Hello _world_ and *bold*\\n\\ncaf\xc3\xa9 <tag> & amp\\n  indented")),
+]
+
+def parser_pages(argv):
+  # Saved pages from the arguments, TopShelf (index, chapters and the
+  # layout without book-navigation) and raw pages otherwise
+  pages = []
+  for filename in argv:
+    pages.append((os.path.basename(filename), "TopShelf", open(filename).read()))
+  if pages:
+    return pages
+  site = SyntheticSite(chapters=5, page_kb=30, images=2)
+  pages.append(("site index", "TopShelf", site.index()))
+  pages.append(("site chapter 30 KB", "TopShelf", site.chapter(1)))
+  site.page_kb = 200
+  pages.append(("site chapter 200 KB", "TopShelf", site.chapter(2)))
+  pages.append(("old layout", "TopShelf", legacy_layout_page(50)))
+  pages.append(("raw 500 paragraphs", None, synthetic_page(500)))
+  for name, html in parser_corpus:
+    pages.append((name, None, html))
+  return pages
+
+def process_page(parser, layout, html, url="http://example.com/book/page"):
+  # What parse_url does with a page, without following the links: the
+  # references keep the values they had in the page
+  ts = TopShelf(layout=layout)
+  ts.parser = make_parser(parser)
+  ts.queue_mode = True
+  ts.page_jobs = []
+  ts.page_stack.append(ts.new_page(url, u"content/page", {}))
+  soup = ts.parser.parse(html)
+  content, refs = ts.parse_page(soup, u"content/page", url, True)
+  for ref in refs.values():
+    ref.resolved = True
+  title = ts.navigation and ts.navigation[0]['title'] or u""
+  return ts.resolve(content, refs), title
+
+unescape = HTMLParser.HTMLParser().unescape
+
+def normalize(xhtml, tags=True):
+  # The tags, their attributes and the words of a page, with the entities
+  # decoded and without the layout. The <html>, <head> and <body> tags
+  # BeautifulSoup doesn't add are left out.
+  res = []
+  for tag, text in re.findall(r'(<[^>]*>)|([^<]+)', xhtml.decode('utf-8')):
+    if text:
+      res.extend(unescape(text).split())
+    elif tags and not tag.startswith("<!"):
+      name = re.match(r'<(/?[^\s/>]*)', tag).group(1)
+      if name.strip('/') in ('html', 'head', 'body'):
+        continue
+      attrs = [(k, unescape(v1 or v2)) for k, v1, v2 in
+               re.findall(r'([^\s=]+)=(?:"([^"]*)"|\'([^\']*)\')', tag)]
+      res.append((name, sorted(attrs)))
+  return res
+
+def bench_parser(argv):
+  # The parser backends on whole pages: parsing, layout, sanitizing and
+  # rendering, BeautifulSoup against lxml. The output is compared byte for
+  # byte, then once normalized (entities decoded, layout ignored: the
+  # same tags and text are "equivalent"), then the text alone (the tags
+  # of broken markup may be closed elsewhere, or the body of a page
+  # without one filtered). Pass saved TopShelf pages as arguments,
+  # synthetic pages and a corpus of odd markup are used otherwise.
+  if not lxml_ok:
+    print "lxml is not installed"
+    return
+  print "%-22s %10s %10s %8s %11s" % ("page", "soup ms", "lxml ms", "speedup", "output")
+  different = 0
+  for name, layout, html in parser_pages(argv):
+    (old, old_title), t_old = timed(process_page, "soup", layout, html)
+    (new, new_title), t_new = timed(process_page, "lxml", layout, html)
+    if old == new and old_title == new_title:
+      same = "same"
+    elif unescape(old_title) != unescape(new_title):
+      same = "DIFFERENT"
+    elif normalize(old) == normalize(new):
+      same = "equivalent"
+    elif normalize(old, False) == normalize(new, False):
+      same = "same text"
+    else:
+      same = "DIFFERENT"
+    if same == "DIFFERENT":
+      different += 1
+    print "%-22s %10.1f %10.1f %8.1f %11s" % (name, t_old * 1000, t_new * 1000,
+      t_old / max(t_new, 1e-6), same)
+  print "%d different" % different
+
+def bench_crawl(argv):
+  # Whole builds against a local SyntheticSite:
+  #   crawl [--chapters N] [--page-kb KB] [--images N] [--latency MS]
+  #         [--runs N] ["TOPSHELF OPTIONS" ...]
+  # Each quoted argument is a set of topshelf.py options to compare, the
+  # best of --runs builds is reported for each.
+  params = {'chapters': 20, 'page-kb': 30, 'images': 2, 'latency': 50, 'runs': 1}
+  configs = []
+  i = 0
+  while i < len(argv):
+    if argv[i].startswith("--") and argv[i][2:] in params:
+      params[argv[i][2:]] = int(argv[i + 1])
+      i += 2
+    else:
+      configs.append(argv[i])
+      i += 1
+  if not configs:
+    configs = ["", "-j 4", "--queue", "-j 4 --stream"]
+  site = SyntheticSite(params['chapters'], params['page-kb'], params['images'],
+                       params['latency'] / 1000.0)
+  url = site.serve() + "/book/index"
+  workdir = tempfile.mkdtemp()
+  print "%d chapters of %d KB, %d images each, %d ms latency" % (
+    params['chapters'], params['page-kb'], params['images'], params['latency'])
+  print "%-24s %6s %6s %8s %8s %8s %9s %9s" % ("options", "pages", "dups",
+    "time s", "pages/s", "MB/s", "RSS MB", "epub KB")
+  try:
+    for config in configs:
+      best = None
+      for run in range(params['runs']):
+        res = crawl(url, shlex.split(config), workdir)
+        if res and (best is None or res['elapsed'] < best['elapsed']):
+          best = res
+      if best is None:
+        print "%-24s %s" % (config or "(default)", "FAILED")
+        continue
+      counters = best['counters']
+      print "%-24s %6d %6d %8.2f %8.1f %8.2f %9.1f %9.1f" % (config or "(default)",
+        counters['pages'], counters.get('duplicates', 0), best['elapsed'],
+        counters['pages'] / best['elapsed'],
+        counters['bytes_in'] / 1048576.0 / best['elapsed'],
+        best['maxrss'] / 1024.0, counters['bytes_out'] / 1024.0)
+  finally:
+    site.shutdown()
+    shutil.rmtree(workdir)
+
+def check_fetch_cache(n=20000, seed=1):
+  # FetchCache against a plain list kept in least recently used order
+  rnd = random.Random(seed)
+  cache = FetchCache(50000)
+  model = []
+  failed = 0
+  for i in range(n):
+    url = "http://example.com/%d" % rnd.randint(0, 200)
+    if rnd.random() < 0.6:
+      hit = [e for e in model if e[0] == url]
+      dta = cache.get(url)
+      if hit:
+        model.remove(hit[0])
+        model.append(hit[0])
+      if (dta and dta['data']) != (hit[0][1] if hit else None):
+        failed += 1
+    else:
+      data = "x" * rnd.randint(0, 8000) + url
+      cache.put(url, {'data': data})
+      model = [e for e in model if e[0] != url] + [(url, data)]
+      while sum(len(e[1]) for e in model) > 50000:
+        model.pop(0)
+    if cache.size != sum(len(e[1]) for e in model) or len(cache) != len(model):
+      failed += 1
+  return failed
+
+def bench_cache(argv):
+  # The in-memory fetch cache: LRU equivalence, then the cost of get and
+  # put with a budget holding a quarter of the URLs, against a dict
+  failed = check_fetch_cache()
+  print "equivalence: %s" % (failed and "%d FAILED" % failed or "ok")
+  n = argv and int(argv[0]) or 200000
+  urls = ["http://example.com/page-%d" % i for i in range(4000)]
+  rnd = random.Random(1)
+  ops = [rnd.choice(urls) for i in range(n)]
+  dta = {'data': "x" * 1024}
+  def run(cache, get, put):
+    for url in ops:
+      if get(url) is None:
+        put(url, dta)
+  d = {}
+  _, t_dict = timed(run, d, d.get, d.__setitem__)
+  cache = FetchCache(1000 * 1024)
+  _, t_cache = timed(run, cache, cache.get, cache.put)
+  print "%-12s %10s %10s %10s %10s" % ("cache", "ops/s", "entries", "KB", "evictions")
+  print "%-12s %10d %10d %10d %10s" % ("dict", n / t_dict, len(d), len(d), "-")
+  print "%-12s %10d %10d %10d %10d" % ("FetchCache", n / t_cache, len(cache),
+    cache.size / 1024, cache.counts['evictions'])
+
+def legacy_writeout(epub, epub_name):
+  # Epub.writeout before parallel compression: every member deflated in
+  # turn with ZipFile.writestr
+  z = zipfile.ZipFile(epub_name, 'w')
+  epub.write_header(z)
+  epub.write_chunks(z, "metadata.opf", epub.opf_chunks())
+  epub.write_chunks(z, "toc.ncx",      epub.toc_chunks())
+  for filename in epub.all_files:
+    f = epub.all_files[filename]
+    z.writestr(epub.make_zipinfo(filename), f['data'])
+  z.close()
+
+def illustrated_book(pages, images, page_kb, image_kb, seed=1):
+  # An Epub of `pages' synthetic pages and `images' incompressible JPEG
+  # images
+  rnd = random.Random(seed)
+  epub = Epub()
+  for i in range(pages):
+    filename = "content/page-%d.xhtml" % i
+    paragraphs = max(1, page_kb * 1024 / len(synthetic_page(1)))
+    epub.addfile(filename, synthetic_page(paragraphs), "application/xhtml+xml")
+    epub.navigation.append({'file': filename, 'title': u"Page %d" % i, 'sub': []})
+  for i in range(images):
+    data = ("%0*x" % (image_kb * 2048, rnd.getrandbits(image_kb * 8192))).decode('hex')
+    epub.addfile("content/image-%d.jpg" % i, "\xff\xd8" + data, "image/jpeg")
+  return epub
+
+def zip_members(filename):
+  z = zipfile.ZipFile(filename)
+  res = [(info.filename, info.CRC, z.read(info.filename)) for info in z.infolist()]
+  z.close()
+  return res
+
+def bench_zip(argv):
+  # Epub.writeout of an illustrated book: the legacy serial writer against
+  # compress_jobs threads (pass the numbers of threads as arguments). The
+  # members must be the same, in the same order.
+  jobs = [int(a) for a in argv] or sorted(set([1, 2, 4, multiprocessing.cpu_count()]))
+  epub = illustrated_book(200, 100, 30, 200)
+  workdir = tempfile.mkdtemp()
+  try:
+    legacy = os.path.join(workdir, "legacy.epub")
+    t = time.time()
+    legacy_writeout(epub, legacy)
+    t_old = time.time() - t
+    expected = zip_members(legacy)
+    print "%d pages, %d images, %d processors" % (200, 100, multiprocessing.cpu_count())
+    print "%-12s %10s %8s %10s %6s" % ("writer", "ms", "speedup", "KB", "same")
+    print "%-12s %10.1f %8.1f %10.1f %6s" % ("legacy", t_old * 1000, 1.0,
+      os.path.getsize(legacy) / 1024.0, True)
+    for n in jobs:
+      filename = os.path.join(workdir, "jobs-%d.epub" % n)
+      epub.compress_jobs = n
+      t = time.time()
+      epub.writeout(filename)
+      t_new = time.time() - t
+      print "%-12s %10.1f %8.1f %10.1f %6s" % ("%d threads" % n, t_new * 1000,
+        t_old / max(t_new, 1e-6), os.path.getsize(filename) / 1024.0,
+        zip_members(filename) == expected)
+  finally:
+    shutil.rmtree(workdir)
+
+def free_port():
+  s = socket.socket()
+  s.bind(("127.0.0.1", 0))
+  port = s.getsockname()[1]
+  s.close()
+  return port
+
+def api_call(base, method, path, body=None):
+  r = urllib2.Request(base + path, body is not None and json.dumps(body) or None)
+  r.get_method = lambda: method
+  f = urllib2.urlopen(r)
+  res = f.read()
+  f.close()
+  return res
+
+def bench_serve(argv):
+  # Building e-books one process each against the --serve daemon:
+  #   serve [--books N] [--chapters N] [--latency MS] ["TOPSHELF OPTIONS"]
+  # The books are the same SyntheticSite book with a different title, one
+  # after the other. The daemon pays the start-up and the downloads once,
+  # the following books come from its warm caches.
+  params = {'books': 5, 'chapters': 20, 'latency': 20}
+  options = []
+  i = 0
+  while i < len(argv):
+    if argv[i].startswith("--") and argv[i][2:] in params:
+      params[argv[i][2:]] = int(argv[i + 1])
+      i += 2
+    else:
+      options += shlex.split(argv[i])
+      i += 1
+  site = SyntheticSite(params['chapters'], 30, 2, params['latency'] / 1000.0)
+  url = site.serve() + "/book/index"
+  workdir = tempfile.mkdtemp()
+  script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "topshelf.py")
+  print "%d books of %d chapters, %d ms latency" % (params['books'],
+    params['chapters'], params['latency'])
+  print "%-10s %10s %10s %10s" % ("mode", "first s", "next s", "total s")
+  daemon = None
+  try:
+    times = []
+    for n in range(params['books']):
+      t = time.time()
+      crawl(url, options + ["-m", "title=Book %d" % n], workdir)
+      times.append(time.time() - t)
+    print "%-10s %10.2f %10.2f %10.2f" % ("process", times[0],
+      sum(times[1:]) / max(1, len(times) - 1), sum(times))
+    port = free_port()
+    base = "http://127.0.0.1:%d" % port
+    t = time.time()
+    daemon = subprocess.Popen([sys.executable, script, "--serve", str(port),
+      "--serve-dir", workdir] + options, cwd=workdir,
+      stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+    while True:
+      try:
+        api_call(base, "GET", "/books")
+        break
+      except (urllib2.URLError, socket.error):
+        time.sleep(0.05)
+    times = []
+    for n in range(params['books']):
+      job = json.loads(api_call(base, "POST", "/books",
+        {'url': [url], 'meta': {'title': "Book %d" % n}}))
+      while job['status'] not in ("done", "failed"):
+        time.sleep(0.02)
+        job = json.loads(api_call(base, "GET", "/books/%s" % job['id']))
+      times.append(time.time() - t)
+      t = time.time()
+    print "%-10s %10.2f %10.2f %10.2f" % ("daemon", times[0],
+      sum(times[1:]) / max(1, len(times) - 1), sum(times))
+  finally:
+    if daemon:
+      daemon.terminate()
+      daemon.wait()
+    site.shutdown()
+    shutil.rmtree(workdir)
+
+def bench_retry(argv):
+  # Builds against a SyntheticSite failing some of the requests:
+  #   retry [--chapters N] [--failures PERCENT] [--limit REQUESTS]
+  #         [--latency MS] ["TOPSHELF OPTIONS" ...]
+  # PERCENT of the requests are answered 503, those over REQUESTS per
+  # second 429. The books are written even with errors (-c) so that the
+  # errors can be counted.
+  params = {'chapters': 40, 'failures': 5, 'limit': 40, 'latency': 10}
+  configs = []
+  i = 0
+  while i < len(argv):
+    if argv[i].startswith("--") and argv[i][2:] in params:
+      params[argv[i][2:]] = int(argv[i + 1])
+      i += 2
+    else:
+      configs.append(argv[i])
+      i += 1
+  if not configs:
+    configs = ["--retries 0 --rate 0 -j 8", "--rate 0 -j 8", "-j 8"]
+  print "%d chapters, %d%% failing, %d requests/s at most, %d ms latency" % (
+    params['chapters'], params['failures'], params['limit'], params['latency'])
+  print "%-28s %6s %7s %8s %9s %8s %9s %8s" % ("options", "pages", "errors",
+    "retries", "throttled", "refused", "requests", "time s")
+  workdir = tempfile.mkdtemp()
+  try:
+    for config in configs:
+      site = SyntheticSite(params['chapters'], 10, 2, params['latency'] / 1000.0,
+                           failures=params['failures'] / 100.0,
+                           limit=params['limit'])
+      url = site.serve() + "/book/index"
+      try:
+        res = crawl(url, ["-c"] + shlex.split(config), workdir)
+      finally:
+        site.shutdown()
+      if res is None:
+        print "%-28s %s" % (config, "FAILED")
+        continue
+      counters = res['counters']
+      print "%-28s %6d %7d %8d %9d %8d %9d %8.2f" % (config, counters['pages'],
+        counters['errors'], counters.get('retries', 0),
+        counters.get('throttled', 0), site.refused, site.requests + site.refused,
+        res['elapsed'])
+  finally:
+    shutil.rmtree(workdir)
+
+def bench_mirror(argv):
+  # The same SyntheticSite book served by two mirrors, the one in the URL
+  # slow, the other fast, both with a tail of slow requests:
+  #   mirror [--chapters N] [--slow MS] [--fast MS] [--tail PERCENT]
+  #          [--tail-latency MS] ["TOPSHELF OPTIONS" ...]
+  # The options may use the mirrors as $SLOW and $FAST, the books must be
+  # the same.
+  params = {'chapters': 20, 'slow': 100, 'fast': 10, 'tail': 5,
+            'tail-latency': 500}
+  configs = []
+  i = 0
+  while i < len(argv):
+    if argv[i].startswith("--") and argv[i][2:] in params:
+      params[argv[i][2:]] = int(argv[i + 1])
+      i += 2
+    else:
+      configs.append(argv[i])
+      i += 1
+  if not configs:
+    configs = ["--mirrors none -j 4", "--mirrors $SLOW,$FAST -j 4",
+               "--mirrors $SLOW,$FAST -j 4 --hedge 100"]
+  sites = []
+  for latency in (params['slow'], params['fast']):
+    sites.append(SyntheticSite(params['chapters'], 10, 2, latency / 1000.0,
+                               tail=params['tail'] / 100.0,
+                               tail_latency=params['tail-latency'] / 1000.0))
+  hosts = [site.serve()[len("http://"):] for site in sites]
+  print "%d chapters, mirrors at %d and %d ms, %d%% of the requests %d ms slower" % (
+    params['chapters'], params['slow'], params['fast'], params['tail'],
+    params['tail-latency'])
+  print "%-40s %6s %9s %9s %7s %8s %6s" % ("options", "pages", "slow req",
+    "fast req", "hedged", "time s", "same")
+  workdir = tempfile.mkdtemp()
+  expected = None
+  try:
+    for config in configs:
+      before = [site.requests for site in sites]
+      options = shlex.split(config.replace("$SLOW", hosts[0]).replace("$FAST", hosts[1]))
+      res = crawl("http://%s/book/index" % hosts[0], options, workdir)
+      if res is None:
+        print "%-40s %s" % (config, "FAILED")
+        continue
+      members = [(name, data) for name, crc, data in
+                 zip_members(os.path.join(workdir, "book.epub"))
+                 if name.startswith("content/")]
+      if expected is None:
+        expected = members
+      counters = res['counters']
+      print "%-40s %6d %9d %9d %7d %8.2f %6s" % (config, counters['pages'],
+        sites[0].requests - before[0], sites[1].requests - before[1],
+        counters.get('hedged', 0), res['elapsed'], members == expected)
+  finally:
+    for site in sites:
+      site.shutdown()
+    shutil.rmtree(workdir)
+
+def bench_canonical(argv):
+  # Builds a SyntheticSite book whose chapters show the same image under
+  # several forms of its URL:
+  #   canonical [--chapters N] [--latency MS] ["TOPSHELF OPTIONS" ...]
+  # The books must be the same, the forms are downloaded once unless the
+  # URLs are taken as they are.
+  params = {'chapters': 40, 'latency': 20}
+  configs = []
+  i = 0
+  while i < len(argv):
+    if argv[i].startswith("--") and argv[i][2:] in params:
+      params[argv[i][2:]] = int(argv[i + 1])
+      i += 2
+    else:
+      configs.append(argv[i])
+      i += 1
+  if not configs:
+    configs = ["--canonical none --drop-param none -j 4", "-j 4"]
+  print "%d chapters, %d forms of a shared image, %d ms latency" % (
+    params['chapters'], len(SyntheticSite.forms), params['latency'])
+  print "%-40s %6s %9s %9s %9s %8s %6s" % ("options", "pages", "resources",
+    "requests", "variants", "time s", "same")
+  site = SyntheticSite(params['chapters'], 10, 2, params['latency'] / 1000.0,
+                       variants=True)
+  url = site.serve() + "/book/index"
+  workdir = tempfile.mkdtemp()
+  expected = None
+  try:
+    for config in configs:
+      before = site.requests
+      res = crawl(url, shlex.split(config), workdir)
+      if res is None:
+        print "%-40s %s" % (config, "FAILED")
+        continue
+      members = [(name, data) for name, crc, data in
+                 zip_members(os.path.join(workdir, "book.epub"))
+                 if name.startswith("content/")]
+      if expected is None:
+        expected = members
+      counters = res['counters']
+      print "%-40s %6d %9d %9d %9d %8.2f %6s" % (config, counters['pages'],
+        counters['resources'], site.requests - before,
+        counters.get('url_variants', 0), res['elapsed'], members == expected)
+  finally:
+    site.shutdown()
+    shutil.rmtree(workdir)
+
+def bench_batch(argv):
+  # Several e-books in one --batch, sharing the caches:
+  #   batch [--books N] [--chapters N] [--latency MS] ["TOPSHELF OPTIONS"]
+  # Each line is the same raw crawl (-r -O) of chapters linked in a ring.
+  # The e-books after the first are served from the memory cache, and -O
+  # must still stop them once round the ring, with each chapter once.
+  params = {'books': 2, 'chapters': 20, 'latency': 20}
+  options = []
+  i = 0
+  while i < len(argv):
+    if argv[i].startswith("--") and argv[i][2:] in params:
+      params[argv[i][2:]] = int(argv[i + 1])
+      i += 2
+    else:
+      options += shlex.split(argv[i])
+      i += 1
+  site = SyntheticSite(params['chapters'], 10, 1, params['latency'] / 1000.0,
+                       ring=True)
+  url = site.serve() + "/book/chapter-1"
+  workdir = tempfile.mkdtemp()
+  script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "topshelf.py")
+  print "%d books of a ring of %d chapters, %d ms latency" % (params['books'],
+    params['chapters'], params['latency'])
+  print "%-6s %6s %6s %8s %6s" % ("book", "pages", "hits", "time s", "ok")
+  try:
+    f = open(os.path.join(workdir, "batch.txt"), "w")
+    for n in range(params['books']):
+      f.write(" ".join(["-r", "-O", "-c", "--stats-json", "stats.json",
+                        "-o", "./book-%d.epub" % n] + options + [url]) + "\n")
+    f.close()
+    subprocess.call([sys.executable, script, "--batch", "batch.txt"],
+                    cwd=workdir, stdout=open(os.devnull, "w"),
+                    stderr=subprocess.STDOUT)
+    reports = {}
+    if os.path.exists(os.path.join(workdir, "stats.json")):
+      for line in open(os.path.join(workdir, "stats.json")):
+        report = json.loads(line)
+        reports[report['outfile']] = report
+    for n in range(params['books']):
+      report = reports.get("./book-%d.epub" % n)
+      if report is None:
+        print "%-6d %s" % (n + 1, "FAILED")
+        continue
+      counters = report['counters']
+      chapters = [name for name, crc, data in
+                  zip_members(os.path.join(workdir, "book-%d.epub" % n))
+                  if name.startswith("content/chapter-")]
+      print "%-6d %6d %6d %8.2f %6s" % (n + 1, counters['pages'],
+        counters['cache_hits'], report['elapsed'],
+        counters['pages'] == params['chapters'] and
+        len(chapters) == params['chapters'])
+  finally:
+    site.shutdown()
+    shutil.rmtree(workdir)
+
+def crawl_url(i):
+  return "http://bigcloset.us/tf/stories/%d/chapter-%d-and-the-story-goes-on" % (
+    i // 20, i % 20)
+
+def rss_kb():
+  for line in open("/proc/self/status"):
+    if line.startswith("RssAnon:"):
+      return int(line.split()[1])
+
+def check_visited(kind, n, seed=1):
+  # Builds the set of `kind' with n URLs in a child process, returns its
+  # memory in KB, the time taken, the false negatives and the false
+  # positives among n new URLs, whether it is the same once saved and
+  # loaded, and its own report
+  r, w = os.pipe()
+  pid = os.fork()
+  if pid:
+    os.close(w)
+    res = json.loads(os.fdopen(r).read())
+    os.waitpid(pid, 0)
+    return res
+  os.close(r)
+  # The URLs are made as they are added, as the crawl does
+  rnd = random.Random(seed)
+  ids = array.array('l', rnd.sample(xrange(4 * n), 2 * n))
+  before = rss_kb()
+  start = time.time()
+  if kind == "strings":
+    visited = set()
+  else:
+    visited = VisitedSet(kind == "bloom")
+  for i in xrange(n):
+    visited.add(crawl_url(ids[i]))
+  res = {'kb': rss_kb() - before, 'add': time.time() - start}
+  seen = [crawl_url(i) for i in ids[:n]]
+  new  = [crawl_url(i) for i in ids[n:]]
+  start = time.time()
+  res['negatives'] = sum(1 for url in seen if url not in visited)
+  res['positives'] = sum(1 for url in new if url in visited)
+  res['lookup'] = time.time() - start
+  res['reloaded'] = True
+  if kind != "strings":
+    res['report'] = visited.report()
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    visited.save(filename)
+    reloaded = VisitedSet(kind == "bloom")
+    reloaded.load(filename)
+    res['reloaded'] = len(reloaded) == n and \
+      all(url in reloaded for url in seen[::97]) and \
+      not any(url in reloaded for url in new[::97])
+    reloaded.close()
+    visited.close()
+    os.remove(filename)
+  f = os.fdopen(w, "w")
+  f.write(json.dumps(res))
+  f.close()
+  os._exit(0)
+
+def bench_visited(argv):
+  # The URLs seen by a raw crawl kept as strings in a set, as fingerprints
+  # and in a Bloom filter spilling the fingerprints to disk:
+  #   visited [URLS ...]
+  sizes = [int(a) for a in argv] or [100000, 1000000]
+  print "%-8s %8s %10s %8s %9s %9s %6s %6s %8s %9s" % ("kind", "urls",
+    "memory KB", "B/url", "add us", "find us", "f.neg", "f.pos",
+    "bloom fp", "reloaded")
+  for n in sizes:
+    for kind in ("strings", "hash", "bloom"):
+      res = check_visited(kind, n)
+      report = res.get('report', {})
+      print "%-8s %8d %10d %8.1f %9.2f %9.2f %6d %6d %8s %9s" % (kind, n,
+        res['kb'], res['kb'] * 1024.0 / n, res['add'] * 1e6 / n,
+        res['lookup'] * 1e6 / (2 * n), res['negatives'], res['positives'],
+        'bloom_false_positive_rate' in report and
+          "%.4f" % report['bloom_false_positive_rate'] or "-",
+        res['reloaded'])
+
+def long_chapter(kb, sections, seed=1):
+  # A rendered page of about `kb' KB in a <div>, with a table of contents
+  # linking to the `sections' headings and links back to it. The headings
+  # have non-ASCII characters and entities.
+  rnd = random.Random(seed)
+  words = "the story went on and she said it was <b>so</b> very <i>odd</i> there".split()
+  toc = "".join('    <li>\n     <a href="#sec-%d">\n      Section %d\n     </a>\n    </li>\n'
+                % (i, i) for i in range(sections))
+  body = ['  <div class="story">\n   <h1 id="top">\n    The Story\n   </h1>\n'
+          '   <ul id="toc">\n%s   </ul>\n' % toc]
+  size = len(body[0])
+  per_section = kb * 1024 / sections
+  for i in range(sections):
+    body.append('   <h2 id="sec-%d">\n    Section %d &#8211; caf\xc3\xa9 &amp; <i>cr\xc3\xa8me</i>\n   </h2>\n' % (i, i))
+    written = 0
+    while written < per_section:
+      para = '   <p id="p-%d-%d">\n    %s\n   </p>\n' % (i, written, " ".join(
+        rnd.choice(words) for j in range(rnd.randint(40, 120))))
+      body.append(para)
+      written += len(para)
+    body.append('   <p>\n    <a href="#toc">\n     Back\n    </a>\n   </p>\n')
+  return ('<html>\n <head>\n  <title>\n   The Story\n  </title>\n </head>\n'
+          ' <body>\n%s  </div>\n </body>\n</html>' % "".join(body))
+
+def book_text(epub, filenames):
+  # The text of the bodies of the documents, one word after the other
+  words = []
+  for filename in filenames:
+    doc = xml.dom.minidom.parseString(epub.all_files[filename]['data'])
+    stack = [doc.getElementsByTagName('body')[0]]
+    while stack:
+      node = stack.pop()
+      if node.nodeType == node.TEXT_NODE:
+        words.extend(node.data.split())
+      else:
+        stack.extend(reversed(node.childNodes))
+  return words
+
+def check_split(epub, source, split_size):
+  # The errors of the book `epub' split from the documents of `source'
+  errors = []
+  docs = [f for f in epub.all_files if epub.all_files[f]['type'] == "application/xhtml+xml"]
+  ids = {}
+  for filename in docs:
+    try:
+      dom = xml.dom.minidom.parseString(epub.all_files[filename]['data'])
+    except Exception, e:
+      errors.append("%s: %s" % (filename, e))
+      continue
+    for node in dom.getElementsByTagName('*'):
+      if node.getAttribute('id'):
+        if node.getAttribute('id') in ids.setdefault(filename, set()):
+          errors.append("%s: id %s twice" % (filename, node.getAttribute('id')))
+        ids[filename].add(node.getAttribute('id'))
+    if len(epub.all_files[filename]['data']) > split_size * 1.5:
+      errors.append("%s: %d bytes" % (filename, len(epub.all_files[filename]['data'])))
+  if errors:
+    return errors
+  for filename in docs:
+    for href in re.findall(r'href="([^"]*#[^"]*)"', epub.all_files[filename]['data']):
+      path, _, anchor = href.partition('#')
+      target = path and posixpath.normpath(posixpath.join(posixpath.dirname(filename), path)) or filename
+      if anchor not in ids.get(target, ()):
+        errors.append("%s: broken link %s" % (filename, href))
+  for filename in source.all_files:
+    parts = [filename] + [p['file'] for p in epub.parts.get(filename, [])]
+    if book_text(epub, parts) != book_text(source, [filename]):
+      errors.append("%s: not the same text" % filename)
+  spine = re.findall(r'idref="item_(file[0-9]+)"', epub.get_opf())
+  names = dict((epub.all_files[f]['id'], f) for f in epub.all_files)
+  spine = [names[i] for i in spine]
+  expected = []
+  for nav in source.navigation:
+    expected += [nav['file']] + [p['file'] for p in epub.parts.get(nav['file'], [])]
+  if spine != expected:
+    errors.append("spine %s" % spine)
+  try:
+    toc = xml.dom.minidom.parseString(epub.get_toc().encode('utf-8'))
+  except Exception, e:
+    errors.append("toc.ncx: %s" % e)
+    return errors
+  labels = {}
+  for nav in toc.getElementsByTagName('navPoint'):
+    text = nav.getElementsByTagName('text')[0].firstChild
+    labels[nav.getElementsByTagName('content')[0].getAttribute('src')] = \
+      text and " ".join(text.data.split())
+  for filename in epub.parts:
+    for part in epub.parts[filename]:
+      if not part['title']: continue
+      text = " ".join(book_text(epub, [part['file']]))
+      if not labels.get(part['file']) or not text.startswith(labels[part['file']]):
+        errors.append("%s: toc entry %r" % (part['file'], labels.get(part['file'])))
+  return errors
+
+def split_book(chapter, sections, split_size):
+  # The chapter between two pages linking into it, as an Epub split at
+  # split_size KB (None not to split), with the seconds taken to add it
+  epub = Epub()
+  epub.split_size = split_size and split_size * 1024
+  link = '<html>\n <body>\n  <p>\n   <a href="../content/story#sec-%d">\n    Section\n   </a>\n  </p>\n </body>\n</html>'
+  pages = [("content/before", link % (sections - 1)),
+           ("content/story", chapter),
+           ("content/after", link % (sections / 2))]
+  elapsed = 0
+  for filename, data in pages:
+    t = time.time()
+    epub.addfile(filename, data, "application/xhtml+xml")
+    elapsed += time.time() - t
+    epub.navigation.append({'file': filename, 'title': filename, 'sub': []})
+  return epub, elapsed
+
+def bench_split(argv):
+  # Splitting a long chapter with section headings and links into its ids
+  # from the chapter and from the pages around it:
+  #   split [--kb KB] [--sections N] [SPLIT_KB ...]
+  # The parts must be well-formed, with the text of the chapter, the links
+  # must point at the part holding their id.
+  params = {'kb': 4096, 'sections': 40}
+  sizes = []
+  i = 0
+  while i < len(argv):
+    if argv[i].startswith("--") and argv[i][2:] in params:
+      params[argv[i][2:]] = int(argv[i + 1])
+      i += 2
+    else:
+      sizes.append(int(argv[i]))
+      i += 1
+  sizes = sizes or [64, 256, 1024]
+  chapter = long_chapter(params['kb'], params['sections'])
+  source, _ = split_book(chapter, params['sections'], None)
+  print "a %d KB chapter with %d sections" % (
+    len(source.all_files["content/story"]['data']) / 1024, params['sections'])
+  print "%-10s %6s %9s %9s %11s %6s" % ("split KB", "parts", "largest", "headings",
+    "split ms", "ok")
+  workdir = tempfile.mkdtemp()
+  try:
+    for size in sizes:
+      epub, elapsed = split_book(chapter, params['sections'], size)
+      parts = epub.parts.get("content/story", [])
+      epub.writeout(os.path.join(workdir, "book.epub"))
+      errors = check_split(epub, source, size * 1024)
+      for error in errors[:5]:
+        print "  %s" % error
+      largest = max(len(epub.all_files[f]['data']) for f in epub.all_files)
+      print "%-10d %6d %9d %9d %11.1f %6s" % (size, len(parts) + 1,
+        largest / 1024, len([p for p in parts if p['title']]), elapsed * 1000,
+        not errors)
+  finally:
+    shutil.rmtree(workdir)
+
+benchmarks = {
+  'registry': bench_registry,
+  'sanitize': bench_sanitize,
+  'text':     bench_text,
+  'prefilter': bench_prefilter,
+  'toc':      bench_toc,
+  'crawl':    bench_crawl,
+  'parser':   bench_parser,
+  'zip':      bench_zip,
+  'cache':    bench_cache,
+  'serve':    bench_serve,
+  'retry':    bench_retry,
+  'mirror':   bench_mirror,
+  'canonical': bench_canonical,
+  'visited':  bench_visited,
+  'split':    bench_split,
+  'batch':    bench_batch,
+}
+
+def main(argv):
+  if len(argv) < 2 or argv[1] not in benchmarks:
+    print "usage: %s BENCHMARK [ARGS ...]" % argv[0]
+    print "benchmarks: %s" % ", ".join(sorted(benchmarks))
+    return 1
+  benchmarks[argv[1]](argv[2:])
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
+
+#######################################################################
+## Copyright (c) 2009 Mildred Ki'Lya <mildred593(at)online.fr>
+##
+## Permission is hereby granted, free of charge, to any person
+## obtaining a copy of this software and associated documentation
+## files (the "Software"), to deal in the Software without
+## restriction, including without limitation the rights to use,
+## copy, modify, merge, publish, distribute, sublicense, and/or sell
+## copies of the Software, and to permit persons to whom the
+## Software is furnished to do so, subject to the following
+## conditions:
+##
+## The above copyright notice and this permission notice shall be
+## included in all copies or substantial portions of the Software.
+##
+## THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+## EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+## OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+## NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+## HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+## WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+## FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+## OTHER DEALINGS IN THE SOFTWARE.
+#######################################################################
+## kate: hl Python; indent-width 2; space-indent on; replace-tabs off;
+## kate: tab-width 8; remove-trailing-space on;
@@ -6,6 +6,16 @@
 import zipfile
 import uuid
 import time
+import os
+import shutil
+import struct
+import zlib
+import itertools
+import multiprocessing.pool
+import re
+import posixpath
+import bisect
+import HTMLParser
 #try:
 #  import tidy
 #except:
@@ -18,6 +28,7 @@ class Epub:
   #   'data': the content of the file
   #   'type': the mime type
   #   'id':   an unique identifier
+  #   'source': for copied files, the ZipFile to copy the file from
 
   navigation = []
   # an array of dictionnaries containing the table of contents
@@ -29,12 +40,66 @@ class Epub:
   nxc_uid = ""
   nxc_title = "Table Of Contents"
 
+  crawl_manifest = "META-INF/crawl.json"
+
+  stream = None
+  # ZipFile the files are written to as soon as they are added, or None to
+  # keep their data in all_files until writeout. When streaming, the 'data'
+  # of all_files entries is None.
+
+  stored_types = set(["image/jpeg", "image/png", "image/gif"])
+  # mime types of files compressed already, stored in the zip as is
+
+  compress_jobs = 1
+  # number of threads compressing the files in writeout
+
+  split_size = None
+  # XHTML documents of more bytes are split in parts of at most about that
+  # size at paragraph or heading boundaries, None not to split them
+
+  parts = {}
+  # dictionnary indexed by the filename of the split documents, the list
+  # of their parts after the first one, in order, as dictionnaries:
+  #   'file':  the filename of the part
+  #   'title': the heading it starts with, or None
+  #   'ids':   the ids of the elements in the part
+  # The parts follow their document in the spine, those starting with a
+  # heading are sub-entries of its table of contents entry.
+
+  anchors = {}
+  # dictionnary indexed by (filename, id) of the ids moved to another part
+  # of the document, the value is the filename of the part
+
+  block_tags   = set(["p", "div", "h1", "h2", "h3", "h4", "h5", "h6",
+                      "blockquote", "pre", "ul", "ol", "dl", "li", "table",
+                      "tr", "hr", "center", "section", "article",
+                      "address", "figure"])
+  heading_tags = set(["h1", "h2", "h3", "h4", "h5", "h6"])
+  void_tags    = set(["br", "hr", "img", "meta", "link", "input", "col",
+                      "area", "base", "param", "wbr"])
+  raw_tags     = set(["script", "style"])
+  # a document is split before the start tag of a block element, the
+  # elements it is in are closed at the end of the part and opened again
+  # at the start of the next one
+
+  tag_pattern    = re.compile(r'<(/?)([a-zA-Z][a-zA-Z0-9]*)([^>]*)>|<!--.*?-->', re.S)
+  id_pattern     = re.compile(r'\s(?:id|name)="([^"]*)"')
+  anchor_pattern = re.compile(r'(\shref=")([^"#]*)#([^"]*)"')
+
+  unescape = HTMLParser.HTMLParser().unescape
+
   def __init__(self):
     self.ncx_uid   = uuid.uuid1();
     self.ncx_title = "Table Of Contents"
     self.file_id   = 1
     self.all_files  = {}
     self.navigation = []
+    self.stream      = None
+    self.stream_name = None
+    self.compress_jobs = 1
+    self.split_size = None
+    self.parts   = {}
+    self.anchors = {}
 
   def tidy(self, code):
     try:
@@ -56,12 +121,283 @@ class Epub:
       return code
 
   def addfile(self, filename, content, type):
+    if type == "application/xhtml+xml":
+      if self.split_size and len(content) > self.split_size:
+        parts = self.split_document(filename, content)
+        if parts:
+          content = parts[0][1]
+          self.addfile_as_is(filename, content, type)
+          for part, data, title, ids in parts[1:]:
+            self.addfile_as_is(part, data, type)
+          return
+      if self.stream and self.anchors:
+        content = self.rewrite_anchors(filename, content)
+    self.addfile_as_is(filename, content, type)
+
+  def addfile_as_is(self, filename, content, type):
     self.all_files[filename] = {
       'data': content,
       'type': type,
       'id':   "file%i" % self.file_id
     }
     self.file_id += 1
+    if self.stream:
+      self.write_raw(self.stream, filename, *self.compress((filename, content, type)))
+      self.all_files[filename]['data'] = None
+
+  def part_name(self, filename, n):
+    # Filename of the part n of the document filename
+    base, dot, ext = filename.partition('.')
+    name = "%s-part%d%s%s" % (base, n, dot, ext)
+    i = 2
+    while name in self.all_files:
+      name = "%s-part%d-%d%s%s" % (base, n, i, dot, ext)
+      i += 1
+    return name
+
+  def split_points(self, content, start, end):
+    # Where to split content[start:end], the body of a document, as a list
+    # of (position, [(name, start tag) of the elements open], heading), and
+    # the (position, id) of the ids of its elements
+    size  = self.split_size
+    stack = []
+    cuts  = []
+    ids   = []
+    part_start = start
+    last = None
+    pos = start
+    while True:
+      m = self.tag_pattern.search(content, pos, end)
+      if m is None:
+        break
+      pos = m.end()
+      closing, name, attrs = m.groups()
+      if name is None:
+        continue
+      name = name.lower()
+      if closing:
+        if stack and stack[-1][0] == name:
+          stack.pop()
+          continue
+        for i in range(len(stack) - 1, -1, -1):
+          if stack[i][0] == name:
+            del stack[i:]
+            break
+        continue
+      if 'id="' in attrs or 'name="' in attrs:
+        for i in self.id_pattern.findall(attrs):
+          ids.append((m.start(), i))
+      if name in self.block_tags:
+        line = content.rfind('\n', part_start, m.start()) + 1
+        if not line or content[line:m.start()].strip():
+          line = m.start()
+        if line > part_start:
+          point = (line, list(stack), name in self.heading_tags)
+          if line - part_start > size and last and last[0] > part_start:
+            cuts.append(last)
+            part_start = last[0]
+          if line - part_start > size or \
+             (point[2] and line - part_start >= size // 2):
+            cuts.append(point)
+            part_start = line
+          last = point
+      if name in self.raw_tags:
+        close = content.find('</', pos, end)
+        pos = close < 0 and end or close
+      elif name not in self.void_tags and not attrs.endswith('/'):
+        stack.append((name, m.group()))
+    if end - part_start > size and last and last[0] > part_start:
+      cuts.append(last)
+    return cuts, ids
+
+  def split_document(self, filename, content):
+    # Split the XHTML document in parts of about split_size, returns the
+    # list of [filename, data, title, ids] of the parts, or None if it
+    # can't be split. The first part keeps filename.
+    body = re.search(r'<body\b[^>]*>', content)
+    end  = content.rfind('</body>')
+    if body is None or end < body.end():
+      return None
+    start = body.end()
+    cuts, ids = self.split_points(content, start, end)
+    if not cuts:
+      return None
+    # ids[first[n]:first[n + 1]] are in part n
+    first = [bisect.bisect_left(ids, (pos,)) for pos, _, _ in cuts]
+    first = [0] + first + [len(ids)]
+    head, tail = content[:start], content[end:]
+    bounds = [(start, [], False)] + cuts + [(end, [], False)]
+    parts = []
+    for n in range(len(bounds) - 1):
+      (begin, opened, heading), (stop, closed, _) = bounds[n], bounds[n + 1]
+      text = content[begin:stop]
+      data = [head]
+      if n:
+        data.append('\n')
+      for name, tag in opened:
+        data.append(self.id_pattern.sub('', tag) + '\n')
+      data.append(text)
+      for name, tag in reversed(closed):
+        data.append('</%s>\n' % name)
+      data.append(tail)
+      title = None
+      if heading:
+        m = self.tag_pattern.search(text)
+        close = text.find('</%s' % m.group(2), m.end())
+        title = self.tag_pattern.sub(' ', text[m.end():close])
+        title = self.heading_title(title)
+      part = n and self.part_name(filename, n + 1) or filename
+      parts.append([part, ''.join(data), title,
+                    [i for pos, i in ids[first[n]:first[n + 1]]]])
+    self.parts[filename] = []
+    for part, data, title, ids in parts[1:]:
+      self.parts[filename].append({'file': part, 'title': title, 'ids': ids})
+      for i in ids:
+        self.anchors[(filename, i)] = part
+    # The links to the ids of the document from the document itself
+    local = dict((i, part) for part, data, title, ids in parts for i in ids)
+    for part in parts:
+      part[1] = self.rewrite_anchors(part[0], part[1], filename, local)
+    return parts
+
+  def heading_title(self, text):
+    # The table of contents title for the text of a heading, UTF-8 with
+    # HTML entities, or None if it is empty
+    title = " ".join(self.unescape(text.decode('utf-8')).split())
+    if not title:
+      return None
+    return title.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+  def rewrite_anchors(self, filename, data, document=None, local=None):
+    # Point the links to ids moved to another part of their document at
+    # that part. filename is a part of `document' whose ids are in `local'.
+    base = posixpath.dirname(filename)
+    def replace(m):
+      path, anchor = m.group(2), m.group(3)
+      if path:
+        target = posixpath.normpath(posixpath.join(base, path))
+        part = self.anchors.get((target, anchor))
+      elif local is not None:
+        target = document
+        part = local.get(anchor)
+      else:
+        return m.group()
+      if part is None or part == filename:
+        return m.group()
+      name = posixpath.basename(part)
+      if isinstance(name, unicode):
+        # The filenames of TopShelf, the data is UTF-8
+        name = name.encode('utf-8')
+      if path.endswith(posixpath.basename(target)):
+        name = path[:len(path) - len(posixpath.basename(target))] + name
+      return '%s%s#%s"' % (m.group(1), name, anchor)
+    return self.anchor_pattern.sub(replace, data)
+
+  def copyfile(self, filename, source, type):
+    # Add `filename' from the ZipFile `source' as is, without decompressing
+    # and compressing it again
+    self.all_files[filename] = {
+      'data':   None,
+      'source': source,
+      'type':   type,
+      'id':     "file%i" % self.file_id
+    }
+    self.file_id += 1
+    if self.stream:
+      self.copy_raw(self.stream, source, filename)
+      self.all_files[filename]['source'] = None
+
+  def copy_raw(self, epub, source, filename):
+    info = source.getinfo(filename)
+    source.fp.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader,
+                           source.fp.read(zipfile.sizeFileHeader))
+    source.fp.seek(header[zipfile._FH_FILENAME_LENGTH] +
+                   header[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+    raw = source.fp.read(info.compress_size)
+    self.write_raw(epub, filename, info.compress_type, info.CRC,
+                   info.file_size, raw)
+
+  def write_raw(self, epub, filename, compress_type, crc, file_size, raw):
+    # Same as ZipFile.writestr for data that is already compressed
+    info = self.make_zipinfo(filename, compress_type)
+    info.CRC           = crc
+    info.file_size     = file_size
+    info.compress_size = len(raw)
+    info.header_offset = epub.fp.tell()
+    epub._writecheck(info)
+    epub._didModify = True
+    zip64 = file_size > zipfile.ZIP64_LIMIT or len(raw) > zipfile.ZIP64_LIMIT
+    epub.fp.write(info.FileHeader(zip64))
+    epub.fp.write(raw)
+    epub.fp.flush()
+    epub.filelist.append(info)
+    epub.NameToInfo[filename] = info
+
+  def compress(self, member):
+    # Compress a (filename, data, type) member for write_raw, the result is
+    # (compress_type, crc, file_size, raw). Deflates as ZipFile.writestr
+    # does, except for the stored_types.
+    filename, data, type = member
+    crc = zlib.crc32(data) & 0xffffffff
+    if type in self.stored_types:
+      return zipfile.ZIP_STORED, crc, len(data), data
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    raw = compressor.compress(data) + compressor.flush()
+    return zipfile.ZIP_DEFLATED, crc, len(data), raw
+
+  def compress_all(self, members):
+    # Compress the members on up to compress_jobs threads (zlib releases
+    # the GIL) and yield the results in the order of the members
+    jobs = min(self.compress_jobs, len(members))
+    if jobs <= 1:
+      for member in members:
+        yield self.compress(member)
+      return
+    pool = multiprocessing.pool.ThreadPool(jobs)
+    try:
+      for res in pool.imap(self.compress, members):
+        yield res
+    finally:
+      pool.terminate()
+
+  def write_chunks(self, epub, filename, chunks, size=65536):
+    # Compress the member into the zip as the chunks come, in pieces of
+    # about `size' bytes, and fill in its header once the CRC is known
+    info = self.make_zipinfo(filename)
+    info.CRC = info.file_size = info.compress_size = 0
+    info.header_offset = epub.fp.tell()
+    epub._writecheck(info)
+    epub._didModify = True
+    epub.fp.write(info.FileHeader(False))
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    buf = []
+    buf_size = 0
+    for chunk in itertools.chain(chunks, [None]):
+      if chunk is not None:
+        buf.append(chunk)
+        buf_size += len(chunk)
+        if buf_size < size: continue
+      data = u''.join(buf).encode('utf-8')
+      buf = []
+      buf_size = 0
+      info.CRC = zlib.crc32(data, info.CRC) & 0xffffffff
+      info.file_size += len(data)
+      data = compressor.compress(data)
+      if chunk is None:
+        data += compressor.flush()
+      info.compress_size += len(data)
+      epub.fp.write(data)
+    end = epub.fp.tell()
+    epub.fp.seek(info.header_offset)
+    epub.fp.write(info.FileHeader(False))
+    epub.fp.seek(end)
+    epub.filelist.append(info)
+    epub.NameToInfo[filename] = info
+
+  def get_crawl_manifest(self):
+    # Extra file stored in META-INF by subclasses, None for none
+    return None
 
   def make_zipinfo(self, filename, compress_type = zipfile.ZIP_DEFLATED):
     info = zipfile.ZipInfo(filename)
@@ -70,10 +406,7 @@ class Epub:
     info.external_attr = 0644 << 16L
     return info
 
-  def writeout(self, epub_name):
-
-    epub = zipfile.ZipFile(epub_name, 'w')
-
+  def write_header(self, epub):
     mimetype = self.make_zipinfo('mimetype')
     mimetype.compress_type = zipfile.ZIP_STORED
     epub.writestr(mimetype, 'application/epub+zip')
@@ -85,15 +418,60 @@ class Epub:
   </rootfiles>
 </container>\n""")
 
-    epub.writestr("metadata.opf", self.get_opf().encode('utf-8'))
-    epub.writestr("toc.ncx",      self.get_toc().encode('utf-8'))
+  def open_stream(self, epub_name):
+    # Start writing the e-book now, the files added from now on are written
+    # out immediately instead of being kept in memory. writeout finishes
+    # the e-book and moves it to its final name.
+    self.stream_name = epub_name
+    self.stream = zipfile.ZipFile(epub_name, 'w')
+    self.write_header(self.stream)
+
+  def discard_stream(self):
+    if self.stream:
+      self.stream.close()
+      self.stream = None
+      os.remove(self.stream_name)
+      self.stream_name = None
 
+  def writeout(self, epub_name):
+
+    if self.stream:
+      epub = self.stream
+      self.stream = None
+    else:
+      # Written aside, the files may be copied from the e-book it replaces
+      self.stream_name = epub_name + ".part"
+      epub = zipfile.ZipFile(self.stream_name, 'w')
+      self.write_header(epub)
+
+    self.write_chunks(epub, "metadata.opf", self.opf_chunks())
+    self.write_chunks(epub, "toc.ncx",      self.toc_chunks())
+    manifest = self.get_crawl_manifest()
+    if manifest is not None:
+      epub.writestr(self.crawl_manifest, manifest)
+
+    if self.anchors:
+      for filename, f in self.all_files.iteritems():
+        if f['type'] == "application/xhtml+xml" and f['data'] is not None:
+          f['data'] = self.rewrite_anchors(filename, f['data'])
+
+    # Compressed in parallel, written in the order of all_files
+    compressed = self.compress_all([(filename, f['data'], f['type'])
+      for filename, f in self.all_files.iteritems()
+      if not f.get('source') and f['data'] is not None])
     for filename in self.all_files:
-      info = self.make_zipinfo(filename)
-      epub.writestr(info, self.all_files[filename]['data'])
+      f = self.all_files[filename]
+      if f.get('source'):
+        self.copy_raw(epub, f['source'], filename)
+      elif f['data'] is not None:
+        self.write_raw(epub, filename, *next(compressed))
 
     epub.close()
 
+    if self.stream_name and self.stream_name != epub_name:
+      shutil.move(self.stream_name, epub_name)
+    self.stream_name = None
+
 
   def get_metainfo(self, info):
     if   info == "title":	res = ""
@@ -111,6 +489,9 @@ class Epub:
     return res
 
   def get_opf(self):
+    return u''.join(self.opf_chunks())
+
+  def opf_chunks(self):
     metadata = u"""  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/"
       xmlns:dcterms="http://purl.org/dc/terms/"
       xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
@@ -137,48 +518,70 @@ class Epub:
       self.get_metainfo("date"),
       self.get_metainfo("rights"))
 
-    manifest  = '  <manifest>\n'
-    manifest += '    <item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>\n'
-    for filename in self.all_files:
-      f = self.all_files[filename]
-      manifest += '    <item id="item_%s" href="%s" media-type="%s"/>\n' % (
-        f['id'], filename, f['type'])
-    manifest += '  </manifest>\n'
-
-    spine  = '  <spine toc="ncx">\n'
-    spine += self.navigate_opf(self.navigation)
-    spine += '  </spine>\n'
-
-    return u"""<?xml version="1.0"?>
+    yield u"""<?xml version="1.0"?>
 <package xmlns="http://www.idpf.org/2007/opf" unique-identifier="dcidid"
    version="2.0">
 
 %s
 
-%s
-
-%s
-
-</package>""" % (metadata, manifest, spine)
-
-  def navigate_opf(self, navigation, res = ""):
-    for nav in navigation:
-      type, a, b = self.all_files[nav['file']]['type'].partition('/')
-      if type == "text" or type == "application":
-        res += '    <itemref idref="item_%s"/>\n' % self.all_files[nav['file']]['id']
-        res = self.navigate_opf(nav['sub'], res)
-    return res
+""" % metadata
 
+    yield '  <manifest>\n'
+    yield '    <item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>\n'
+    for filename in self.all_files:
+      f = self.all_files[filename]
+      yield '    <item id="item_%s" href="%s" media-type="%s"/>\n' % (
+        f['id'], filename, f['type'])
+    yield '  </manifest>\n'
+
+    yield '\n\n'
+
+    yield '  <spine toc="ncx">\n'
+    for nav in self.walk_navigation():
+      if nav is None: continue
+      yield '    <itemref idref="item_%s"/>\n' % self.all_files[nav['file']]['id']
+      for part in self.parts.get(nav['file'], []):
+        yield '    <itemref idref="item_%s"/>\n' % self.all_files[part['file']]['id']
+    yield '  </spine>\n'
+
+    yield """
+
+</package>"""
+
+  def walk_navigation(self, only_text=True):
+    # Navigation items in reading order, without recursion. None is
+    # yielded after the children of each item. With only_text, items that
+    # are not text (and their children) are skipped as in the spine.
+    stack = [iter(self.navigation)]
+    while stack:
+      for nav in stack[-1]:
+        if only_text:
+          type, a, b = self.all_files[nav['file']]['type'].partition('/')
+          if type != "text" and type != "application":
+            continue
+        yield nav
+        stack.append(iter(nav['sub']))
+        break
+      else:
+        stack.pop()
+        if stack:
+          yield None
 
   def get_toc(self):
-    map = ""
+    return u''.join(self.toc_chunks())
+
+  def toc_chunks(self):
     depth = 0
-    order = 1
-    for nav in self.navigation:
-      map, d, order = self.navigate_toc(nav, "    ", map, 0, order)
-      if d > depth:
-        depth = d
-    toc = u"""<?xml version="1.0" encoding="utf-8"?>
+    level = 0
+    for nav in self.walk_navigation(only_text=False):
+      if nav is None:
+        level -= 1
+      else:
+        level += 1
+        depth = max(depth, level)
+        if any(part['title'] for part in self.parts.get(nav['file'], [])):
+          depth = max(depth, level + 1)
+    yield u"""<?xml version="1.0" encoding="utf-8"?>
 <!DOCTYPE ncx PUBLIC "-//NISO//DTD ncx 2005-1//EN" "http://www.daisy.org/z3986/2005/ncx-2005-1.dtd">
 <ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1" xml:lang="en">
   <head>
@@ -190,25 +593,29 @@ class Epub:
   </head>
   <docTitle><text>%s</text></docTitle>
   <navMap>
-%s
+""" % (self.ncx_uid, depth, self.ncx_title)
+    order = 1
+    indent = "    "
+    for nav in self.walk_navigation(only_text=False):
+      if nav is None:
+        indent = indent[:-2]
+        yield indent + "</navPoint>\n"
+        continue
+      yield indent + '<navPoint id="navPoint_%d" playOrder="%d">\n' % (order, order)
+      yield indent + '  <navLabel><text>%s</text></navLabel>\n' % nav["title"]
+      yield indent + '  <content src="%s"/>\n' % nav["file"]
+      order += 1
+      indent += "  "
+      for part in self.parts.get(nav['file'], []):
+        if not part['title']: continue
+        yield indent + '<navPoint id="navPoint_%d" playOrder="%d">\n' % (order, order)
+        yield indent + '  <navLabel><text>%s</text></navLabel>\n' % part["title"]
+        yield indent + '  <content src="%s"/>\n' % part["file"]
+        yield indent + "</navPoint>\n"
+        order += 1
+    yield u"""
   </navMap>
-</ncx>""" % (self.ncx_uid, depth, self.ncx_title, map);
-    return toc
-
-  def navigate_toc(self, nav, indent = "", res = "", depth = 0, order = 1):
-    depth += 1
-    final_depth = depth
-    indent2 = indent + "  "
-    res += indent + '<navPoint id="navPoint_%d" playOrder="%d">\n' % (order, order)
-    res += indent + '  <navLabel><text>%s</text></navLabel>\n' % nav["title"]
-    res += indent + '  <content src="%s"/>\n' % nav["file"]
-    order += 1
-    for n in nav["sub"]:
-      res, d, order = self.navigate_toc(n, indent2, res, depth, order)
-      if d > final_depth:
-        final_depth = d
-    res += indent + "</navPoint>\n"
-    return res, final_depth, order
+</ncx>"""
 
 
 #######################################################################
@@ -247,12 +654,30 @@ class Epub:
 if 'Epub' not in dir():
   from epub import Epub
 
-from urlparse import urljoin
+from urlparse import urljoin, urlsplit, urlunsplit
 import cookielib
 import os
 import sys
 import datetime
+import time
 import re
+import hashlib
+import json
+import tempfile
+import threading
+import collections
+import shlex
+import codecs
+import itertools
+import random
+import email.utils
+import Queue
+import bisect
+import mmap
+import math
+import struct
+import BaseHTTPServer
+import SocketServer
 
 try:
   import BeautifulSoup
@@ -260,13 +685,27 @@ try:
 except:
   soup_ok=False
 
+try:
+  import lxml.html
+  import lxml.etree
+  lxml_ok=True
+except:
+  lxml_ok=False
+
 
 import urllib2
+import urllib
+import HTMLParser
+import httplib
+import socket
+import zlib
+from StringIO import StringIO
 
 COOKIEFILE = 'cookies.lwp'
 # the path and filename to save your cookies in
 
 cj = None
+cookie_lock = threading.Lock()
 ClientCookie = None
 cookielib = None
 
@@ -315,21 +754,1834 @@ def make_filename(str):
 def has_class(cls):
   return lambda s: s and cls in s.split(" ")
 
+
+def url_key(url):
+  if type(url) == unicode:
+    url = url.encode('utf-8')
+  return hashlib.sha1(url).hexdigest()
+
+
+def normal_netloc(scheme, netloc):
+  # The host of a URL in lowercase, without the default port of scheme
+  netloc = netloc.lower()
+  if scheme == 'http' and netloc.endswith(':80'):
+    netloc = netloc[:-3]
+  elif scheme == 'https' and netloc.endswith(':443'):
+    netloc = netloc[:-4]
+  return netloc
+
+
+class DiskCache:
+  # Persistent HTTP cache shared between runs. The bodies are stored by
+  # content hash in `directory'/data and each URL has an index entry in
+  # `directory'/url, a JSON dictionnary with keys:
+  #   'url'          : The URL
+  #   'digest'       : The SHA-1 of the body
+  #   'Content-Type' : The Content-Type
+  #   'ETag'         : The ETag header or None
+  #   'Last-Modified': The Last-Modified header or None
+  #   'time'         : When the entry was last fetched or revalidated
+  # Entries younger than `max_age' seconds are served without touching the
+  # network, older ones are revalidated with a conditional request.
+
+  def __init__(self, directory, max_age=3600):
+    self.directory = directory
+    self.max_age   = max_age
+
+  def path(self, kind, key):
+    return os.path.join(self.directory, kind, key[:2], key)
+
+  def write_file(self, filename, data):
+    dirname = os.path.dirname(filename)
+    if not os.path.isdir(dirname):
+      try:
+        os.makedirs(dirname)
+      except OSError:
+        if not os.path.isdir(dirname): raise
+    fd, tmp = tempfile.mkstemp(dir=dirname)
+    f = os.fdopen(fd, 'wb')
+    f.write(data)
+    f.close()
+    os.rename(tmp, filename)
+
+  def get(self, url):
+    try:
+      f = open(self.path('url', url_key(url)), 'rb')
+      entry = json.load(f)
+      f.close()
+      f = open(self.path('data', entry['digest']), 'rb')
+      entry['data'] = f.read()
+      f.close()
+    except (IOError, ValueError, KeyError):
+      return None
+    return entry
+
+  def is_fresh(self, entry):
+    return time.time() - entry['time'] < self.max_age
+
+  def put(self, url, dta):
+    digest = hashlib.sha1(dta['data']).hexdigest()
+    if not os.path.exists(self.path('data', digest)):
+      self.write_file(self.path('data', digest), dta['data'])
+    entry = {
+      'url'          : url,
+      'digest'       : digest,
+      'Content-Type' : dta['Content-Type'],
+      'ETag'         : dta.get('ETag'),
+      'Last-Modified': dta.get('Last-Modified'),
+      'time'         : time.time()}
+    self.write_file(self.path('url', url_key(url)), json.dumps(entry))
+
+  def conditional_headers(self, entry):
+    headers = {}
+    if entry.get('ETag'):
+      headers['If-None-Match'] = entry['ETag']
+    if entry.get('Last-Modified'):
+      headers['If-Modified-Since'] = entry['Last-Modified']
+    return headers
+
+
+class FetchCache:
+  # In-memory cache of the downloads, indexed by URL, the values are the
+  # dictionnaries returned by fetch_url. Once the data of the entries takes
+  # more than `max_bytes' (None for no limit) the least recently used ones
+  # are dropped, and entries older than `max_age' seconds (None to keep
+  # them) are downloaded again. Each TopShelf has its own unless one is
+  # given to share, as the e-books of a batch do.
+
+  counters = ["hits", "misses", "evictions", "expired"]
+
+  def __init__(self, max_bytes=None, max_age=None):
+    self.max_bytes = max_bytes
+    self.max_age   = max_age
+    self.entries   = collections.OrderedDict()
+    # url -> (time, size, dta), the least recently used first
+    self.size      = 0
+    self.counts    = dict.fromkeys(self.counters, 0)
+    self.lock      = threading.Lock()
+
+  def __len__(self):
+    return len(self.entries)
+
+  def __contains__(self, url):
+    with self.lock:
+      entry = self.entries.get(url)
+      return entry is not None and not self.is_expired(entry)
+
+  def is_expired(self, entry):
+    return self.max_age is not None and time.time() - entry[0] > self.max_age
+
+  def get(self, url):
+    with self.lock:
+      entry = self.entries.pop(url, None)
+      if entry is not None and self.is_expired(entry):
+        self.size -= entry[1]
+        self.counts['expired'] += 1
+        entry = None
+      if entry is None:
+        self.counts['misses'] += 1
+        return None
+      self.entries[url] = entry
+      self.counts['hits'] += 1
+      return entry[2]
+
+  def put(self, url, dta):
+    # Returns the number of entries evicted to make room
+    size = len(dta['data'])
+    with self.lock:
+      old = self.entries.pop(url, None)
+      if old is not None:
+        self.size -= old[1]
+      if self.max_bytes is not None and size > self.max_bytes:
+        return 0
+      self.entries[url] = (time.time(), size, dta)
+      self.size += size
+      evicted = 0
+      while self.max_bytes is not None and self.size > self.max_bytes:
+        old_url, old = self.entries.popitem(last=False)
+        self.size -= old[1]
+        evicted += 1
+      self.counts['evictions'] += evicted
+      return evicted
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.size = 0
+
+
+class SortedFingerprints:
+  # The fingerprints of a VisitedSet concatenated in order in a string or
+  # an mmap, seen as a sequence of 8 byte strings for bisect. `fence' holds
+  # one fingerprint in `stride' in memory, a lookup only reads the piece of
+  # the data between two of them.
+
+  stride = 64
+
+  def __init__(self, data=""):
+    self.data  = data
+    step = self.stride * 8
+    self.fence = [data[i:i + 8] for i in xrange(0, len(data), step)]
+
+  def __len__(self):
+    return len(self.data) // 8
+
+  def __getitem__(self, i):
+    return self.data[i * 8:i * 8 + 8]
+
+  def find(self, fp):
+    j = bisect.bisect_right(self.fence, fp) - 1
+    if j < 0:
+      return False
+    step = self.stride * 8
+    piece = self.data[j * step:(j + 1) * step]
+    pos = piece.find(fp)
+    while pos > 0 and pos % 8:
+      pos = piece.find(fp, pos + 1)
+    return pos >= 0
+
+  def position(self, fp, lo=0):
+    # Where fp goes in the data, not before lo
+    j = max(bisect.bisect_right(self.fence, fp) - 1, 0)
+    lo = max(lo, j * self.stride)
+    return bisect.bisect_left(self, fp, lo, max(lo, min(len(self), (j + 1) * self.stride)))
+
+  def merged(self, fps):
+    # The pieces of the data with the sorted fingerprints `fps' inserted
+    pos = 0
+    for fp in fps:
+      i = self.position(fp, pos)
+      yield self.data[pos * 8:i * 8]
+      yield fp
+      pos = i
+    yield self.data[pos * 8:]
+
+
+class VisitedSet:
+  # The URLs seen by a crawl, as 64 bit fingerprints (the first 8 bytes of
+  # their SHA-1): 8 bytes for each URL instead of the 100 or so of the URL
+  # itself. The fingerprints are kept sorted, the recent ones in a set
+  # merged with the others once it holds a sixteenth of them. A new URL is
+  # taken for one of n URLs seen with a probability of n/2**64.
+  #
+  # With `spill', the sorted fingerprints go to a temporary file and only a
+  # Bloom filter of `bloom_bits' bits per fingerprint and the recent ones
+  # stay in memory, merged into the file once they are a sixty-fourth of
+  # the set. The filter grows with the set. The URLs it may have seen are
+  # looked up in the file: a false positive of the filter costs a read,
+  # never a page.
+  #
+  # save and load keep the set in a file between runs.
+
+  magic      = "TSVISIT1"
+  merge_size = 4096
+  # recent fingerprints to merge at least at once
+  bloom_size = 65536
+  # fingerprints the filter is made for at first, it doubles when full
+
+  def __init__(self, spill=False, bloom_bits=10):
+    self.count   = 0
+    self.sorted  = SortedFingerprints()
+    self.recent  = set()
+    self.lock    = threading.Lock()
+    self.bloom_bits = bloom_bits
+    self.bloom   = None
+    self.spill   = None
+    self.spill_file = None
+    self.merge_shift = spill and 6 or 4
+    self.checked = 0
+    # lookups of URLs not in the set the filter had to check
+    self.false_positives = 0
+    # and of those, the ones the filter didn't tell apart
+    if spill:
+      fd, self.spill = tempfile.mkstemp(prefix="topshelf-visited-")
+      os.close(fd)
+      self.make_bloom(self.bloom_size)
+
+  def fingerprint(self, url):
+    if isinstance(url, unicode):
+      url = url.encode('utf-8')
+    return hashlib.sha1(url).digest()[:8]
+
+  def __len__(self):
+    return self.count
+
+  def __contains__(self, url):
+    fp = self.fingerprint(url)
+    with self.lock:
+      return self.has(fp)
+
+  def add(self, url):
+    # Returns whether url is new
+    return self.add_fingerprint(self.fingerprint(url))
+
+  def add_fingerprint(self, fp):
+    with self.lock:
+      if self.has(fp):
+        return False
+      self.recent.add(fp)
+      self.count += 1
+      if self.bloom is not None:
+        if self.count > self.capacity:
+          self.make_bloom(self.capacity * 2)
+        else:
+          self.set_bits(fp)
+      if len(self.recent) >= max(self.merge_size,
+                                 len(self.sorted) >> self.merge_shift):
+        self.merge()
+      return True
+
+  def update(self, other):
+    # Adds the URLs of the VisitedSet other
+    with other.lock:
+      other.merge()
+      fps = [other.sorted[i] for i in xrange(len(other.sorted))]
+    for fp in fps:
+      self.add_fingerprint(fp)
+
+  def has(self, fp):
+    if self.bloom is not None:
+      if not self.test_bits(fp):
+        self.checked += 1
+        return False
+      if fp in self.recent or self.sorted.find(fp):
+        return True
+      self.checked += 1
+      self.false_positives += 1
+      return False
+    return fp in self.recent or self.sorted.find(fp)
+
+  def bit_positions(self, fp):
+    h1, h2 = struct.unpack(">II", fp)
+    h2 |= 1
+    m = len(self.bloom) * 8
+    return [(h1 + i * h2) % m for i in range(self.hashes)]
+
+  def set_bits(self, fp):
+    bloom = self.bloom
+    for b in self.bit_positions(fp):
+      bloom[b >> 3] |= 1 << (b & 7)
+
+  def test_bits(self, fp):
+    bloom = self.bloom
+    for b in self.bit_positions(fp):
+      if not bloom[b >> 3] & (1 << (b & 7)):
+        return False
+    return True
+
+  def make_bloom(self, capacity):
+    self.capacity = capacity
+    self.hashes   = max(1, int(round(self.bloom_bits * math.log(2))))
+    self.bloom    = bytearray((capacity * self.bloom_bits + 7) // 8)
+    for i in xrange(len(self.sorted)):
+      self.set_bits(self.sorted[i])
+    for fp in self.recent:
+      self.set_bits(fp)
+
+  def merge(self):
+    if not self.recent:
+      return
+    pieces = self.sorted.merged(sorted(self.recent))
+    if self.spill is None:
+      self.sorted = SortedFingerprints("".join(pieces))
+    else:
+      self.write_spill(pieces)
+    self.recent.clear()
+
+  def write_spill(self, pieces):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.spill))
+    f = os.fdopen(fd, 'wb')
+    for piece in pieces:
+      f.write(piece)
+    f.close()
+    self.close_spill()
+    os.rename(tmp, self.spill)
+    self.spill_file = open(self.spill, 'rb')
+    if os.path.getsize(self.spill):
+      self.sorted = SortedFingerprints(
+        mmap.mmap(self.spill_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+  def close_spill(self):
+    if isinstance(self.sorted.data, mmap.mmap):
+      self.sorted.data.close()
+    self.sorted = SortedFingerprints()
+    if self.spill_file:
+      self.spill_file.close()
+      self.spill_file = None
+
+  def close(self):
+    # Removes the spill file
+    if self.spill is not None:
+      self.close_spill()
+      os.remove(self.spill)
+      self.spill = None
+
+  def save(self, filename):
+    with self.lock:
+      self.merge()
+      dirname = os.path.dirname(os.path.abspath(filename))
+      fd, tmp = tempfile.mkstemp(dir=dirname)
+      f = os.fdopen(fd, 'wb')
+      f.write(self.magic)
+      if self.spill_file:
+        self.spill_file.seek(0)
+        shutil.copyfileobj(self.spill_file, f)
+      else:
+        f.write(self.sorted.data)
+      f.close()
+      os.rename(tmp, filename)
+
+  def load(self, filename):
+    # Replaces the set by the one saved in filename, raises ValueError if
+    # it isn't a saved VisitedSet
+    f = open(filename, 'rb')
+    try:
+      size = os.fstat(f.fileno()).st_size - len(self.magic)
+      if f.read(len(self.magic)) != self.magic or size % 8:
+        raise ValueError("not a visited set: %s" % filename)
+      with self.lock:
+        self.recent.clear()
+        if self.spill is None:
+          self.sorted = SortedFingerprints(f.read())
+        else:
+          self.write_spill(iter(lambda: f.read(1 << 20), ""))
+        self.count = len(self.sorted)
+        if self.bloom is not None:
+          capacity = self.bloom_size
+          while capacity < self.count:
+            capacity *= 2
+          self.make_bloom(capacity)
+    finally:
+      f.close()
+
+  def memory(self):
+    # Estimate of the bytes taken in memory
+    size = sys.getsizeof(self.recent) + len(self.recent) * sys.getsizeof("12345678")
+    if self.bloom is not None:
+      return size + len(self.bloom)
+    return size + len(self.sorted.data)
+
+  def report(self):
+    with self.lock:
+      res = {
+        'urls'               : self.count,
+        'memory'             : self.memory(),
+        'disk'               : self.spill and len(self.sorted.data) or 0,
+        'false_positive_rate': self.count / 2.0 ** 64}
+      if self.bloom is not None:
+        res['bloom_false_positives'] = self.false_positives
+        res['bloom_false_positive_rate'] = \
+          self.checked and float(self.false_positives) / self.checked or 0.0
+      return res
+
+
+class HTTPPool:
+  # HTTP client keeping the connections open between requests, with up to
+  # `size' idle connections per host. It asks for compressed responses and
+  # decompresses them, follows redirections and handles the cookies in
+  # `cookiejar' like the HTTPCookieProcessor installed by main. Anything
+  # but plain http and https (proxies, other schemes) goes through urllib2.
+
+  redirect_codes = (301, 302, 303, 307)
+  max_redirects  = 10
+
+  def __init__(self, size=4, cookiejar=None):
+    self.size      = size
+    self.cookiejar = cookiejar
+    self.idle      = {}
+    self.lock      = threading.Lock()
+    self.proxies   = urllib.getproxies()
+
+  def connect(self, scheme, host):
+    if scheme == 'https':
+      return httplib.HTTPSConnection(host)
+    return httplib.HTTPConnection(host)
+
+  def get_connection(self, scheme, host):
+    with self.lock:
+      idle = self.idle.get((scheme, host))
+      if idle:
+        return idle.pop()
+    return None
+
+  def release(self, scheme, host, conn):
+    with self.lock:
+      idle = self.idle.setdefault((scheme, host), [])
+      if len(idle) < self.size:
+        idle.append(conn)
+        return
+    conn.close()
+
+  def request(self, scheme, host, selector, headers):
+    conn = self.get_connection(scheme, host)
+    while True:
+      reused = conn is not None
+      if not reused:
+        conn = self.connect(scheme, host)
+      try:
+        conn.request('GET', selector, headers=headers)
+        response = conn.getresponse()
+        body = response.read()
+        break
+      except (httplib.HTTPException, socket.error), e:
+        conn.close()
+        conn = None
+        if not reused:
+          raise urllib2.URLError(e)
+        # The server closed the idle connection, try a new one
+    if response.will_close:
+      conn.close()
+    else:
+      self.release(scheme, host, conn)
+    encoding = (response.getheader('Content-Encoding') or '').lower()
+    if encoding == 'gzip':
+      body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+      try:
+        body = zlib.decompress(body)
+      except zlib.error:
+        body = zlib.decompress(body, -zlib.MAX_WBITS)
+    return response, body
+
+  def open(self, req):
+    for i in range(self.max_redirects + 1):
+      scheme = req.get_type()
+      host   = req.get_host()
+      if scheme not in ('http', 'https') or scheme in self.proxies:
+        return urllib2.urlopen(req)
+      if self.cookiejar is not None:
+        self.cookiejar.add_cookie_header(req)
+      headers = dict(req.header_items())
+      headers.setdefault('User-agent', 'Python-urllib/%s' % urllib2.__version__)
+      headers['Accept-encoding'] = 'gzip, deflate'
+      response, body = self.request(scheme, host, req.get_selector(), headers)
+      result = urllib.addinfourl(StringIO(body), response.msg,
+                                 req.get_full_url(), response.status)
+      if self.cookiejar is not None:
+        self.cookiejar.extract_cookies(result, req)
+      location = response.getheader('Location')
+      if response.status in self.redirect_codes and location:
+        url = urljoin(req.get_full_url(), location)
+        req = Request(url, headers=req.headers, unverifiable=True,
+                      origin_req_host=req.get_origin_req_host())
+        continue
+      if response.status < 200 or response.status >= 300:
+        raise urllib2.HTTPError(req.get_full_url(), response.status,
+                                response.reason, response.msg, StringIO(body))
+      return result
+    raise urllib2.HTTPError(req.get_full_url(), response.status,
+                            "Too many redirections", response.msg, StringIO(body))
+
+
+def classify_error(e):
+  # How a download failed: 'throttled' when the server asks to slow down
+  # (429, or 503 with a Retry-After), 'transient' for network errors and
+  # server errors worth retrying, 'permanent' for anything else (404, bad
+  # URLs, ...)
+  if isinstance(e, urllib2.HTTPError):
+    if e.code == 429 or (e.code == 503 and retry_after(e) is not None):
+      return 'throttled'
+    if e.code in (408, 500, 502, 503, 504):
+      return 'transient'
+    return 'permanent'
+  if isinstance(e, urllib2.URLError):
+    e = e.reason
+  if isinstance(e, (socket.error, httplib.HTTPException)):
+    return 'transient'
+  return 'permanent'
+
+def retry_after(e):
+  # Seconds to wait according to the Retry-After header of the HTTPError
+  # `e', None if it has none
+  value = e.info() and e.info().getheader('Retry-After')
+  if not value:
+    return None
+  value = value.strip()
+  if value.isdigit():
+    return float(value)
+  date = email.utils.parsedate_tz(value)
+  if date is None:
+    return None
+  return max(0.0, email.utils.mktime_tz(date) - time.time())
+
+
+class RateLimiter:
+  # Token bucket per host, shared by the downloads of every e-book. Each
+  # host starts at `rate' requests per second with bursts of up to `burst'
+  # requests, and the rate grows up to `max_rate' while the responses are
+  # healthy: by one request per second with each response (doubling every
+  # second) until the host first throttles us, then by `increase' requests
+  # per second every second. When the server throttles us (see
+  # classify_error) the rate is halved, down to `min_rate' and at most once per `interval'
+  # seconds since the requests already sent get the same answer. A
+  # Retry-After pauses the host altogether.
+
+  def __init__(self, rate=32.0, max_rate=256.0, min_rate=1.0, increase=1.0,
+               burst=16, interval=1.0):
+    self.rate     = float(rate)
+    self.max_rate = max(float(max_rate), self.rate)
+    self.min_rate = min(float(min_rate), self.rate)
+    self.increase = increase
+    self.burst    = burst
+    self.interval = interval
+    self.hosts    = {}
+    # host -> [rate, tokens, updated, paused until, last decrease,
+    #          throttled yet]
+    self.lock     = threading.Lock()
+
+  def bucket(self, host, now):
+    b = self.hosts.get(host)
+    if b is None:
+      b = self.hosts[host] = [self.rate, float(self.burst), now, 0.0, 0.0, False]
+    else:
+      b[1] = min(float(self.burst), b[1] + (now - b[2]) * b[0])
+      b[2] = now
+    return b
+
+  def acquire(self, host):
+    # Takes a token, waiting until there is one. Returns the time waited.
+    with self.lock:
+      now = time.time()
+      b = self.bucket(host, now)
+      b[1] -= 1
+      wait = max(b[3] - now, b[1] < 0 and -b[1] / b[0] or 0.0)
+    if wait > 0:
+      time.sleep(wait)
+    return wait
+
+  def success(self, host):
+    with self.lock:
+      b = self.bucket(host, time.time())
+      if b[5]:
+        b[0] = min(self.max_rate, b[0] + self.increase / b[0])
+      else:
+        b[0] = min(self.max_rate, b[0] + 1)
+
+  def throttled(self, host, delay=None):
+    with self.lock:
+      now = time.time()
+      b = self.bucket(host, now)
+      if now - b[4] >= self.interval:
+        b[0] = max(self.min_rate, b[0] / 2)
+        b[1] = min(b[1], 0.0)
+        b[4] = now
+        b[5] = True
+      if delay:
+        b[3] = max(b[3], now + delay)
+
+
+class UrlCanonicalizer:
+  # The canonical form of the URLs, the forms of a URL leading to the same
+  # page are downloaded and stored once. The scheme and the host are
+  # lowercased, the default port and the fragment dropped, the query
+  # parameters whose name matches one of the `drop' regular expressions
+  # removed, then the `rules' apply:
+  #   'scheme': https is the same as http
+  #   'slash' : trailing slashes of the path don't count
+  #   'query' : the order of the query parameters doesn't count, but for
+  #             the values of a parameter given several times
+  # Only http and https URLs are changed.
+
+  all_rules    = ['scheme', 'slash', 'query']
+  default_drop = ['utm_[a-z]+']
+
+  def __init__(self, rules=None, drop=None):
+    if rules is None:
+      rules = self.all_rules
+    if drop is None:
+      drop = self.default_drop
+    self.rules = frozenset(rules)
+    self.drop  = drop and re.compile("(?:%s)$" % "|".join(drop)) or None
+
+  def canonical(self, url):
+    scheme, netloc, path, query, fragment = urlsplit(url)
+    scheme = scheme.lower()
+    if scheme not in ('http', 'https'):
+      return url
+    netloc = normal_netloc(scheme, netloc)
+    if 'scheme' in self.rules:
+      scheme = 'http'
+    if 'slash' in self.rules:
+      path = path.rstrip('/')
+    if query and (self.drop or 'query' in self.rules):
+      params = query.split('&')
+      if self.drop:
+        params = [p for p in params if not self.drop.match(p.partition('=')[0])]
+      if 'query' in self.rules:
+        # The values of a repeated parameter keep their order
+        params.sort(key=lambda p: p.partition('=')[0])
+      query = '&'.join(params)
+    return urlunsplit((scheme, netloc, path, query, ''))
+
+
+class MirrorSet:
+  # Groups of hosts serving the same site. The URLs of a group are known by
+  # their canonical form, on the first host of the group, so that the
+  # caches hold one copy whatever the mirror. The requests go to the host
+  # of the URL, the other mirrors being tried in turn when it fails: the
+  # cookies of a login only go to the host they come from. With `rotate'
+  # they go to the mirror with the lowest latency among the healthy ones
+  # instead, by default when the groups are given (--mirrors). Moving
+  # averages of the latency and of the error rate are kept for each host,
+  # `alpha' being the weight of the last sample, and hosts failing more
+  # than `max_errors' of the time are only tried when the others fail. The
+  # errors are forgotten by half every `half_life' seconds so that a
+  # mirror that was down is tried again. Hosts match with their
+  # subdomains (www.bigcloset.us is a bigcloset.us mirror).
+
+  default_groups = [["bigcloset.us", "bigclosetr.us"]]
+
+  def __init__(self, groups=None, alpha=0.1, max_errors=0.5, half_life=60.0,
+               rotate=None):
+    if rotate is None:
+      rotate = groups is not None
+    self.rotate     = rotate
+    self.groups     = []
+    self.alpha      = alpha
+    self.max_errors = max_errors
+    self.half_life  = half_life
+    self.latency    = {}
+    self.errors     = {}
+    # host -> [error rate, time of the last sample]
+    self.lock       = threading.Lock()
+    if groups is None:
+      groups = self.default_groups
+    for hosts in groups:
+      self.add(hosts)
+
+  def add(self, hosts):
+    self.groups.append(list(hosts))
+
+  def find(self, url):
+    # Returns (scheme, subdomain, host, rest of the URL, group), or None if
+    # the URL is not on a mirror
+    parts = urlsplit(url)
+    netloc = normal_netloc(parts[0].lower(), parts[1])
+    for group in self.groups:
+      for host in group:
+        if netloc == host:
+          return parts, "", host, group
+        if netloc.endswith("." + host):
+          return parts, netloc[:-len(host)], host, group
+    return None
+
+  def on_host(self, parts, subdomain, host):
+    return urlunsplit((parts[0], subdomain + host) + tuple(parts[2:]))
+
+  def canonical(self, url):
+    found = self.find(url)
+    if found is None:
+      return url
+    parts, subdomain, host, group = found
+    if host == group[0]:
+      return url
+    return self.on_host(parts, subdomain, group[0])
+
+  def order(self, url):
+    # The URL on each mirror, the best first
+    found = self.find(url)
+    if found is None:
+      return [url]
+    parts, subdomain, host, group = found
+    now = time.time()
+    with self.lock:
+      def rank(h):
+        # Hosts without samples yet come first to get some
+        unhealthy = self.error_rate(subdomain + h, now) > self.max_errors
+        if not self.rotate:
+          return (unhealthy, h != host)
+        return (unhealthy, self.latency.get(subdomain + h, 0.0), h != host)
+      hosts = sorted(group, key=rank)
+    return [h == host and url or self.on_host(parts, subdomain, h)
+            for h in hosts]
+
+  def error_rate(self, host, now):
+    e = self.errors.get(host)
+    if e is None:
+      return 0.0
+    return e[0] * 0.5 ** ((now - e[1]) / self.half_life)
+
+  def record(self, host, seconds, failed):
+    # A request to `host' took `seconds', failed or not
+    now = time.time()
+    with self.lock:
+      if host in self.errors:
+        rate = self.error_rate(host, now)
+        rate += self.alpha * ((failed and 1.0 or 0.0) - rate)
+      else:
+        rate = failed and 1.0 or 0.0
+      self.errors[host] = [rate, now]
+      if not failed:
+        if host in self.latency:
+          self.latency[host] += self.alpha * (seconds - self.latency[host])
+        else:
+          self.latency[host] = seconds
+
+
+class Sanitizer:
+  # Serializes a soup the way prettify() does, without recursion, while
+  # filtering the content of <body>: tags not in `allowed_body' are
+  # replaced by their content (silently for `blacklist_body'), attributes
+  # not allowed for the tag are dropped (silently for the blacklisted ones)
+  # and `remove_body' tags are dropped with their content.
+
+  allowed_head   = frozenset(['title', 'link', 'meta'])
+  allowed_body   = frozenset(['p', 'a', 'img', 'font', 'u', 'b', 'strong', 'i', 'em', 's', 'center', 'big', 'small', 'br', 'hr', 'ul', 'ol', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote'])
+  blacklist_body = frozenset(['div', 'span', 'table', 'tr', 'th', 'td', 'form', 'input'])
+  allowed_attrs  = frozenset(['id', 'style', 'class'])
+  allowed_body_attrs = {
+    'a':    allowed_attrs | frozenset(['href', 'name', 'title']),
+    'img':  allowed_attrs | frozenset(['src', 'width', 'height', 'alt', 'align']),
+    'p':    allowed_attrs | frozenset(['align']),
+    'font': allowed_attrs | frozenset(['size', 'color', 'face'])}
+  blacklist_body_attrs = {
+    'img':  frozenset(['border']),
+    'a':    frozenset(['onclick', 'rel'])}
+  remove_body    = frozenset(['script'])
+
+  def __init__(self, encoding="utf-8"):
+    self.encoding = encoding
+
+  def children(self, tag, filtered, remove):
+    # The children of `tag' once filtered, the content of the extracted
+    # tags is walked with a stack instead of recursion
+    stack = [iter(tag.contents)]
+    while stack:
+      for e in stack[-1]:
+        if e.__class__ != BeautifulSoup.Tag:
+          yield e
+        elif e.name in remove:
+          continue
+        elif not filtered or e.name in self.allowed_body:
+          yield e
+        else:
+          if e.name not in self.blacklist_body:
+            print "extract <%s>" % e.name
+          stack.append(iter(e.contents))
+          break
+      else:
+        stack.pop()
+
+  def filter_attributes(self, name, attrs):
+    allowed   = self.allowed_body_attrs.get(name, self.allowed_attrs)
+    blacklist = self.blacklist_body_attrs.get(name, ())
+    res = []
+    index = {}
+    for attr, val in attrs:
+      if attr not in allowed:
+        if attr not in blacklist:
+          print "extract <%s %s=\"%s\">" % (name, attr, val)
+      elif attr in index:
+        res[index[attr]] = (attr, val)
+      else:
+        index[attr] = len(res)
+        res.append((attr, val))
+    return res
+
+  def attributes(self, tag, filtered):
+    attrs = tag.attrs
+    if filtered:
+      attrs = self.filter_attributes(tag.name, attrs)
+    substitute = not filtered and tag.containsSubstitutions
+    res = []
+    for key, val in attrs:
+      if isinstance(val, Reference):
+        if not val.resolved:
+          res.append(val.placeholder(self, tag, key, substitute))
+          continue
+        val = val.value
+      res.append(self.format_attribute(tag, key, val, substitute))
+    return res
+
+  def format_attribute(self, tag, key, val, substitute):
+    fmt = '%s="%s"'
+    if isinstance(val, basestring):
+      if substitute and '%SOUP-ENCODING%' in val:
+        val = tag.substituteEncoding(val, self.encoding)
+      if '"' in val:
+        fmt = "%s='%s'"
+        if "'" in val:
+          val = val.replace("'", "&squot;")
+      val = tag.BARE_AMPERSAND_OR_BRACKET.sub(tag._sub_entity, val)
+    return fmt % (tag.toEncoding(key, self.encoding),
+                  tag.toEncoding(val, self.encoding))
+
+  def detached(self, tag):
+    # An empty tag of the same class, enough for format_attribute
+    return tag.__class__.__new__(tag.__class__)
+
+  def render(self, soup, remove=()):
+    out = []
+    # Each frame holds the children iterator, the next child, the indent
+    # level of the children, if they are filtered and how to close the
+    # parent tag: (indent, closing tag, has next sibling, start in out)
+    children = self.children(soup, False, remove)
+    stack = [[children, next(children, None), 1, False, None]]
+    while stack:
+      frame = stack[-1]
+      e = frame[1]
+      if e is None:
+        stack.pop()
+        if frame[4]:
+          space, close, has_next, start = frame[4]
+          if len(out) > start and out[-1][-1] != "\n":
+            out.append("\n")
+          if close:
+            out.append(space + close)
+            if has_next:
+              out.append("\n")
+        continue
+      frame[1] = next(frame[0], None)
+      level = frame[2]
+      space = " " * (level - 1)
+      if e.__class__ != BeautifulSoup.Tag:
+        text = e.__str__(self.encoding).strip()
+        if text:
+          out.append(space + text + "\n")
+        continue
+      filtered = frame[3] or e.name == 'body'
+      name  = e.toEncoding(e.name, self.encoding)
+      attrs = self.attributes(e, filtered)
+      if attrs:
+        attrs = ' ' + ' '.join(attrs)
+      else:
+        attrs = ''
+      if e.isSelfClosing:
+        out.append('%s<%s%s />\n' % (space, name, attrs))
+        close = ''
+      else:
+        out.append('%s<%s%s>\n' % (space, name, attrs))
+        close = '</%s>' % name
+      children = self.children(e, filtered, remove)
+      stack.append([children, next(children, None), level + 1, filtered,
+                    (space, close, frame[1] is not None, len(out))])
+    return ''.join(out)
+
+
+class Reference:
+  # Attribute value that is only known once the links of the page are
+  # followed. With the crawl queue the page is rendered before that, with
+  # a placeholder in place of the attribute, see TopShelf.resolve().
+
+  def __init__(self, value, token):
+    self.value    = value
+    self.token    = token
+    self.resolved = False
+
+  def set(self, value):
+    self.value = value
+
+  def placeholder(self, sanitizer, tag, key, substitute):
+    # Keep what is needed to format the attribute but not the tag itself,
+    # it would keep the whole tree alive
+    self.sanitizer  = sanitizer
+    self.tag        = sanitizer.detached(tag)
+    self.key        = key
+    self.substitute = substitute
+    return self.token
+
+  def format(self):
+    return self.sanitizer.format_attribute(self.tag, self.key, self.value,
+                                           self.substitute)
+
+
+class SoupParser:
+  # Parser backend on BeautifulSoup 3. The layouts only use the methods of
+  # a parser backend to read and change the pages, see LxmlParser for the
+  # other one. Strings given as contents to tag() are text, in which
+  # entities may appear (as returned by inner_html).
+
+  name = "soup"
+
+  def __init__(self, soup_class=None):
+    self.soup_class = soup_class or BeautifulSoup.BeautifulSoup
+
+  def parse(self, data):
+    return self.soup_class(data)
+
+  def find(self, node, name, attrs={}):
+    return node.find(name, attrs=attrs)
+
+  def find_all(self, node, name=None, attrs={}):
+    return node.findAll(name, attrs=attrs)
+
+  def name_of(self, node):
+    return node.name
+
+  def parent(self, node):
+    return node.parent
+
+  def previous_sibling(self, node, name=None):
+    if name is None:
+      return node.previousSibling
+    return node.findPreviousSibling(name)
+
+  def get(self, node, key):
+    return node[key]
+
+  def set(self, node, key, value):
+    node[key] = value
+
+  def inner_html(self, node):
+    return node.renderContents()
+
+  def extract(self, node):
+    node.extract()
+
+  def remove_before(self, node):
+    after = node.previousSibling
+    while after is not None:
+      ns = node.previousSibling
+      after.extract()
+      after = ns
+
+  def remove_after(self, node):
+    after = node.nextSibling
+    while after is not None:
+      ns = node.nextSibling
+      after.extract()
+      after = ns
+
+  def tag(self, doc, name, contents=(), attrs=()):
+    tag = BeautifulSoup.Tag(doc, name)
+    for i in range(len(contents)):
+      e = contents[i]
+      if isinstance(e, basestring):
+        e = BeautifulSoup.NavigableString(e)
+      tag.insert(i, e)
+    for key, value in attrs:
+      tag[key] = value
+    return tag
+
+  def insert(self, parent, index, node):
+    parent.insert(index, node)
+
+  def append(self, parent, node):
+    parent.append(node)
+
+  def render(self, doc, remove=()):
+    return Sanitizer().render(doc, remove)
+
+
+class LxmlSanitizer(Sanitizer):
+  # The Sanitizer for lxml trees, the text is in the text and tail of the
+  # elements. The output is laid out the same way, the text is escaped
+  # since lxml decodes the entities.
+
+  void = frozenset(['br', 'hr', 'input', 'img', 'meta', 'spacer', 'link',
+                    'frame', 'base', 'col'])
+  # the tags BeautifulSoup closes itself
+  whitespace = ' \t\n\r\f\v'
+  charset = re.compile(r"((^|;)\s*charset=)([^;]*)", re.M)
+
+  def __init__(self, refs, encoding="utf-8"):
+    Sanitizer.__init__(self, encoding)
+    self.refs = refs
+
+  def contents(self, tag):
+    if tag.text:
+      yield tag.text
+    for e in tag:
+      yield e
+      if e.tail:
+        yield e.tail
+
+  def children(self, tag, filtered, remove, contents=None):
+    stack = [contents or self.contents(tag)]
+    while stack:
+      for e in stack[-1]:
+        if isinstance(e, basestring) or not isinstance(e.tag, basestring):
+          yield e
+        elif e.tag in remove:
+          continue
+        elif not filtered or e.tag in self.allowed_body:
+          yield e
+        else:
+          if e.tag not in self.blacklist_body:
+            print "extract <%s>" % e.tag
+          stack.append(self.contents(e))
+          break
+      else:
+        stack.pop()
+
+  def escape(self, text):
+    text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    if isinstance(text, unicode):
+      text = text.encode(self.encoding)
+    return text
+
+  def attributes(self, tag, filtered):
+    attrs = tag.attrib.items()
+    if filtered:
+      attrs = self.filter_attributes(tag.tag, attrs)
+    # The page is written in self.encoding, whatever it was in
+    substitute = not filtered and tag.tag == 'meta' and \
+                 tag.get('http-equiv') is not None
+    res = []
+    for key, val in attrs:
+      val = self.refs.pop(val, val)
+      if isinstance(val, Reference):
+        if not val.resolved:
+          res.append(val.placeholder(self, tag, key, substitute))
+          continue
+        val = val.value
+      res.append(self.format_attribute(tag, key, val, substitute))
+    return res
+
+  def format_attribute(self, tag, key, val, substitute):
+    if substitute and key == 'content':
+      val = self.charset.sub(lambda m: m.group(1) + self.encoding, val)
+    return '%s="%s"' % (self.escape(key),
+                        self.escape(val).replace('"', '&quot;'))
+
+  def detached(self, tag):
+    return None
+
+  def render(self, root, remove=()):
+    out = []
+    doctype = root.getroottree().docinfo.doctype
+    if doctype:
+      out.append(doctype.encode(self.encoding) + "\n")
+    top = list(root.itersiblings(preceding=True))
+    top.reverse()
+    top.append(root)
+    top.extend(root.itersiblings())
+    children = self.children(root, False, remove, iter(top))
+    stack = [[children, next(children, None), 1, False, None]]
+    while stack:
+      frame = stack[-1]
+      e = frame[1]
+      if e is None:
+        stack.pop()
+        if frame[4]:
+          space, close, has_next, start = frame[4]
+          if len(out) > start and out[-1][-1] != "\n":
+            out.append("\n")
+          if close:
+            out.append(space + close)
+            if has_next:
+              out.append("\n")
+        continue
+      frame[1] = next(frame[0], None)
+      level = frame[2]
+      space = " " * (level - 1)
+      if isinstance(e, basestring):
+        text = self.escape(e).strip(self.whitespace)
+        if text:
+          out.append(space + text + "\n")
+        continue
+      if not isinstance(e.tag, basestring):
+        if e.tag is lxml.etree.Comment:
+          out.append(space + "<!--%s-->\n" % (e.text or '').encode(self.encoding))
+        continue
+      filtered = frame[3] or e.tag == 'body'
+      name  = e.tag.encode(self.encoding)
+      attrs = self.attributes(e, filtered)
+      if attrs:
+        attrs = ' ' + ' '.join(attrs)
+      else:
+        attrs = ''
+      if e.tag in self.void:
+        out.append('%s<%s%s />\n' % (space, name, attrs))
+        close = ''
+      else:
+        out.append('%s<%s%s>\n' % (space, name, attrs))
+        close = '</%s>' % name
+      children = self.children(e, filtered, remove)
+      stack.append([children, next(children, None), level + 1, filtered,
+                    (space, close, frame[1] is not None, len(out))])
+    return ''.join(out)
+
+
+class LxmlParser:
+  # Parser backend on lxml.html, the same interface as SoupParser. Parsing
+  # and searching the tree are done in C, many times faster. The text is
+  # decoded: entities come out as characters, escaped again on output.
+  # Attribute values must be strings, a Reference is stored as its token
+  # until the page is rendered.
+
+  unescape = HTMLParser.HTMLParser().unescape
+
+  name = "lxml"
+
+  def __init__(self):
+    # Without a doctype in the page, libxml2 would add one
+    self.utf8  = lxml.html.HTMLParser(encoding='utf-8', default_doctype=False)
+    self.other = lxml.html.HTMLParser(default_doctype=False)
+    self.refs  = {}
+
+  def parse(self, data):
+    parser = self.utf8
+    try:
+      data.decode('utf-8')
+    except UnicodeDecodeError:
+      # Let libxml2 look for the charset of the page
+      parser = self.other
+    try:
+      return lxml.html.document_fromstring(data, parser=parser)
+    except lxml.etree.ParserError:
+      # Nothing but whitespace
+      return lxml.html.document_fromstring("<html></html>", parser=parser)
+
+  def matches(self, node, attrs):
+    for key in attrs:
+      val = node.get(key)
+      test = attrs[key]
+      if test is True:
+        if val is None: return False
+      elif callable(test):
+        if not test(val): return False
+      elif val != test:
+        return False
+    return True
+
+  def find_all(self, node, name=None, attrs={}):
+    if name is None:
+      elements = node.iterdescendants(lxml.etree.Element)
+    else:
+      elements = node.iterdescendants(name)
+    return [e for e in elements if self.matches(e, attrs)]
+
+  def find(self, node, name, attrs={}):
+    for e in node.iterdescendants(name):
+      if self.matches(e, attrs):
+        return e
+    return None
+
+  def name_of(self, node):
+    return node.tag
+
+  def parent(self, node):
+    return node.getparent()
+
+  def previous_sibling(self, node, name=None):
+    if name is None:
+      return node.getprevious()
+    for e in node.itersiblings(name, preceding=True):
+      return e
+    return None
+
+  def get(self, node, key):
+    val = node.get(key)
+    if val is None:
+      raise KeyError(key)
+    return val
+
+  def set(self, node, key, value):
+    if isinstance(value, Reference):
+      self.refs[value.token] = value
+      value = value.token
+    node.set(key, value)
+
+  def escape(self, text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+  def inner_html(self, node):
+    res = [self.escape(node.text or u'').encode('utf-8')]
+    for e in node:
+      res.append(lxml.html.tostring(e, encoding='utf-8', with_tail=True))
+    return ''.join(res)
+
+  def extract(self, node):
+    # drop_tree keeps the text following the node
+    node.drop_tree()
+
+  def remove_before(self, node):
+    parent = node.getparent()
+    if parent is None: return
+    for e in list(node.itersiblings(preceding=True)):
+      parent.remove(e)
+    parent.text = None
+
+  def remove_after(self, node):
+    parent = node.getparent()
+    if parent is None: return
+    for e in list(node.itersiblings()):
+      parent.remove(e)
+    node.tail = None
+
+  def add_text(self, tag, text):
+    if len(tag):
+      tag[-1].tail = (tag[-1].tail or u'') + text
+    else:
+      tag.text = (tag.text or u'') + text
+
+  def tag(self, doc, name, contents=(), attrs=()):
+    tag = doc.makeelement(name, {})
+    for e in contents:
+      if not isinstance(e, basestring):
+        tag.append(e)
+        continue
+      if isinstance(e, str):
+        e = e.decode('utf-8', 'replace')
+      self.add_text(tag, self.unescape(e))
+    for key, value in attrs:
+      self.set(tag, key, value)
+    return tag
+
+  def insert(self, parent, index, node):
+    if index == 0 and parent.text:
+      # Before the text too, as with BeautifulSoup
+      node.tail = parent.text + (node.tail or u'')
+      parent.text = None
+    parent.insert(index, node)
+
+  def append(self, parent, node):
+    parent.append(node)
+
+  def render(self, doc, remove=()):
+    return LxmlSanitizer(self.refs).render(doc, remove)
+
+parsers = ["lxml", "soup", "minimal"]
+
+def make_parser(name=None):
+  # The parser backend called name, by default lxml when it is installed
+  if name is None:
+    name = lxml_ok and "lxml" or "soup"
+  if name == "lxml":
+    return LxmlParser()
+  elif name == "minimal":
+    return SoupParser(BeautifulSoup.MinimalSoup)
+  return SoupParser()
+
+
+class TextConverter:
+  # Turns a text/plain page into HTML: paragraphs are separated by an empty
+  # or an indented line, _text_ is emphasized and *text* is strong.
+  # The text can be given in chunks to feed(), only the paragraph being
+  # read is kept between two calls. Each chunk is escaped once and the
+  # markup is looked for on complete paragraphs only.
+
+  breaks    = re.compile('\n(?:\r?\n|  )')
+  # same as \r?\n(\r?\n|  ), the \r is removed by paragraphs(). Starting
+  # with a literal makes the search much faster.
+  controls  = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+  control_chars = ''.join(map(chr, range(0, 9) + range(11, 13) + range(14, 32)))
+  emphasis  = re.compile('_([^_<>]+)_')
+  strong    = re.compile('\*([^\*<>]+)\*')
+  separator = '</p>\n<p>'
+
+  def __init__(self):
+    self.decoder = codecs.getincrementaldecoder('utf-8')('ignore')
+    self.pending = ''
+    # escaped text of the unfinished paragraph
+    self.scanned = 0
+    # length of self.pending known to hold no paragraph break
+    self.started = False
+
+  def escape(self, text):
+    data = text.encode('ascii', 'xmlcharrefreplace')
+    if len(data.translate(None, self.control_chars)) != len(data):
+      data = self.controls.sub(lambda m: "&#%x;" % ord(m.group()), data)
+    return data.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+  def paragraphs(self, data):
+    parts = self.breaks.split(data)
+    if '\r' in data:
+      for i in range(len(parts) - 1):
+        if parts[i].endswith('\r'):
+          parts[i] = parts[i][:-1]
+    return parts
+
+  def wrap(self, pattern, data, start, end):
+    # pattern.sub(start + '\\1' + end, data) without a template expansion
+    # for each match
+    parts = pattern.split(data)
+    last = parts.pop()
+    return ''.join(itertools.chain.from_iterable(
+      itertools.izip(parts, itertools.cycle((start, end))))) + last
+
+  def markup(self, data):
+    if '_' in data:
+      data = self.wrap(self.emphasis, data, '<em>', '</em>')
+    if '*' in data:
+      data = self.wrap(self.strong, data, '<strong>', '</strong>')
+    return data
+
+  def header(self):
+    if self.started:
+      return ''
+    self.started = True
+    return "<html><body>\n<p>"
+
+  def feed(self, chunk):
+    pending = self.pending + self.escape(self.decoder.decode(chunk))
+    # A break is made of \r, \n and spaces only, none can span the last
+    # other character
+    end = len(pending.rstrip('\r\n '))
+    parts = self.paragraphs(pending[self.scanned:end])
+    if len(parts) == 1:
+      self.pending = pending
+      self.scanned = end
+      return self.header()
+    parts[0] = pending[:self.scanned] + parts[0]
+    last = parts.pop()
+    self.pending = last + pending[end:]
+    self.scanned = len(last)
+    parts.append('')
+    return self.header() + self.markup(self.separator.join(parts))
+
+  def close(self):
+    pending = self.pending + self.escape(self.decoder.decode('', True))
+    parts = self.paragraphs(pending[self.scanned:])
+    parts[0] = pending[:self.scanned] + parts[0]
+    self.pending = ''
+    self.scanned = 0
+    return self.header() + self.markup(self.separator.join(parts)) + \
+           "</p>\n</body></html>"
+
+  def convert(self, data, size=65536):
+    # Smaller pieces than the whole text are faster to work on
+    res = [self.feed(data[i:i+size]) for i in range(0, len(data), size)]
+    res.append(self.close())
+    return ''.join(res)
+
+
+class Prefilter:
+  # The --replace rules, compiled once and applied in order to the code of
+  # each page. Rules replacing a plain string by another do not go through
+  # the regexp engine: str.replace does the same, much faster, and is
+  # skipped when the string is not in the page.
+
+  metachars = frozenset('.^$*+?{}[]\\|()')
+
+  def __init__(self):
+    self.rules = []
+    # dictionnaries with keys:
+    #   'search', 'replace': The rule
+    #   'pattern'          : The compiled regexp, None for plain strings
+    #   'hits', 'time'     : What the rule cost so far
+
+  def __len__(self):
+    return len(self.rules)
+
+  def add(self, search, replace):
+    pattern = None
+    if not search or self.metachars.intersection(search) or '\\' in replace:
+      pattern = re.compile(search)
+    self.rules.append({
+      'search' : search,
+      'replace': replace,
+      'pattern': pattern,
+      'hits'   : 0,
+      'time'   : 0.0})
+
+  def apply(self, code):
+    for rule in self.rules:
+      t = time.time()
+      if rule['pattern'] is None:
+        if rule['search'] in code:
+          rule['hits'] += code.count(rule['search'])
+          code = code.replace(rule['search'], rule['replace'])
+      else:
+        code, n = rule['pattern'].subn(rule['replace'], code)
+        rule['hits'] += n
+      rule['time'] += time.time() - t
+    return code
+
+  def report(self):
+    print "%8s %10s  %s" % ("hits", "time (ms)", "rule")
+    for rule in self.rules:
+      print "%8d %10.1f  %r -> %r" % (rule['hits'], rule['time'] * 1000,
+                                      rule['search'], rule['replace'])
+
+
+class BuildStats:
+  # Where the time of a build goes, for --stats. The phases are timed on
+  # the thread building the e-book, a phase started inside another one
+  # pauses it: parsing a page doesn't count the pages it follows, and the
+  # times add up to the time of the build. The counters may be updated
+  # from the download threads.
+  #
+  # The functions in `hooks' are called with (url, timing) once each page
+  # is parsed, timing is a dictionnary of the seconds spent in each phase
+  # for that page, plus 'filename' and 'bytes'.
+
+  phases = ["fetch", "text", "prefilter", "parse", "layout", "sanitize",
+            "render", "write"]
+  # fetch:     waiting for downloads, from the cache or the network
+  # text:      converting text/plain pages to HTML
+  # prefilter: the --replace rules
+  # parse:     building the soup
+  # layout:    finding the title, authors and links of the page
+  # sanitize:  cleaning <head> and the images
+  # render:    serializing the soup to XHTML
+  # write:     compressing and writing the e-book
+
+  counters = ["pages", "resources", "duplicates", "reused", "requests",
+              "errors", "retries", "throttled", "hedged", "hedge_wins",
+              "url_variants", "bytes_in", "bytes_out", "cache_hits",
+              "cache_misses", "cache_evictions", "disk_hits",
+              "disk_revalidated", "disk_misses"]
+
+  def __init__(self):
+    self.times      = dict.fromkeys(self.phases, 0.0)
+    self.counts     = dict.fromkeys(self.counters, 0)
+    self.running    = []
+    # [phase, started, seconds] of the phases started and not stopped
+    self.page_times = []
+    # timing dictionnaries of the pages being parsed
+    self.hooks      = []
+    self.lock       = threading.Lock()
+    self.started    = time.time()
+    self.stopped    = None
+    self.visited    = None
+    # VisitedSet of the crawl, its size and memory are reported
+
+  def start(self, phase):
+    now = time.time()
+    if self.running:
+      self.charge(self.running[-1], now)
+    self.running.append([phase, now, 0.0])
+
+  def stop(self):
+    # Returns the time spent in the phase, without the phases nested in it
+    now = time.time()
+    frame = self.running.pop()
+    self.charge(frame, now)
+    if self.running:
+      self.running[-1][1] = now
+    return frame[2]
+
+  def charge(self, frame, now):
+    phase, started, seconds = frame
+    frame[1] = now
+    frame[2] += now - started
+    self.times[phase] += now - started
+    if self.page_times:
+      timing = self.page_times[-1]
+      timing[phase] = timing.get(phase, 0.0) + now - started
+
+  def count(self, counter, n=1):
+    with self.lock:
+      self.counts[counter] += n
+
+  def begin_page(self):
+    self.page_times.append({})
+
+  def end_page(self, url=None, filename=None, size=0):
+    # Without url, the file wasn't a page after all
+    timing = self.page_times.pop()
+    if url is None:
+      return
+    timing['filename'] = filename
+    timing['bytes']    = size
+    for hook in self.hooks:
+      hook(url, timing)
+
+  def finish(self):
+    self.stopped = time.time()
+
+  def elapsed(self):
+    return (self.stopped or time.time()) - self.started
+
+  def as_dict(self):
+    with self.lock:
+      counts = dict(self.counts)
+    res = {
+      'elapsed' : self.elapsed(),
+      'phases'  : dict(self.times),
+      'counters': counts}
+    if self.visited is not None:
+      res['visited'] = self.visited.report()
+    return res
+
+  def report(self):
+    elapsed = self.elapsed()
+    print "%-10s %10s %7s" % ("phase", "time (ms)", "share")
+    for phase in self.phases:
+      share = elapsed and 100 * self.times[phase] / elapsed or 0
+      print "%-10s %10.1f %6.1f%%" % (phase, self.times[phase] * 1000, share)
+    print "%-10s %10.1f" % ("total", elapsed * 1000)
+    with self.lock:
+      for counter in self.counters:
+        print "%-16s %10d" % (counter, self.counts[counter])
+    if self.visited is not None:
+      visited = self.visited.report()
+      for name in sorted(visited):
+        if isinstance(visited[name], float):
+          print "visited %-25s %10.3g" % (name, visited[name])
+        else:
+          print "visited %-25s %10d" % (name, visited[name])
+
+
+class FileRecord(object):
+  # What a file of the book was downloaded from
+  __slots__ = ('url', 'modify')
+
+  def __init__(self, url, modify):
+    self.url    = url
+    self.modify = modify
+
+
+class FileRegistry:
+  # Files of the book indexed by filename, with a reverse index on
+  # (url, modify) and the next free suffix for each basename so that
+  # naming a file does not depend on the number of files already known.
+  # The reverse index holds `key(url)', the forms of a URL with the same
+  # key share a file.
+
+  def __init__(self, key=None):
+    self.key      = key
+    self.files    = {}
+    self.by_url   = {}
+    self.suffixes = {}
+    self.aliases  = []
+    # (url, modify, filename) for the URLs sharing the file of another URL
+    self.reserved = set()
+    # names taken by files not downloaded, the parts of split documents
+
+  def __contains__(self, filename):
+    return filename in self.files
+
+  def __len__(self):
+    return len(self.files)
+
+  def __getitem__(self, filename):
+    return self.files[filename]
+
+  def lookup(self, url, modify):
+    if self.key:
+      url = self.key(url)
+    return self.by_url.get((url, modify))
+
+  def unique_name(self, base, dot, ext):
+    filename = base + dot + ext
+    if filename not in self.files and filename not in self.reserved:
+      return filename
+    key = (base, dot, ext)
+    i = self.suffixes.get(key, 2)
+    while filename in self.files or filename in self.reserved:
+      filename = base + "-" + str(i) + dot + ext
+      i = i + 1
+    self.suffixes[key] = i
+    return filename
+
+  def add(self, filename, url, modify):
+    self.files[filename] = FileRecord(url, modify)
+    self.by_url.setdefault((self.key and self.key(url) or url, modify), filename)
+
+  def alias(self, filename, url, modify):
+    # url has the same content as filename, already in the book
+    self.by_url[(self.key and self.key(url) or url, modify)] = filename
+    self.aliases.append((url, modify, filename))
+
+  def reserve(self, filename):
+    self.reserved.add(filename)
+
+
+class PreviousBook:
+  # An e-book written earlier, opened by --update to copy the files that
+  # did not change. Its crawl manifest tells which URL each file comes from
+  # and, for pages, what they linked to.
+
+  def __init__(self, filename, key=None):
+    # The URLs are looked up by `key(url)' like in FileRegistry
+    self.filename = filename
+    self.key = key or (lambda url: url)
+    self.zip = zipfile.ZipFile(filename)
+    try:
+      manifest = json.loads(self.zip.read(Epub.crawl_manifest))
+    except KeyError:
+      self.zip.close()
+      raise ValueError("no crawl manifest, rebuild it without --update")
+    self.files   = manifest['files']
+    self.pages   = dict((self.key(url), page)
+                        for url, page in manifest['pages'].iteritems())
+    self.aliases = manifest.get('aliases', [])
+    self.parts   = manifest.get('parts', {})
+    self.by_url  = {}
+    for filename in self.files:
+      f = self.files[filename]
+      self.by_url[(self.key(f['url']), f['modify'])] = filename
+    for url, modify, filename in self.aliases:
+      self.by_url[(self.key(url), modify)] = filename
+
+  def knows(self, url):
+    url = self.key(url)
+    return url in self.pages or (url, True) in self.by_url or \
+           (url, False) in self.by_url
+
+  def lookup(self, url, modify):
+    # Returns (filename, page record or None) or None if url is unknown
+    url = self.key(url)
+    filename = self.by_url.get((url, modify))
+    page = None
+    if modify:
+      page = self.pages.get(url)
+    if page is not None and filename is None:
+      filename = page['filename']
+    if filename is None:
+      return None
+    return filename, page
+
+  def close(self):
+    self.zip.close()
+
+
+class PendingFetch:
+  # A download submitted to a FetchPool
+
+  def __init__(self, url):
+    self.url     = url
+    self.host    = urlsplit(url)[1]
+    self.started = False
+    self.result  = None
+    self.error   = None
+    self.done    = threading.Event()
+
+  def wait(self):
+    # The result of the download, or the exception it raised, raised again
+    # in the thread that needs it
+    self.done.wait()
+    if self.error is not None:
+      raise self.error
+    return self.result
+
+
+class FetchPool:
+  # The crawl frontier: URLs the crawler will need soon, downloaded in the
+  # background with at most `jobs' threads and at most `per_host'
+  # simultaneous requests to the same host. The threads only live while
+  # there is work queued. The crawler claims the results one by one, in
+  # the order it needs them, so the navigation is assembled exactly as in
+  # a sequential crawl. The URLs with the same `key(url)' are downloaded
+  # once.
+
+  def __init__(self, fetch, jobs, per_host=None, key=None):
+    self.fetch    = fetch
+    self.jobs     = jobs
+    self.per_host = per_host
+    self.key      = key or (lambda url: url)
+    self.lock     = threading.Lock()
+    self.queue    = collections.deque()
+    self.pending  = {}
+    self.active   = {}
+    self.running  = 0
+
+  def submit(self, urls):
+    with self.lock:
+      for url in urls:
+        key = self.key(url)
+        if key in self.pending: continue
+        p = PendingFetch(url)
+        self.pending[key] = p
+        self.queue.append(p)
+      while self.running < self.jobs and self.running < len(self.queue):
+        self.running += 1
+        t = threading.Thread(target=self.worker)
+        t.daemon = True
+        t.start()
+
+  def next_job(self):
+    for p in self.queue:
+      if not self.per_host or self.active.get(p.host, 0) < self.per_host:
+        self.queue.remove(p)
+        self.active[p.host] = self.active.get(p.host, 0) + 1
+        p.started = True
+        return p
+    return None
+
+  def worker(self):
+    while True:
+      with self.lock:
+        p = self.next_job()
+        if not p:
+          # Either the queue is empty or all its hosts are busy, in which
+          # case the threads working for those hosts will pick it up
+          self.running -= 1
+          return
+      try:
+        p.result = self.fetch(p.url)
+      except Exception, e:
+        # Keep the thread for the next job, the error goes to the claimer
+        p.error = e
+      finally:
+        with self.lock:
+          self.active[p.host] -= 1
+        p.done.set()
+
+  def claim(self, url):
+    # Returns the PendingFetch for `url', or None if the caller should
+    # download it itself
+    with self.lock:
+      p = self.pending.pop(self.key(url), None)
+      if p and not p.started:
+        self.queue.remove(p)
+        return None
+    return p
+
+
 class TopShelf(Epub):
 
-  downloaded_files = {}
-  # dictionnary indexed by filename containing a dictionnary:
-  #   'url':   The URL
-  #   'parse': If the data was parsed
+  downloaded_files = None
+  # FileRegistry of the files of the book and the URL they come from
+
+  download_cache = None
+  # FetchCache of the downloads, the values are dictionnaries:
+  #   'Content-Type' : The Content-Type
+  #   'ETag'         : The ETag header or None
+  #   'Last-Modified': The Last-Modified header or None
+  #   'data'         : The data
+
+  fetched = None
+  # VisitedSet of the URLs downloaded for this e-book, whether still in
+  # download_cache or not: their fetch_key and the other forms downloaded
+
+  known = None
+  # VisitedSet of the URLs downloaded by the previous runs (--link-visited),
+  # with -O they are linked to instead of downloaded, or None
 
-  download_cache = {}
-  # dictionnary indexed by url, the value is a dictionnary:
-  #   'Content-Type': The Content-Type
-  #   'data'        : The data
+  canonicalizer = None
+  # UrlCanonicalizer of the URLs, or None to take them as they are
+
+  disk_cache = None
+  # DiskCache instance, or None to only cache in memory
+
+  http = None
+  # HTTPPool instance, or None to open a new connection with urllib2 for
+  # each request
+
+  rate = None
+  # RateLimiter of the requests to each host, or None for no limit
+
+  mirrors = None
+  # MirrorSet of the hosts serving the same site, or None
+
+  hedge = None
+  # seconds after which a request still waiting is sent to a second mirror
+  # too, the first response wins. None not to hedge.
+
+  retries    = 3
+  retry_base = 1.0
+  retry_max  = 60.0
+  # a download failing with a transient error is tried `retries' more
+  # times, waiting about retry_base, then twice as long each time up to
+  # retry_max seconds, or as long as the server asks with Retry-After
+
+  pages = {}
+  # dictionnary indexed by url of the parsed pages, stored in the crawl
+  # manifest to update the e-book later:
+  #   'filename'     : The file name in the e-book
+  #   'title', 'authors', 'tags', 'submitter': The information found
+  #   'links'        : [url, nested] for each page parsed from this one
+  #   'resources'    : The images of the page
+  #   'ETag', 'Last-Modified': The validators of the page
+
+  previous = None
+  # PreviousBook being updated, or None
+
+  digests = {}
+  # dictionnary indexed by the SHA-1 of the resources of the book, the
+  # value is the filename. A resource with the same content as one already
+  # in the book is not stored again, its URL is an alias of the file.
+
+  stats = None
+  # BuildStats of the build
 
   def __init__(self, url = None, layout="TopShelf", accept_regexp=None, delete_regexp=None, skip=False):
     Epub.__init__(self)
-    self.downloaded_files = {}
+    self.downloaded_files = FileRegistry(self.fetch_key)
     self.current_nav = self.navigation
     self.info_title  = ""
     self.info_url    = ""
@@ -338,11 +2590,38 @@ class TopShelf(Epub):
     self.info_date   = datetime.datetime.utcnow()
     self.raw         = layout == None
     self.layout      = layout
-    self.replace     = []
+    self.replace     = Prefilter()
     self.replace_show= False
     self.error       = False
     self.downloadOnce= False
-    self.BeautifulParser = BeautifulSoup.BeautifulSoup
+    self.download_cache = FetchCache()
+    self.fetched     = VisitedSet()
+    self.canonicalizer = UrlCanonicalizer()
+    self.disk_cache  = None
+    self.http        = None
+    self.rate        = None
+    self.mirrors     = MirrorSet()
+    self.hedge       = None
+    self.jobs        = 1
+    self.host_jobs   = None
+    self.fetch_pool  = None
+    self.pages       = {}
+    self.page_stack  = []
+    self.previous    = None
+    self.revalidate  = False
+    self.reused      = set()
+    self.digests     = {}
+    self.stats       = BuildStats()
+    self.stats.visited = self.fetched
+    self.queue_mode  = False
+    self.crawl_queue = []
+    self.page_jobs   = None
+    self.crawling    = False
+    self.references  = {}
+    self.ref_prefix  = "topshelf-ref-%s-" % uuid.uuid4().hex
+    self.ref_count   = itertools.count()
+    self.ref_pattern = re.compile(re.escape(self.ref_prefix) + "([0-9]+)")
+    self.parser = make_parser()
     if accept_regexp:
       self.accept_regexp = re.compile(accept_regexp)
     else:
@@ -357,10 +2636,9 @@ class TopShelf(Epub):
       self.parse_url(url, output=(not skip))
 
   def translate_url_to_name(self, url, modify=True, suffix=None):
-    for df in self.downloaded_files:
-      if self.downloaded_files[df]['url']    == url and \
-         self.downloaded_files[df]['modify'] == modify:
-        return df
+    df = self.downloaded_files.lookup(url, modify)
+    if df is not None:
+      return df
     filename = os.path.basename(url.rstrip('/'))
     if not modify:
       filename = "content/resources/%s" % filename
@@ -371,19 +2649,18 @@ class TopShelf(Epub):
     if suffix and not len(ext):
       dot = '.'
       ext = suffix
-      filename = base + dot + ext
-    i = 2
-    while filename in self.downloaded_files:
-      filename = base + "-" + str(i) + dot + ext
-      i = i + 1
-    self.downloaded_files[filename] = {'url':url, 'modify':modify}
+    filename = self.downloaded_files.unique_name(base, dot, ext)
+    self.downloaded_files.add(filename, url, modify)
     return filename.decode('utf-8')
 
   def allow_url(self, url):
-    if self.delete_regexp and self.delete_regexp.search(url):
+    # The URL as it is and its canonical form must be allowed alike
+    key = self.fetch_key(url)
+    if self.delete_regexp and (self.delete_regexp.search(url) or
+                               self.delete_regexp.search(key)):
       return False
     elif self.accept_regexp:
-      return self.accept_regexp.search(url)
+      return self.accept_regexp.search(url) or self.accept_regexp.search(key)
     else:
       return True
 
@@ -398,37 +2675,347 @@ class TopShelf(Epub):
     return url
 
   def has_url(self, url):
-    return url in self.download_cache
+    key = self.fetch_key(url)
+    if self.known is not None and key in self.known:
+      return True
+    return key in self.fetched or url in self.reused
+
+  def addfile(self, filename, content, type):
+    self.stats.start("write")
+    Epub.addfile(self, filename, content, type)
+    self.stats.stop()
+
+  def copyfile(self, filename, source, type):
+    self.stats.start("write")
+    Epub.copyfile(self, filename, source, type)
+    self.stats.stop()
+
+  def writeout(self, epub_name):
+    self.stats.start("write")
+    Epub.writeout(self, epub_name)
+    self.stats.stop()
+    self.stats.count('bytes_out', os.path.getsize(epub_name))
+
+  def update_from(self, filename):
+    # Reuse the files of a previous e-book, only the pages given on the
+    # command line (or all with self.revalidate) are checked for changes
+    self.previous = PreviousBook(filename, self.fetch_key)
+    for name in self.previous.files:
+      f = self.previous.files[name]
+      self.downloaded_files.add(name, f['url'], f['modify'])
+    for url, modify, name in self.previous.aliases:
+      self.downloaded_files.alias(name, url, modify)
+
+  def get_crawl_manifest(self):
+    files = {}
+    for filename in self.all_files:
+      if filename not in self.downloaded_files: continue
+      f = self.downloaded_files[filename]
+      files[filename] = {
+        'url'   : f.url,
+        'modify': f.modify,
+        'type'  : self.all_files[filename]['type']}
+    for digest in self.digests:
+      if self.digests[digest] in files:
+        files[self.digests[digest]]['digest'] = digest
+    aliases = [list(a) for a in self.downloaded_files.aliases
+               if a[2] in files]
+    manifest = {'version': 1, 'files': files, 'pages': self.pages,
+                'aliases': aliases}
+    parts = dict((filename, self.parts[filename]) for filename in self.parts
+                 if filename in files)
+    if parts:
+      manifest['parts'] = parts
+    return json.dumps(manifest, sort_keys=True)
+
+  def part_name(self, filename, n):
+    # Named like the other files, so that no page gets the name later
+    base, dot, ext = filename.partition('.')
+    name = self.downloaded_files.unique_name("%s-part%d" % (base, n), dot, ext)
+    self.downloaded_files.reserve(name)
+    return name
+
+  def same_resource(self, url, digest):
+    # The file of the book with the same content as the resource url, which
+    # becomes an alias of it, or None
+    if self.downloaded_files.lookup(url, False) is not None:
+      return None
+    filename = self.digests.get(digest)
+    if filename is None or filename not in self.all_files:
+      return None
+    self.downloaded_files.alias(filename, url, False)
+    self.stats.count('duplicates')
+    return filename
+
+  def new_page(self, url, filename, dta):
+    return {
+      'filename'     : filename,
+      'title'        : "",
+      'authors'      : [],
+      'tags'         : [],
+      'submitter'    : None,
+      'links'        : [],
+      'resources'    : [],
+      'ETag'         : dta.get('ETag'),
+      'Last-Modified': dta.get('Last-Modified')}
+
+  def record_link(self, url, nested):
+    if self.page_stack:
+      self.page_stack[-1]['links'].append([url, nested])
+
+  def record_resource(self, url):
+    if self.page_stack:
+      self.page_stack[-1]['resources'].append(url)
+
+  def add_page_info(self, title, authors, tags, submitter):
+    if not self.info_title:
+      self.info_title = title
+    for s in authors:
+      if s not in self.info_author:
+        self.info_author.append(s)
+        print "Author: %s" % s
+    for s in tags:
+      if s not in self.info_tags:
+        self.info_tags.append(s)
+        print "Tag: %s" % s
+    if not self.info_author and submitter is not None:
+      # Use the submitter name
+      self.info_author.append(submitter)
+
+  def urlopen(self, url, headers=None):
+    # Downloads `url' from the best of its mirrors. After a transient error
+    # the next mirror is tried at once, and once all of them failed they
+    # are tried again, waiting longer each time, up to self.retries times.
+    # A mirror failing with a permanent error is not tried again.
+    if headers is None:
+      headers = {}
+    urls = self.mirrors and self.mirrors.order(url) or [url]
+    attempt = 0
+    i = 0
+    while True:
+      if self.hedge is not None and i + 1 < len(urls):
+        result, failures = self.open_hedged(urls[i], urls[i + 1], headers)
+      else:
+        try:
+          result, failures = self.open_once(urls[i], headers), []
+        except Exception, e:
+          result, failures = None, [(urls[i], e)]
+      if not failures:
+        return result
+      # The mirrors that failed are urls[i:i + len(failures)]
+      tried = urls[i:i + len(failures)]
+      delay = None
+      for failed, e in failures:
+        if headers and isinstance(e, urllib2.HTTPError) and e.code == 304:
+          # Not Modified, the caller keeps its cached copy
+          return e
+        kind = classify_error(e)
+        retry = None
+        if isinstance(e, urllib2.HTTPError):
+          retry = retry_after(e)
+          if retry is not None:
+            retry = min(retry, self.retry_max)
+            if delay is None or retry > delay:
+              delay = retry
+        if kind == 'throttled':
+          self.stats.count('throttled')
+          if self.rate:
+            self.rate.throttled(urlsplit(failed)[1], retry)
+        if kind == 'permanent':
+          tried.remove(failed)
+      urls[i:i + len(failures)] = tried
+      i += len(tried)
+      if i < len(urls):
+        continue
+      i = 0
+      if not urls or attempt >= self.retries:
+        break
+      # Exponential backoff, with jitter so that the parallel downloads
+      # don't all come back at once
+      wait = min(self.retry_max, self.retry_base * 2 ** attempt)
+      wait = random.uniform(wait / 2, wait)
+      if delay is not None:
+        wait = max(wait, delay)
+      attempt += 1
+      self.stats.count('retries')
+      print "Retrying in %.1fs (%s): %s" % (wait, e, url)
+      time.sleep(wait)
+    print("Error downloading: %s" % url)
+    self.stats.count('errors')
+    self.error = True
+    return None
 
-  def urlopen(self, url):
-    result = None
+  def open_once(self, url, headers):
+    # One request, without retries, timed for the mirror statistics
+    host = urlsplit(url)[1]
+    self.stats.count('requests')
+    if self.rate:
+      self.rate.acquire(host)
+    started = time.time()
     try:
-      r = Request(url);
-      result = urlopen (r)
-      if cj is not None:
-        cj.save(COOKIEFILE);
-    except:
-      url2 = url.replace('bigcloset.us', 'bigclosetr.us');
-      if url2 != url:
-        self.urlopen(url2);
+      r = Request(url, headers=headers);
+      if self.http:
+        result = self.http.open(r)
       else:
-        print("Error downloading: %s" % url)
-        self.error = True
-    return result;
+        result = urlopen (r)
+    except Exception, e:
+      failed = classify_error(e) != 'permanent'
+      if self.mirrors:
+        self.mirrors.record(host, time.time() - started, failed)
+      if self.rate and not failed:
+        self.rate.success(host)
+      raise
+    if self.mirrors:
+      self.mirrors.record(host, time.time() - started, False)
+    if self.rate:
+      self.rate.success(host)
+    if cj is not None:
+      with cookie_lock:
+        cj.save(COOKIEFILE);
+    return result
+
+  def open_hedged(self, url, backup, headers):
+    # Requests `url', and `backup' as well if no response came after
+    # self.hedge seconds. Returns (response, failures): the first response
+    # or None, and the (url, error) of the requests that failed, the other
+    # request being waited for when one fails.
+    results = Queue.Queue()
+    def run(u):
+      try:
+        results.put((u, self.open_once(u, headers), None))
+      except Exception, e:
+        results.put((u, None, e))
+    def start(u):
+      t = threading.Thread(target=run, args=(u,))
+      t.daemon = True
+      t.start()
+    start(url)
+    pending = 1
+    try:
+      u, result, error = results.get(True, self.hedge)
+    except Queue.Empty:
+      self.stats.count('hedged')
+      start(backup)
+      pending = 2
+      u, result, error = results.get()
+    pending -= 1
+    failures = []
+    while error is not None:
+      failures.append((u, error))
+      if not pending:
+        return None, failures
+      u, result, error = results.get()
+      pending -= 1
+    if u == backup:
+      self.stats.count('hedge_wins')
+    if pending:
+      # Close the response that lost the race once it comes
+      def drain():
+        u, r, e = results.get()
+        if r is not None:
+          r.close()
+      t = threading.Thread(target=drain)
+      t.daemon = True
+      t.start()
+    return result, []
+
+  def fetch_key(self, url):
+    # The URL the downloads and the files of `url' are known by, the same
+    # for all its forms and on every mirror. The downloads use the URL as
+    # it is.
+    if self.canonicalizer:
+      url = self.canonicalizer.canonical(url)
+    if self.mirrors:
+      url = self.mirrors.canonical(url)
+    return url
 
   def open_url(self, url):
-    if url in self.download_cache:
-      return self.download_cache[url]
-    f = self.urlopen(url);
+    key = self.fetch_key(url)
+    if url != key and key in self.fetched and url not in self.fetched:
+      # Another form of the URL was downloaded already
+      self.stats.count('url_variants')
+    dta = self.download_cache.get(key)
+    if dta is not None:
+      # The cache may be shared with e-books that marked the URL fetched
+      # for themselves only
+      self.stats.count('cache_hits')
+      self.add_fetched(key, url)
+      return dta
+    self.stats.count('cache_misses')
+    pending = None
+    if self.fetch_pool:
+      pending = self.fetch_pool.claim(url)
+    if pending:
+      dta = pending.wait()
+    else:
+      dta = self.fetch_url(url)
+    if dta:
+      self.add_fetched(key, url)
+      self.stats.count('cache_evictions', self.download_cache.put(key, dta))
+    return dta
+
+  def add_fetched(self, key, url):
+    self.fetched.add(key)
+    if url != key:
+      self.fetched.add(url)
+
+  def prefetch(self, urls):
+    # Start downloading `urls' in the background, parse_url will pick the
+    # results up when it reaches them
+    if self.jobs <= 1:
+      return
+    urls = [u for u in urls
+            if self.fetch_key(u) not in self.download_cache and
+               self.allow_url(u) and
+               not (self.previous and self.previous.knows(u))]
+    if not urls:
+      return
+    if not self.fetch_pool:
+      self.fetch_pool = FetchPool(self.fetch_url, self.jobs, self.host_jobs,
+                                  self.fetch_key)
+    self.fetch_pool.submit(urls)
+
+  def fetch_url(self, url):
+    cached = None
+    headers = {}
+    key = self.fetch_key(url)
+    if self.disk_cache:
+      cached = self.disk_cache.get(key)
+      if cached:
+        if self.disk_cache.is_fresh(cached):
+          self.stats.count('disk_hits')
+          return self.use_cached(key, cached, False)
+        headers = self.disk_cache.conditional_headers(cached)
+    f = self.urlopen(url, headers);
+    if f and getattr(f, 'code', None) == 304:
+      f.close()
+      self.stats.count('disk_revalidated')
+      return self.use_cached(key, cached, True)
     if f:
+      info = f.info()
       dta = {
-        'Content-Type': f.info().getheader("Content-Type").replace('; charset=', ';charset='),
-        'data'        : f.read()}
+        'Content-Type' : info.getheader("Content-Type").replace('; charset=', ';charset='),
+        'ETag'         : info.getheader("ETag"),
+        'Last-Modified': info.getheader("Last-Modified"),
+        'data'         : f.read()}
       f.close()
-      self.download_cache[url] = dta
+      self.stats.count('bytes_in', len(dta['data']))
+      if self.disk_cache:
+        self.stats.count('disk_misses')
+        self.disk_cache.put(key, dta)
       return dta
     return None
 
+  def use_cached(self, url, entry, revalidated):
+    dta = {
+      'Content-Type' : str(entry['Content-Type']),
+      'ETag'         : entry.get('ETag'),
+      'Last-Modified': entry.get('Last-Modified'),
+      'data'         : entry['data']}
+    if revalidated:
+      self.disk_cache.put(url, dta)
+    return dta
+
   def parse_url(self, url, parse=True, output=True, toc=True):
     allow = self.allow_url(url)
     if output and not allow:
@@ -436,11 +3023,28 @@ class TopShelf(Epub):
       return None
     if not self.info_url and output and allow:
       self.info_url = url
+    if self.previous:
+      filename = self.reuse_url(url, parse, output, toc)
+      if filename:
+        return filename
+    if parse:
+      self.stats.begin_page()
+    self.stats.start("fetch")
     dta = self.open_url(url)
+    self.stats.stop()
     if not dta:
+      if parse:
+        self.stats.end_page()
       print "Fail to download: %s" % (url)
       return None
     else:
+      filename = digest = None
+      if not parse and output:
+        digest = hashlib.sha1(dta['data']).hexdigest()
+        filename = self.same_resource(url, digest)
+        if filename is not None:
+          print "Same file     %s:\t%s" % (filename, url)
+          return filename
       filename = self.translate_url_to_name(url, parse)
       is_html  = ("text/html"         in dta['Content-Type']) or \
                  ("application/xhtml" in dta['Content-Type'])
@@ -449,18 +3053,9 @@ class TopShelf(Epub):
       if dta['Content-Type'] == "text/plain":
         is_html = True
         dta['Content-Type'] = "text/html"
-        data = data.decode('utf-8', 'ignore').encode('ascii', 'xmlcharrefreplace')
-        for i in range(0, 9) + range(11, 13) + range(14, 32):
-          data = data.replace(chr(i),  "&#%x;" % i)
-        data = data.replace('&', '&amp;')
-        data = data.replace('<', '&lt;')
-        data = data.replace('>', '&gt;')
-        #data = data.replace('\n\n', '</p>\n<p>')
-        #data = data.replace('\n  ', '</p>\n<p>')
-        data = re.sub('\r?\n(\r?\n|  )', '</p>\n<p>', data)
-        data = re.sub('_([^_<>]+)_', '<em>\\1</em>', data)
-        data = re.sub('\*([^\*<>]+)\*', '<strong>\\1</strong>', data)
-        data = """<html><body>\n<p>%s</p>\n</body></html>""" % (data)
+        self.stats.start("text")
+        data = TextConverter().convert(data)
+        self.stats.stop()
       if has_file:
         if parse and is_html:
           if output:
@@ -479,11 +3074,24 @@ class TopShelf(Epub):
           print "Download file %s:\t%s" % (filename, url)
 
       if parse and is_html:
+        page = self.new_page(url, filename, dta)
+        saved = self.begin_page()
+        self.page_stack.append(page)
+        size = len(data)
         data = self.prefilter(data, filename, url)
-        soup = self.BeautifulParser(data)
-        content = self.parse_soup(soup, filename, url, output)
-        if not has_file and output:
-          self.addfile(filename, content,     "application/xhtml+xml")
+        self.stats.start("parse")
+        soup = self.parser.parse(data)
+        self.stats.stop()
+        content, refs = self.parse_page(soup, filename, url, output)
+        soup = data = None
+        self.page_stack.pop()
+        self.pages[url] = page
+        self.stats.count('pages')
+        self.stats.end_page(url, filename, size)
+        def finish():
+          if not has_file and output:
+            self.addfile(filename, self.resolve(content, refs), "application/xhtml+xml")
+        self.end_page(saved, finish)
       else:
         if output and toc:
           self.current_nav.append({
@@ -492,34 +3100,266 @@ class TopShelf(Epub):
             'sub'  : []})
         if not has_file and output:
           self.addfile(filename, data, dta['Content-Type'])
+          self.stats.count('resources')
+          if digest:
+            self.digests.setdefault(digest, filename)
+        if parse:
+          self.stats.end_page()
       return filename
 
+  def defer(self, fn):
+    # In queue mode, run fn once the page being processed is written out,
+    # after the functions deferred before it. Run it now otherwise.
+    if self.page_jobs is None:
+      fn()
+    else:
+      self.page_jobs.append(self.make_job(fn))
+
+  def make_job(self, fn):
+    return (fn, self.current_nav, self.recursion_index, list(self.page_stack))
+
+  def begin_page(self):
+    saved = self.page_jobs
+    if self.queue_mode:
+      self.page_jobs = []
+    return saved
+
+  def end_page(self, saved, finish):
+    # Queue the jobs deferred since begin_page, followed by finish. The
+    # queue is a stack so that the pages are visited in the same order as
+    # when following the links right away.
+    jobs, self.page_jobs = self.page_jobs, saved
+    if jobs is None:
+      finish()
+      return
+    jobs.append(self.make_job(finish))
+    jobs.reverse()
+    self.crawl_queue.extend(jobs)
+    if not self.crawling:
+      self.run_queue()
+
+  def run_queue(self):
+    self.crawling = True
+    while self.crawl_queue:
+      fn, nav, index, stack = self.crawl_queue.pop()
+      saved = (self.current_nav, self.recursion_index, self.page_stack)
+      self.current_nav, self.recursion_index, self.page_stack = nav, index, stack
+      fn()
+      self.current_nav, self.recursion_index, self.page_stack = saved
+    self.crawling = False
+
+  def new_reference(self, value):
+    token = "%s%d" % (self.ref_prefix, next(self.ref_count))
+    ref = Reference(value, token)
+    if self.queue_mode:
+      self.references[token] = ref
+    return ref
+
+  def resolve(self, content, references):
+    # Replace the placeholders of `references' by the attributes
+    if self.ref_prefix not in content:
+      return content
+    return self.ref_pattern.sub(
+      lambda m: references[m.group()].format(), content)
+
+  def follow_link(self, url, ref=None):
+    # Download a page linked from the current one, ref is set to the new
+    # link target
+    if self.downloadOnce and self.has_url(url):
+      if ref: ref.set(url)
+    else:
+      self.record_link(url, True)
+      self.recursion_index = self.recursion_index + 1
+      u = self.parse_url(url)
+      if u and ref: ref.set("../%s" % u)
+      self.recursion_index = self.recursion_index - 1
+    if ref: ref.resolved = True
+
+  def get_image(self, url, baseurl, ref):
+    u = self.get_url(url, relative=os.path.dirname(self.translate_url_to_name(baseurl))+"/")
+    if u: ref.set("%s" % u)
+    ref.resolved = True
+
+  def is_unchanged(self, url, page):
+    # Conditional request for a page of the previous e-book. When it
+    # changed, the new version is kept for parse_url.
+    headers = {}
+    if page.get('ETag'):
+      headers['If-None-Match'] = str(page['ETag'])
+    if page.get('Last-Modified'):
+      headers['If-Modified-Since'] = str(page['Last-Modified'])
+    if not headers:
+      return False
+    f = self.urlopen(url, headers)
+    if f and getattr(f, 'code', None) == 304:
+      f.close()
+      return True
+    if f:
+      info = f.info()
+      dta = {
+        'Content-Type' : info.getheader("Content-Type").replace('; charset=', ';charset='),
+        'ETag'         : info.getheader("ETag"),
+        'Last-Modified': info.getheader("Last-Modified"),
+        'data'         : f.read()}
+      f.close()
+      self.stats.count('bytes_in', len(dta['data']))
+      key = self.fetch_key(url)
+      if self.disk_cache:
+        self.disk_cache.put(key, dta)
+      self.add_fetched(key, url)
+      self.stats.count('cache_evictions', self.download_cache.put(key, dta))
+    return False
+
+  def reuse_url(self, url, parse, output, toc):
+    # Take url from the previous e-book instead of downloading it, returns
+    # its filename or None to download it
+    old = self.previous.lookup(url, parse)
+    if old is None:
+      return None
+    filename, page = old
+    has_file = filename in self.all_files
+    if output and not has_file and filename not in self.previous.files:
+      return None
+    if page is not None and (self.revalidate or not self.page_stack):
+      if not self.is_unchanged(url, page):
+        return None
+
+    print "Reuse file    %s" % filename
+    self.reused.add(url)
+    self.stats.count('reused')
+    def finish():
+      if not has_file and output:
+        f = self.previous.files[filename]
+        self.copyfile(filename, self.previous.zip, f['type'])
+        if f.get('digest'):
+          self.digests.setdefault(f['digest'], filename)
+        self.copy_parts(filename, f['type'])
+    if page is not None:
+      self.replay_page(url, page, output, finish)
+    else:
+      if output and toc:
+        self.current_nav.append({
+          'file' : filename,
+          'title': filename.encode('utf-8'),
+          'sub'  : []})
+      finish()
+    return filename
+
+  def copy_parts(self, filename, type):
+    # The parts of filename if it was split in the previous e-book
+    parts = self.previous.parts.get(filename)
+    if not parts:
+      return
+    self.parts[filename] = parts
+    for part in parts:
+      self.downloaded_files.reserve(part['file'])
+      self.copyfile(part['file'], self.previous.zip, type)
+      for i in part['ids']:
+        self.anchors[(filename, i)] = part['file']
+
+  def replay_page(self, url, old, output, finish):
+    # Do what parsing the page did the first time, from its record
+    enc  = lambda s: s is not None and s.encode('utf-8') or s
+    page = self.new_page(url, old['filename'], old)
+    page['title']     = enc(old['title'])
+    page['authors']   = [enc(s) for s in old['authors']]
+    page['tags']      = [enc(s) for s in old['tags']]
+    page['submitter'] = enc(old['submitter'])
+    old_nav = self.current_nav
+    if output:
+      self.add_page_info(page['title'], page['authors'], page['tags'],
+                         page['submitter'])
+      navigation_item = {
+        'file' : old['filename'],
+        'title': old['title'],
+        'sub'  : []}
+      self.current_nav.append(navigation_item)
+      self.current_nav = navigation_item['sub']
+    if self.recursion_limit != None and self.recursion_index > self.recursion_limit:
+      accept_recursion = False
+    else:
+      accept_recursion = True
+    saved = self.begin_page()
+    self.page_stack.append(page)
+    for link, nested in old['links']:
+      if not nested:
+        self.record_link(link, False)
+        self.defer(lambda link=link: self.parse_url(link))
+      elif accept_recursion:
+        self.defer(lambda link=link: self.follow_link(link))
+    for res in old['resources']:
+      self.record_resource(res)
+      self.defer(lambda res=res: self.parse_url(res, parse=False, toc=False))
+    self.page_stack.pop()
+    self.pages[url] = page
+    self.current_nav = old_nav
+    self.end_page(saved, finish)
+
   def init_replace(self, r1, r2, show=False):
     #print "%s -> %s" % (r1,r2)
-    self.replace.append( (r1,r2) )
+    self.replace.add(r1, r2)
     if show: self.replace_show = True
 
   def prefilter(self, code, filename, baseurl):
     if len(self.replace):
-      for r1, r2 in self.replace:
-        code = re.sub(r1, r2, code)
+      self.stats.start("prefilter")
+      code = self.replace.apply(code)
+      self.stats.stop()
       if self.replace_show:
         print "== code =="
         print code
         print "== /code =="
     return code
 
+  def parse_page(self, soup, filename, baseurl, output):
+    # parse_soup with a dictionnary of references of its own, returns the
+    # content and the references. They only live as long as the page,
+    # whether it is written out or not.
+    saved, self.references = self.references, {}
+    try:
+      content = self.parse_soup(soup, filename, baseurl, output)
+      return content, self.references
+    finally:
+      self.references = saved
+
   def parse_soup_topshelf(self, soup, filename, baseurl, output):
-    page_title = soup.find("title")
-    if page_title:
-      page_title = page_title.renderContents().replace(" | TopShelf", "")
+    parser = self.parser
+    page_title = parser.find(soup, "title")
+    if page_title is not None:
+      page_title = parser.inner_html(page_title).replace(" | TopShelf", "")
       page_title = page_title.replace(" | BigCloset TopShelf", "")
     else:
       page_title = os.path.basename(filename)
-    submitted  = soup.find('footer', attrs={'class':'submitted'})
+    submitted  = parser.find(soup, 'footer', {'class':'submitted'})
+    page = self.page_stack[-1]
+    page['title'] = page_title
+
+    numsection=0
+    for section in parser.find_all(soup, 'section', {'class':has_class('field')}):
+      for a in parser.find_all(section, 'a'):
+        s = parser.inner_html(a)
+        if numsection == 0:
+          if s != "New Author":
+            page['authors'].append(s)
+        else:
+          page['tags'].append(s)
+      numsection += 1
+
+    if submitted is not None:
+      a = parser.find(submitted, 'span', {'rel':'author'})
+      if a is not None:
+        page['submitter'] = parser.inner_html(a)
+      else:
+        a, b, info = parser.inner_html(submitted).partition("ubmitted by ")
+        if not info:
+          a, b, info = parser.inner_html(submitted).partition("wned by ")
+        info, a, b = info.partition(" on")
+        if len(info):
+          page['submitter'] = info
+
     if output:
-      if not self.info_title:
-        self.info_title = page_title
+      self.add_page_info(page_title, page['authors'], page['tags'],
+                         page['submitter'])
       navigation_item = {
         'file' : filename,
         'title': page_title.decode('utf-8'),
@@ -527,111 +3367,69 @@ class TopShelf(Epub):
       self.current_nav.append(navigation_item)
       self.current_nav = navigation_item['sub']
 
-      numsection=0
-      for section in soup.findAll('section', attrs={'class':has_class('field')}):
-        for a in section.findAll('a'):
-          s = a.renderContents()
-          if numsection == 0:
-            if s == "New Author":
-              pass
-            elif s not in self.info_author:
-              self.info_author.append(s)
-              print "Author: %s" % s
-          elif s not in self.info_tags:
-            self.info_tags.append(s)
-            print "Tag: %s" % s
-        numsection += 1
-
-      if not self.info_author and submitted:
-        # Use the submitter name
-        a = submitted.find('span', attrs={'rel':'author'})
-        if a:
-          s = a.renderContents()
-          if s not in self.info_author:
-            self.info_author.append(s)
-        else:
-          a, b, info = submitted.renderContents().partition("ubmitted by ")
-          if not info:
-            a, b, info = submitted.renderContents().partition("wned by ")
-          info, a, b = info.partition(" on")
-          if len(info) and info not in self.info_author:
-            self.info_author.append(info)
-
-    if submitted:
-      submitted = submitted.renderContents()
+    if submitted is not None:
+      submitted = parser.inner_html(submitted)
 
-    self.soup_remove_before(soup, soup.find('span',   attrs={'class':'print-link'}))
-    self.soup_remove_after (soup, soup.find('footer', attrs={'class':'book-navigation'}))
+    self.soup_remove_before(soup, parser.find(soup, 'span',   {'class':'print-link'}))
+    self.soup_remove_after (soup, parser.find(soup, 'footer', {'class':'book-navigation'}))
 
-    srv  = soup.find('div', attrs={'class':'service-links'})
-    if srv:
-      srv.extract();
+    srv  = parser.find(soup, 'div', {'class':'service-links'})
+    if srv is not None:
+      parser.extract(srv)
 
-    nav  = soup.find('footer', attrs={'class':'book-navigation'})
-    if nav:
-      list = nav.find('ul')
-      if list:
+    nav  = parser.find(soup, 'footer', {'class':'book-navigation'})
+    if nav is not None:
+      list = parser.find(nav, 'ul')
+      if list is not None:
         #for line in list.findAll("li"):
-        for line in nav.findAll('li', attrs={'class':has_class('leaf')}):
-          link  = line.find("a")
-          title = link.renderContents()
-          url   = link["href"]
-          url = urljoin(baseurl, url)
-          self.parse_url(url)
-        for line in nav.findAll('li', attrs={'class':has_class('collapsed')}):
-          link  = line.find("a")
-          title = link.renderContents()
-          url   = link["href"]
-          url = urljoin(baseurl, url)
-          self.parse_url(url)
-      nav.extract()
+        urls = []
+        for line in parser.find_all(nav, 'li', {'class':has_class('leaf')}):
+          link  = parser.find(line, "a")
+          urls.append(urljoin(baseurl, parser.get(link, "href")))
+        for line in parser.find_all(nav, 'li', {'class':has_class('collapsed')}):
+          link  = parser.find(line, "a")
+          urls.append(urljoin(baseurl, parser.get(link, "href")))
+        self.prefetch(urls)
+        for url in urls:
+          self.record_link(url, False)
+          self.defer(lambda url=url: self.parse_url(url))
+      parser.extract(nav)
     else:
-      nav = soup.find('div',  attrs={'class': 'content'})
-      if nav:
+      nav = parser.find(soup, 'div', {'class': 'content'})
+      if nav is not None:
         self.soup_remove_after (soup, nav)
-        div = nav.find('div', attrs={'class': 'vote-wrap'})
-        if div:
-          font = div.findPreviousSibling('font')
-          if font:
+        div = parser.find(nav, 'div', {'class': 'vote-wrap'})
+        if div is not None:
+          font = parser.previous_sibling(div, 'font')
+          if font is not None:
             self.soup_remove_after (soup, font)
-            font.extract()
+            parser.extract(font)
           else:
-            self.soup_remove_after (soup, div.previousSibling)
-            div.previousSibling.extract()
+            self.soup_remove_after (soup, parser.previous_sibling(div))
+            parser.extract(parser.previous_sibling(div))
 
-    body = soup.find('body')
+    body = parser.find(soup, 'body')
 
     if submitted:
-      txt = BeautifulSoup.NavigableString(submitted)
-      p = BeautifulSoup.Tag(soup, 'p')
-      em = BeautifulSoup.Tag(soup, 'em')
-      em.insert(0, txt)
-      p.insert(0, em)
-      body.insert(0, p)
-
-    h = BeautifulSoup.Tag(soup, 'h1')
-    h.insert(0, BeautifulSoup.NavigableString(page_title))
-    body.insert(0, h)
-
-    p = BeautifulSoup.Tag(soup, 'p')
-    a = BeautifulSoup.Tag(soup, 'a')
-    a.insert(0, BeautifulSoup.NavigableString(baseurl))
-    a['href'] = baseurl;
-    p.insert(0, BeautifulSoup.NavigableString("Downloaded from: "))
-    p.insert(1, a)
-    p['style'] = 'font-size: 0.5em'
-    body.append(p)
+      em = parser.tag(soup, 'em', [submitted])
+      parser.insert(body, 0, parser.tag(soup, 'p', [em]))
+
+    parser.insert(body, 0, parser.tag(soup, 'h1', [page_title]))
+
+    a = parser.tag(soup, 'a', [baseurl], [('href', baseurl)])
+    parser.append(body, parser.tag(soup, 'p', ["Downloaded from: ", a],
+                                   [('style', 'font-size: 0.5em')]))
 
     soup = self.follow_links(soup, baseurl, recursive=False)
-    soup = self.sanitize_soup(soup, baseurl)
-    return soup.prettify()
+    return self.sanitize_soup(soup, baseurl)
 
   def parse_soup_raw(self, soup, filename, baseurl, output):
-    page_title = soup.find("title")
-    if page_title:
-      page_title = page_title.renderContents()
+    page_title = self.parser.find(soup, "title")
+    if page_title is not None:
+      page_title = self.parser.inner_html(page_title)
     else:
       page_title = os.path.basename(filename)
+    self.page_stack[-1]['title'] = page_title
     if output:
       if not self.info_title:
 	self.info_title = page_title
@@ -643,11 +3441,11 @@ class TopShelf(Epub):
       self.current_nav = navigation_item['sub']
 
     soup = self.follow_links(soup, baseurl, recursive=True)
-    soup = self.sanitize_soup(soup, baseurl)
-    return soup.prettify()
+    return self.sanitize_soup(soup, baseurl)
 
   def parse_soup(self, soup, filename, baseurl, output):
     old_nav = self.current_nav
+    self.stats.start("layout")
 
     #print "Layout: %s" % (self.layout)
     if self.layout == "TopShelf":
@@ -655,6 +3453,7 @@ class TopShelf(Epub):
     else:
       result = self.parse_soup_raw(soup, filename, baseurl, output)
 
+    self.stats.stop()
     self.current_nav = old_nav
     return result
 
@@ -663,202 +3462,69 @@ class TopShelf(Epub):
       accept_recursion = False
     else:
       accept_recursion = True
-    for a in soup.findAll('a', href=True):
-      url = urljoin(baseurl, a["href"])
+    parser = self.parser
+    links = []
+    base = self.fetch_key(baseurl)
+    for a in parser.find_all(soup, 'a', {'href': True}):
+      url = urljoin(baseurl, parser.get(a, "href"))
       url1, _, _ = url.partition('#')
       url2, _, _ = baseurl.partition('#')
-      if url and url1 != url2:
-	if recursive and accept_recursion and not (self.downloadOnce and self.has_url(url)):
-	  self.recursion_index = self.recursion_index + 1
-	  u = self.parse_url(url)
-	  if u: a['href'] = "../%s" % u
-	  self.recursion_index = self.recursion_index - 1
-	else:
-	  #u = self.get_url(url)
-	  #if u: a['href'] = "../%s" % u
-	  a['href'] = url
+      if url and url1 != url2 and self.fetch_key(url) != base:
+	links.append((a, url))
+    if recursive and accept_recursion:
+      self.prefetch([url for a, url in links
+                     if not (self.downloadOnce and self.has_url(url))])
+    for a, url in links:
+      if recursive and accept_recursion:
+	ref = self.new_reference(parser.get(a, 'href'))
+	parser.set(a, 'href', ref)
+	self.defer(lambda url=url, ref=ref: self.follow_link(url, ref))
+      else:
+	#u = self.get_url(url)
+	#if u: a['href'] = "../%s" % u
+	parser.set(a, 'href', url)
     return soup
 
   def sanitize_soup(self, soup, baseurl):
-
-    allowed_head = ['title', 'link', 'meta']
-    allowed_body = ['p', 'a', 'img', 'font', 'u', 'b', 'strong', 'i', 'em', 's', 'center', 'big', 'small', 'br', 'hr', 'ul', 'ol', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote']
-    not_allowed_body = ['div', 'span', 'table', 'tr', 'th', 'td', 'form', 'input']
-    allowed_body_attrs = {'a':['href', 'name', 'title'], 'img':['src', 'width', 'height', 'alt', 'align'], 'p':['align'], 'font':['size', 'color', 'face'], '*':['id', 'style', 'class']}
-    not_allowed_body_attrs = {'img':['border'], 'a':['onclick', 'rel']}
-    remove_body = ['script']
+    self.stats.start("sanitize")
+    parser = self.parser
 
     #
     # Extract anything but `allowed_head' from <head>
     #
 
-    for head in soup.findAll('head'):
+    for head in parser.find_all(soup, 'head'):
       #for base in head.findAll('base'):
       #  base.extract();
-      for e in head.findAll():
-	if e.__class__ == BeautifulSoup.Tag:
-	  if e.name not in allowed_head:
-	    e.extract()
-	else:
-	  e.extract()
+      for e in parser.find_all(head):
+	if parser.name_of(e) not in Sanitizer.allowed_head:
+	  parser.extract(e)
 
     #
     # Modify <img src>
     #
 
-    for img in soup.findAll('img', src=True):
-      url = urljoin(baseurl, img["src"])
-      u = self.get_url(url, relative=os.path.dirname(self.translate_url_to_name(baseurl))+"/")
-      if u: img['src'] = "%s" % u
+    imgs = parser.find_all(soup, 'img', {'src': True})
+    self.prefetch([urljoin(baseurl, parser.get(img, "src")) for img in imgs])
+    for img in imgs:
+      url = urljoin(baseurl, parser.get(img, "src"))
+      self.record_resource(url)
+      ref = self.new_reference(parser.get(img, 'src'))
+      parser.set(img, 'src', ref)
+      self.defer(lambda url=url, ref=ref: self.get_image(url, baseurl, ref))
 
     #
-    # Remove `remove_body' tags from <body>
-    # Filter `allowed_body' in <body>
+    # Serialize, filtering <body> on the way
     #
 
-    for body in soup.findAll('body'):
-
-      for unwanted in remove_body:
-	for tag in soup.findAll(unwanted):
-	  tag.extract()
-
-      body.replaceWith(self.sanitize_soup_filter(soup, body, allowed_body, allowed_body_attrs, not_allowed_body, not_allowed_body_attrs, True));
-
-    return soup
-
-
-  def sanitize_soup_filter(self, parser, soup, allowed_tags, allowed_attrs, blacklist_tags, blacklist_attrs, keepSoup=False):
-
-    if soup.__class__ != BeautifulSoup.Tag:
-      return soup
-
-    result = []
-    for e in soup.contents:
-      r = self.sanitize_soup_filter(parser, e, allowed_tags, allowed_attrs, blacklist_tags, blacklist_attrs)
-      if type(r) == type([]): result.extend(r)
-      else:                   result.append(r)
-
-    if soup.name not in allowed_tags and not keepSoup:
-      if soup.name not in blacklist_tags:
-	print "extract <%s>" % soup.name
-      return result
-
-    else:
-
-      if '*' not in allowed_attrs: allowed_attrs['*'] = []
-      if soup.name not in allowed_attrs: allowed_attrs[soup.name] = []
-      if '*' not in blacklist_attrs: blacklist_attrs['*'] = []
-      if soup.name not in blacklist_attrs: blacklist_attrs[soup.name] = []
-
-      #parser = soup
-      #while parser.parent:
-	#parser = parser.parent
-      tag = BeautifulSoup.Tag(parser, soup.name)
-
-      for attr, val in soup.attrs:
-	if attr not in allowed_attrs[soup.name] and attr not in allowed_attrs['*']:
-	  if attr not in blacklist_attrs[soup.name] and attr not in blacklist_attrs['*']:
-	    print "extract <%s %s=\"%s\">" % (soup.name, attr, val)
-	  #del soup[attr]
-	else:
-	  tag[attr] = val
-
-      soup = tag
-
-      for i in range(len(result)):
-	soup.insert(i, result[i])
-      #for e in soup:
-	#if e not in result:
-	  #e.extract()
-
-      #i = 0
-      #last = None
-      #for e in result:
-	#soup.insert(i, e)
-	#i = i + 1
-	#last = e
-      #if last != None:
-	#while last.nextSibling != None:
-	  #last.nextSibling.extract()
-      #else:
-	#for e in soup.contents: e.extract()
-
-      return soup
-
-    #curr = soup.next
-    #index = 0
-
-    #while curr.nextSibling != None:
-      #next = curr.nextSibling
-      #if curr.__class__ == BeautifulSoup.Tag:
-	#if curr.name not in allowed_tags:
-	  #print "extract %s" % curr.name
-	  #for e in curr:
-	    #soup.insert(index, self.sanitize_soup_filter(e, allowed_tags))
-	    #index = index + 1
-	  #curr.extract()
-	  #index = index - 1
-	#else:
-	  #curr.replaceWith(self.sanitize_soup_filter(curr, allowed_tags))
-      #curr = next
-      #index = index + 1
-
-    #for center in soup.findAll('center'):
-      #div = BeautifulSoup.Tag(soup, 'div')
-      #div['style'] = 'display: block; margin-left: auto; margin-right: auto; text-align: center;';
-      #for item in center.contents:
-	#div.append(item)
-      #center.replaceWith(div)
-    #for font in soup.findAll('font'):
-      #span = BeautifulSoup.Tag(soup, 'span')
-      #style = []
-      #try:
-	#style.append("color: %s" % font['color'])
-      #except:
-	#pass
-      #try:
-	#style.append("font-family: %s" % font['face'])
-      #except:
-	#pass
-      #try:
-	#try:
-	  #i = int(font['size'])
-	  #if font['size'][0] == '+' or font['size'][0] == '-':
-	    #if   i <= -6: style.append("font-size: 25%")
-	    #elif i == -5: style.append("font-size: 33%")
-	    #elif i == -4: style.append("font-size: 40%")
-	    #elif i == -3: style.append("font-size: 57%")
-	    #elif i == -2: style.append("font-size: 80%")
-	    #elif i == -1: style.append("font-size: 91%")
-	    #elif i ==  0: pass
-	    #elif i ==  1: style.append("font-size: 110%")
-	    #elif i ==  2: style.append("font-size: 125%")
-	    #elif i ==  3: style.append("font-size: 175%")
-	    #elif i ==  4: style.append("font-size: 250%")
-	    #elif i ==  5: style.append("font-size: 300%")
-	    #elif i >=  6: style.append("font-size: 400%")
-	  #else:
-	    #if   i <= 1: style.append("font-size: xx-small")
-	    #elif i == 2: style.append("font-size: small")
-	    #elif i == 3: style.append("font-size: medium")
-	    #elif i == 4: style.append("font-size: large")
-	    #elif i == 5: style.append("font-size: x-large")
-	    #elif i >= 6: style.append("font-size: xx-large")
-	#except:
-	  ##style.append("font-size: %s" % font['size'])
-	  #pass
-      #except:
-	#pass
-      #span['style'] = "; ".join(style);
-      #print "font: ", font
-      #print "style: ", style
-      #for item in font.contents:
-	#span.append(item)
-	#print "item: ", item
-      #font.replaceWith(span)
-      #print "span: ", span
-
-    #return soup
+    remove = ()
+    if parser.find(soup, 'body') is not None:
+      remove = Sanitizer.remove_body
+    self.stats.start("render")
+    content = parser.render(soup, remove)
+    self.stats.stop()
+    self.stats.stop()
+    return content
 
   def set_metainfo(self, info, value):
     if   info == "title":	self.info_title = value
@@ -888,22 +3554,14 @@ class TopShelf(Epub):
     return res
 
   def soup_remove_before(self, soup, tag):
-    while tag is not None and tag.name != 'body':
-      after = tag.previousSibling
-      while after is not None:
-	ns = tag.previousSibling
-	after.extract()
-	after = ns
-      tag = tag.parent
+    while tag is not None and self.parser.name_of(tag) != 'body':
+      self.parser.remove_before(tag)
+      tag = self.parser.parent(tag)
 
   def soup_remove_after(self, soup, tag):
-    while tag is not None and tag.name != 'body':
-      after = tag.nextSibling
-      while after is not None:
-	ns = tag.nextSibling
-	after.extract()
-	after = ns
-      tag = tag.parent
+    while tag is not None and self.parser.name_of(tag) != 'body':
+      self.parser.remove_after(tag)
+      tag = self.parser.parent(tag)
 
 
 helpmsg = """NAME
@@ -940,18 +3598,180 @@ OPTIONS
 
     -M, --minimal
 	Use minimal parser for pathologically bad markup documents
+	(same as --parser minimal)
+
+    --parser PARSER
+        Parse the pages with PARSER: lxml (fast, needs lxml), soup
+        (BeautifulSoup) or minimal (BeautifulSoup's MinimalSoup). The
+        default is lxml when it is installed, soup otherwise.
 
     -D, --depth DEPTH
 	Recursion limit
 
+    -j, --jobs JOBS
+        Download up to JOBS pages and images in parallel (default 1)
+
+    --zip-jobs JOBS
+        Compress the files of the e-book on JOBS threads when writing it
+        (default: the number of processors). JPEG, PNG and GIF images are
+        stored without compression.
+
+    --split-size KB
+        Split the pages of more than KB kilobytes (default 256) in parts of
+        at most that size, at paragraph or heading boundaries, for the
+        e-readers slow to open big files. The parts starting with a heading
+        are listed under the page in the table of contents, the links to
+        the ids of the page point at the right part. 0 not to split.
+        With --stream, the links of the pages written before a page is
+        split still point at its first part.
+
+    --host-jobs JOBS
+        Make at most JOBS simultaneous requests to the same host
+
+    --rate REQUESTS
+        Start at REQUESTS requests per second to each host (default 32).
+        The rate goes up while the host answers and is halved when it
+        answers 429 or 503 with a Retry-After, 0 doesn't limit the rate.
+
+    --mirrors HOSTS
+        Hosts serving the same site, separated by commas, for instance
+        bigcloset.us,bigclosetr.us (the default). Each page is cached once
+        whatever the mirror. By default it is downloaded from the host of
+        its URL, which has the cookies of the login, and from the other
+        mirrors only when that host fails. With the option, it comes from
+        the fastest mirror that works. Give the option once per site,
+        "none" for no mirrors.
+
+    --hedge MS
+        When a mirror didn't answer after MS milliseconds, send the same
+        request to the next mirror and take the first response
+        (default: wait)
+
+    --canonical RULES
+        The forms of a URL downloaded once, separated by commas (default
+        all of them, "none" for none): "scheme" for http and https, "slash"
+        for a path with and without trailing slashes, "query" for the
+        query parameters in any order. Letter case of the host, default
+        ports and fragments never count.
+
+    --drop-param REGEXP
+        Query parameters whose name matches REGEXP don't count when
+        comparing URLs. Repeat for several, "none" for none (default
+        utm_[a-z]+, the tracking parameters).
+
+    --retries N
+        Try again up to N times the downloads failing with a network error
+        or a 408, 429, 500, 502, 503 or 504 status, waiting longer each time
+        or as long as Retry-After says (default 3)
+
+    --cache DIRECTORY
+        Keep downloaded files in DIRECTORY between runs and revalidate them
+        with conditional requests instead of downloading them again
+
+    --cache-age SECONDS
+        Use cached files younger than SECONDS without revalidation
+        (default 3600)
+
+    --memory-cache MB
+        Keep up to MB megabytes of downloads in memory, the least recently
+        used are dropped first (default 64). The e-books of a --batch share
+        them.
+
+    --memory-cache-age SECONDS
+        Download again the files kept in memory for more than SECONDS
+        (default: keep them)
+
+    --visited KIND
+        How to remember the URLs downloaded: "hash" keeps a 64 bit
+        fingerprint of each, 8 bytes in memory (the default), "bloom" only
+        a Bloom filter of about 1.2 bytes in memory and the fingerprints in
+        a temporary file, for crawls of millions of pages
+
+    --bloom-bits BITS
+        Bits of the Bloom filter for each URL with --visited bloom (default
+        10, one URL in a hundred to look up in the file)
+
+    --visited-file FILE
+        Load the URLs downloaded from FILE if it exists, and save them there
+        with those of this e-book once it is written (with those of all the
+        e-books of a batch or of the --serve daemon)
+
+    --link-visited
+        With -O, link to the pages in --visited-file instead of downloading
+        them again, so that the e-book only has the pages no previous run
+        or e-book of the batch downloaded
+
     --replace SEARCH REPLACEMENT
 
+    --replace-stats
+        Print how many times each --replace rule matched and the time it
+        took once the e-book is downloaded
+
+    --stats
+        Print the time spent downloading, parsing, sanitizing and writing
+        the e-book, and how many pages, bytes and cache hits it took
+
+    --stats-json FILE
+        Append the same statistics to FILE as a JSON object on one line,
+        with the e-book file name and URLs and "ok" false if it could not
+        be built (one line per e-book of a batch)
+
     --gui
 	Start the GUI
 
     -o OUTFILE
         use OUTFILE as filename for the resulting epub e-book
 
+    --batch FILE
+        Build one e-book per line of FILE. Each line holds the options and
+        URLs of an e-book as on the command line (-o, -m, --replace, ...),
+        the options given on the command line apply to every line. The
+        e-books share the download cache and the cookies. Empty lines and
+        lines starting with # are ignored.
+
+    --batch-jobs JOBS
+        Build up to JOBS e-books of the batch or of --serve in parallel
+        (default 1)
+
+    --serve [HOST:]PORT
+        Run as a daemon building the e-books submitted to an HTTP API on
+        PORT (HOST defaults to 127.0.0.1). POST a JSON book spec to /books,
+        {"url": [...], "meta": {...}, "replace": [[search, replacement]],
+        "layout": "TopShelf" or null, "options": [...]}, then poll
+        /books/ID until its status is done and download /books/ID/epub.
+        The same spec submitted while it is being built joins that job.
+        The options given on the command line apply to every e-book, and
+        the downloads are cached between them.
+
+    --serve-dir DIRECTORY
+        Write the e-books built by --serve to DIRECTORY (default: a
+        temporary directory removed on exit)
+
+    --pool-size SIZE
+        Keep up to SIZE connections open to each host between requests, 0
+        opens a new connection for each request (default 4)
+
+    --update EPUB
+        Update EPUB, an e-book made by this program: the pages given on the
+        command line are checked for changes and only the pages that are
+        new or changed are downloaded, the other files are copied from
+        EPUB. The e-book is written over EPUB unless -o is given.
+
+    --revalidate
+        With --update, check every page of the e-book for changes, not
+        only the pages given on the command line
+
+    --queue
+        Finish each page before following its links, which are kept in a
+        queue. Only one page is parsed in memory at a time, whatever the
+        depth of the crawl (-r -D), and the table of contents is the same.
+
+    --stream
+        Write pages and images to the e-book as soon as they are processed
+        instead of keeping the whole e-book in memory. The downloads are
+        still kept in memory up to --memory-cache, lower it to bound the
+        memory used by large e-books.
+
     -m METAINFO=VALUE
         set meta METAINFO to VALUE
 
@@ -961,101 +3781,248 @@ SEE ALSO
 
 """;
 
-def main(argv):
-
-  if not soup_ok:
-    print "package beautifulSoup not found"
-    return 1
-
-  url = []
-  obsoletes = []
-  outfile = None
-  layout = "TopShelf"
-  accept = None
-  delete = None
-  skip = False
-  show=False
-  cont=False
-  minimal = False
-  once = False
-  recursion_limit = None
-  id_url = None
-  id_data = None
-  replace = []
-  meta = {}
-  i = 1
+def default_options():
+  return {
+    'url'            : [],
+    'outfile'        : None,
+    'layout'         : "TopShelf",
+    'accept'         : None,
+    'delete'         : None,
+    'skip'           : False,
+    'show'           : False,
+    'cont'           : False,
+    'parser'         : None,
+    'once'           : False,
+    'recursion_limit': None,
+    'jobs'           : 1,
+    'host_jobs'      : None,
+    'rate'           : 32,
+    'retries'        : 3,
+    'mirrors'        : None,
+    'hedge'          : None,
+    'canonical'      : UrlCanonicalizer.all_rules,
+    'drop_params'    : None,
+    'zip_jobs'       : None,
+    'split_size'     : 256,
+    'cache_dir'      : None,
+    'cache_age'      : 3600,
+    'memory_cache'   : 64,
+    'memory_cache_age': None,
+    'visited'        : "hash",
+    'bloom_bits'     : 10,
+    'visited_file'   : None,
+    'link_visited'   : False,
+    'stream'         : False,
+    'pool_size'      : 4,
+    'queue'          : False,
+    'replace_stats'  : False,
+    'stats'          : False,
+    'stats_json'     : None,
+    'update'         : None,
+    'revalidate'     : False,
+    'id_url'         : None,
+    'id_data'        : None,
+    'batch'          : None,
+    'batch_jobs'     : 1,
+    'serve'          : None,
+    'serve_dir'      : None,
+    'help'           : False,
+    'replace'        : [],
+    'meta'           : {}}
+
+def copy_options(opts):
+  opts = dict(opts)
+  opts['url']     = list(opts['url'])
+  opts['replace'] = list(opts['replace'])
+  opts['meta']    = dict(opts['meta'])
+  if opts['mirrors'] is not None:
+    opts['mirrors'] = list(opts['mirrors'])
+  if opts['drop_params'] is not None:
+    opts['drop_params'] = list(opts['drop_params'])
+  return opts
+
+def parse_options(argv, i, opts):
+  # Parse the options in argv starting at index i into opts and return the
+  # index of the first URL
   argc = len(argv)
   while i < argc:
     arg = argv[i]
     if arg == "-o":
       i = i + 1
-      outfile = argv[i]
+      opts['outfile'] = argv[i]
     elif arg == "-h" or arg == "--help":
-      print helpmsg
-      return 0
+      opts['help'] = True
     elif arg == "-r" or arg == "--raw":
-      layout = None
+      opts['layout'] = None
     elif arg == "-M" or arg == "--minimal":
-      minimal = True
+      opts['parser'] = "minimal"
+    elif arg == "--parser":
+      i = i + 1
+      opts['parser'] = argv[i]
     elif arg == "-c" or arg == "--continue":
-      cont = True
+      opts['cont'] = True
     elif arg == "-s" or arg == "--skip":
-      skip = True
+      opts['skip'] = True
     elif arg == "-O" or arg == "--once":
-      once = True
+      opts['once'] = True
     elif arg == "-D" or arg == "--depth":
       i = i + 1
-      recursion_limit = int(argv[i])
+      opts['recursion_limit'] = int(argv[i])
+    elif arg == "-j" or arg == "--jobs":
+      i = i + 1
+      opts['jobs'] = int(argv[i])
+    elif arg == "--host-jobs":
+      i = i + 1
+      opts['host_jobs'] = int(argv[i])
+    elif arg == "--rate":
+      i = i + 1
+      opts['rate'] = float(argv[i])
+    elif arg == "--retries":
+      i = i + 1
+      opts['retries'] = int(argv[i])
+    elif arg == "--mirrors":
+      i = i + 1
+      if opts['mirrors'] is None:
+        opts['mirrors'] = []
+      if argv[i] != "none":
+        opts['mirrors'].append(argv[i].split(","))
+    elif arg == "--hedge":
+      i = i + 1
+      opts['hedge'] = int(argv[i]) / 1000.0
+    elif arg == "--canonical":
+      i = i + 1
+      rules = [r for r in argv[i].split(",") if r != "none"]
+      for r in rules:
+        if r not in UrlCanonicalizer.all_rules:
+          raise ValueError("unknown URL rule: %s" % r)
+      opts['canonical'] = rules
+    elif arg == "--drop-param":
+      i = i + 1
+      if opts['drop_params'] is None:
+        opts['drop_params'] = []
+      if argv[i] != "none":
+        try:
+          re.compile(argv[i])
+        except re.error, e:
+          raise ValueError("bad regular expression %s: %s" % (argv[i], e))
+        opts['drop_params'].append(argv[i])
+    elif arg == "--zip-jobs":
+      i = i + 1
+      opts['zip_jobs'] = int(argv[i])
+    elif arg == "--split-size":
+      i = i + 1
+      opts['split_size'] = int(argv[i])
+    elif arg == "--visited":
+      i = i + 1
+      if argv[i] not in ("hash", "bloom"):
+        raise ValueError("unknown visited set: %s" % argv[i])
+      opts['visited'] = argv[i]
+    elif arg == "--bloom-bits":
+      i = i + 1
+      opts['bloom_bits'] = int(argv[i])
+    elif arg == "--visited-file":
+      i = i + 1
+      opts['visited_file'] = argv[i]
+    elif arg == "--link-visited":
+      opts['link_visited'] = True
+    elif arg == "--cache":
+      i = i + 1
+      opts['cache_dir'] = argv[i]
+    elif arg == "--cache-age":
+      i = i + 1
+      opts['cache_age'] = int(argv[i])
+    elif arg == "--memory-cache":
+      i = i + 1
+      opts['memory_cache'] = int(argv[i])
+    elif arg == "--memory-cache-age":
+      i = i + 1
+      opts['memory_cache_age'] = int(argv[i])
     elif arg == "-a" or arg == "--accept":
       i = i + 1
-      accept = argv[i]
+      opts['accept'] = argv[i]
     elif arg == "-d" or arg == "--delete":
       i = i + 1
-      delete = argv[i]
+      opts['delete'] = argv[i]
     elif arg == "-m":
       i = i + 1
       m, eq, val = argv[i].partition("=")
-      meta[m] = val.decode('utf-8')
+      opts['meta'][m] = val.decode('utf-8')
     elif arg == "--replace":
       i = i + 1
-      replace.append( (argv[i],argv[i+1]) )
+      try:
+        re.compile(argv[i])
+      except re.error, e:
+        raise ValueError("bad regular expression %s: %s" % (argv[i], e))
+      opts['replace'].append( (argv[i],argv[i+1]) )
       i = i + 1
     elif arg == "--show":
-      show=True
+      opts['show'] = True
+    elif arg == "--replace-stats":
+      opts['replace_stats'] = True
+    elif arg == "--stats":
+      opts['stats'] = True
+    elif arg == "--stats-json":
+      i = i + 1
+      opts['stats_json'] = argv[i]
+    elif arg == "--stream":
+      opts['stream'] = True
+    elif arg == "--queue":
+      opts['queue'] = True
+    elif arg == "--pool-size":
+      i = i + 1
+      opts['pool_size'] = int(argv[i])
+    elif arg == "--update":
+      i = i + 1
+      opts['update'] = argv[i]
+    elif arg == "--revalidate":
+      opts['revalidate'] = True
+    elif arg == "--batch":
+      i = i + 1
+      opts['batch'] = argv[i]
+    elif arg == "--batch-jobs":
+      i = i + 1
+      opts['batch_jobs'] = int(argv[i])
+    elif arg == "--serve":
+      i = i + 1
+      opts['serve'] = argv[i]
+    elif arg == "--serve-dir":
+      i = i + 1
+      opts['serve_dir'] = argv[i]
     elif arg == "--identify":
       i = i + 1
-      id_url = argv[i]
+      opts['id_url'] = argv[i]
       i = i + 1
-      id_data = argv[i]
+      opts['id_data'] = argv[i]
     elif arg == "--":
       i = i + 1
       break
     else:
       break
     i = i + 1
-
-  #if layout == "TopShelf" and not accept:
-  #  accept = "bigclosetr\.us/topshelf/"
-
-  for i in range(i, argc):
-    url.append(argv[i])
-
-  #remaining_args = argc - i
-  #if remaining_args == 1:
-  #  url = argv[i]
-  #  i = i + 1
-  #  remaining_args = remaining_args - 1
-  #elif remaining_args >= 2:
-  #  outfile = argv[i]
-  #  url = argv[i+1]
-  #  i = i + 2
-  #  remaining_args = remaining_args - 2
-
-  if not len(url):
-    print "You should specify a URL"
+  return i
+
+def check_parser(name):
+  # Returns why the parser `name' can't be used, None if it can
+  if name is not None and name not in parsers:
+    return "Unknown parser: %s (%s)" % (name, ", ".join(parsers))
+  if name == "lxml" and not lxml_ok:
+    return "package lxml not found"
+  if name in ("soup", "minimal") and not soup_ok:
+    return "package beautifulSoup not found"
+  return None
+
+def make_fetch_cache(opts):
+  return FetchCache(opts['memory_cache'] * 1048576, opts['memory_cache_age'])
+
+def cpu_count():
+  try:
+    return multiprocessing.cpu_count()
+  except NotImplementedError:
     return 1
 
-
+def init_cookies():
+  cj = None
+  COOKIEFILE = None
   if cj_lwp is not None or cj_moz is not None:
   # we successfully imported
   # one of the two cookie handling modules
@@ -1092,37 +4059,131 @@ def main(argv):
       # and install the opener in ClientCookie
       opener = ClientCookie.build_opener(ClientCookie.HTTPCookieProcessor(cj))
       ClientCookie.install_opener(opener)
+  return cj, COOKIEFILE
 
-  if id_url is not None and id_data is not None:
-    r = Request(id_url, id_data);
-    f = urlopen(r)
-    print f.info();
-    f2 = open("login.html", "w");
-    f2.write(f.read())
-    f2.close()
-    if cj is not None:
-      print 'These are the cookies we have received so far :'
-      for index, cookie in enumerate(cj): print index, '  :  ', cookie
-      cj.save(COOKIEFILE)
+obsolete_lock = threading.Lock()
+stats_lock = threading.Lock()
 
+def write_stats(opts, ts, outfile, ok=True):
+  ts.stats.finish()
+  if opts['stats']:
+    if ok:
+      print "Statistics for %s:" % outfile
+    else:
+      print "Statistics for %s (failed):" % outfile
+    ts.stats.report()
+  if opts['stats_json']:
+    report = ts.stats.as_dict()
+    report['outfile'] = outfile
+    report['url']     = opts['url']
+    report['ok']      = ok
+    with stats_lock:
+      f = open(opts['stats_json'], "a")
+      f.write(json.dumps(report, sort_keys=True) + "\n")
+      f.close()
+
+def make_visited_set(opts):
+  # The VisitedSet of --visited, loaded from --visited-file if it exists
+  visited = VisitedSet(opts['visited'] == "bloom", opts['bloom_bits'])
+  if opts['visited_file'] and os.path.exists(opts['visited_file']):
+    try:
+      visited.load(opts['visited_file'])
+    except:
+      visited.close()
+      raise
+  return visited
+
+def build_book(opts, shared=None):
+  # Download and write one e-book, returns (success, outfile)
+  if shared is None:
+    shared = {}
+  url = opts['url']
+  outfile = opts['outfile']
+  obsoletes = []
 
   for u in url:
     print "E-Book URL: %s" % u
 
-  ts = TopShelf(layout=layout, accept_regexp=accept, delete_regexp=delete)
-  if minimal:
-    ts.BeautifulParser = BeautifulSoup.MinimalSoup
-  if recursion_limit:
-    ts.recursion_limit = recursion_limit
-  if once:
+  ts = TopShelf(layout=opts['layout'], accept_regexp=opts['accept'], delete_regexp=opts['delete'])
+  ts.parser = make_parser(opts['parser'])
+  if opts['recursion_limit']:
+    ts.recursion_limit = opts['recursion_limit']
+  if opts['once']:
     ts.downloadOnce = True
+  if opts['queue']:
+    ts.queue_mode = True
+  if 'http' in shared:
+    ts.http = shared['http']
+  if 'rate' in shared:
+    ts.rate = shared['rate']
+  elif opts['rate'] > 0:
+    ts.rate = RateLimiter(opts['rate'])
+  ts.retries = opts['retries']
+  if 'mirrors' in shared:
+    ts.mirrors = shared['mirrors']
+  else:
+    ts.mirrors = MirrorSet(opts['mirrors'])
+  ts.hedge = opts['hedge']
+  ts.canonicalizer = UrlCanonicalizer(opts['canonical'], opts['drop_params'])
+  if 'disk_cache' in shared:
+    ts.disk_cache = shared['disk_cache']
+  elif opts['cache_dir']:
+    ts.disk_cache = DiskCache(opts['cache_dir'], opts['cache_age'])
+  if 'fetch_cache' in shared:
+    ts.download_cache = shared['fetch_cache']
+  else:
+    ts.download_cache = make_fetch_cache(opts)
+  ts.jobs = opts['jobs']
+  ts.host_jobs = opts['host_jobs']
+  ts.compress_jobs = opts['zip_jobs'] or cpu_count()
+  ts.split_size = opts['split_size'] * 1024 or None
+  # The e-book has a set of its own, added to the --visited-file one once
+  # it is written
+  ts.fetched = VisitedSet(opts['visited'] == "bloom", opts['bloom_bits'])
+  ts.stats.visited = ts.fetched
+  visited = shared.get('visited')
+  def close_visited(save=False):
+    if save and visited is not None:
+      visited.update(ts.fetched)
+      visited.save(opts['visited_file'])
+    ts.fetched.close()
+    if visited is not None and 'visited' not in shared:
+      visited.close()
+  if visited is None and opts['visited_file']:
+    try:
+      visited = make_visited_set(opts)
+    except (IOError, ValueError), e:
+      print "Can't load %s: %s" % (opts['visited_file'], e)
+      write_stats(opts, ts, outfile, False)
+      close_visited()
+      return False, outfile
+  if opts['link_visited']:
+    ts.known = visited
+  if opts['update']:
+    try:
+      ts.update_from(opts['update'])
+    except (IOError, ValueError, zipfile.BadZipfile), e:
+      print "Can't update %s: %s" % (opts['update'], e)
+      write_stats(opts, ts, opts['update'], False)
+      close_visited()
+      return False, opts['update']
+    ts.revalidate = opts['revalidate']
+    if not outfile:
+      outfile = opts['update']
+  if opts['stream']:
+    # The final name depends on the metadata found while downloading
+    fd, partfile = tempfile.mkstemp(suffix='.epub', dir='.')
+    os.close(fd)
+    ts.open_stream(partfile)
   ts.replace_show = False
-  for m in meta:
-    ts.set_metainfo(m, meta[m])
-  for r1, r2 in replace:
-    ts.init_replace(r1, r2, show);
+  for m in opts['meta']:
+    ts.set_metainfo(m, opts['meta'][m])
+  for r1, r2 in opts['replace']:
+    ts.init_replace(r1, r2, opts['show']);
   for u in url:
-    ts.parse_url(u, output = not skip)
+    ts.parse_url(u, output = not opts['skip'])
+  if opts['replace_stats'] and len(ts.replace):
+    ts.replace.report()
 
   if not outfile:
     author = make_filename(" ".join(ts.info_author))
@@ -1139,23 +4200,495 @@ def main(argv):
 
   make_dir=os.path.dirname(outfile)
   if not os.path.exists(make_dir):
-    os.mkdir(make_dir)
+    try:
+      os.mkdir(make_dir)
+    except OSError:
+      # Another book of the batch may have created it meanwhile
+      if not os.path.isdir(make_dir): raise
 
   if ts.error:
     print "Errors downloading E-Book: %s" % outfile
-    if not cont: exit(1)
+    if not opts['cont']:
+      ts.discard_stream()
+      write_stats(opts, ts, outfile, False)
+      close_visited()
+      return False, outfile
   else:
     print "Downloaded E-Book: %s" % outfile
-    if cont: print "Option -c supplied but unnecessary"
+    if opts['cont']: print "Option -c supplied but unnecessary"
 
   if len(obsoletes):
-    f = open("obsolete.txt", "a")
-    for o in obsoletes:
-      f.write("%s\n" % o);
-    f.close();
+    with obsolete_lock:
+      f = open("obsolete.txt", "a")
+      for o in obsoletes:
+        f.write("%s\n" % o);
+      f.close();
 
   #print ts.navigation
   ts.writeout(outfile)
+  if ts.previous:
+    ts.previous.close()
+  write_stats(opts, ts, outfile)
+  close_visited(True)
+  return True, outfile
+
+def read_batch(filename, opts):
+  # One e-book per line, with its options and URLs as on the command line.
+  # Empty lines and lines starting with # are ignored. Returns a list of
+  # (lineno, options, error), the lines that can't be parsed have an error
+  # message instead of options.
+  books = []
+  f = open(filename)
+  lineno = 0
+  for line in f:
+    lineno += 1
+    args = shlex.split(line, comments=True)
+    if not args: continue
+    book = copy_options(opts)
+    book['batch'] = None
+    try:
+      i = parse_options(args, 0, book)
+    except (IndexError, ValueError):
+      books.append((lineno, None, "bad options: %s" % " ".join(args)))
+      continue
+    if book['help']:
+      books.append((lineno, None, "option not allowed here: -h"))
+      continue
+    book['url'] = args[i:]
+    books.append((lineno, book, None))
+  f.close()
+  return books
+
+def build_batch(opts, shared):
+  books = read_batch(opts['batch'], opts)
+  shared = dict(shared)
+  if opts['cache_dir']:
+    shared['disk_cache'] = DiskCache(opts['cache_dir'], opts['cache_age'])
+  shared['fetch_cache'] = make_fetch_cache(opts)
+  if opts['visited_file']:
+    # The e-books add to the same set instead of overwriting the file
+    try:
+      shared['visited'] = make_visited_set(opts)
+    except (IOError, ValueError), e:
+      print "Can't load %s: %s" % (opts['visited_file'], e)
+      return 1
+  results = {}
+  queue = collections.deque(books)
+  lock = threading.Lock()
+
+  def worker():
+    while True:
+      with lock:
+        if not queue: return
+        lineno, book, error = queue.popleft()
+      if error is None and not book['url']:
+        error = "no URL"
+      if error is not None:
+        results[lineno] = (False, error)
+        continue
+      try:
+        ok, outfile = build_book(book, shared)
+        if ok:
+          results[lineno] = (True, outfile)
+        else:
+          results[lineno] = (False, "errors downloading %s" % outfile)
+      except Exception, e:
+        results[lineno] = (False, "%s: %s" % (e.__class__.__name__, e))
+
+  threads = []
+  for n in range(max(1, min(opts['batch_jobs'], len(books)))):
+    t = threading.Thread(target=worker)
+    t.start()
+    threads.append(t)
+  for t in threads:
+    t.join()
+  if 'visited' in shared:
+    shared['visited'].close()
+
+  failed = 0
+  print "Batch %s:" % opts['batch']
+  for lineno, book, error in books:
+    ok, msg = results[lineno]
+    if ok:
+      print "  ok      line %d: %s" % (lineno, msg)
+    else:
+      print "  FAILED  line %d: %s" % (lineno, msg)
+      failed += 1
+  print "%d e-books built, %d failed" % (len(books) - failed, failed)
+  if failed:
+    return 1
+  return 0
+
+class BuildServer:
+  # The --serve daemon: builds the e-books submitted to a small HTTP API on
+  # up to `jobs' threads. The builds share the HTTP connections and the
+  # caches, which stay warm from one e-book to the next. The API speaks
+  # JSON, but for the e-book itself:
+  #   POST   /books          Submit an e-book, the body is the book spec:
+  #                            'url'    : The URLs (required)
+  #                            'meta'   : {name: value} as given with -m
+  #                            'replace': [[search, replacement], ...]
+  #                            'layout' : "TopShelf" (default) or null for -r
+  #                            'options': Other options, as on the command line
+  #                          and returns the job. While a job for the same
+  #                          spec is queued or running, it is returned instead
+  #                          of a new one.
+  #   GET    /books          The jobs
+  #   GET    /books/ID       The job, a dictionnary with keys:
+  #                            'id', 'status' (queued, running, done, failed),
+  #                            'error', 'url', 'submitted', 'started',
+  #                            'finished' and 'stats' (as with --stats-json)
+  #   GET    /books/ID/epub  The e-book, once the job is done
+  #   DELETE /books/ID       Forget a finished job and remove its e-book
+  # The e-books are written to `directory'.
+
+  # options a book spec may not set
+  server_options = ['outfile', 'batch', 'serve', 'serve_dir', 'update',
+                    'stats_json', 'id_url', 'id_data', 'cache_dir', 'rate',
+                    'mirrors', 'visited_file', 'help']
+
+  max_request = 1048576
+
+  def __init__(self, opts, shared, directory, jobs=1):
+    self.opts      = opts
+    self.shared    = shared
+    self.directory = directory
+    self.jobs      = {}
+    self.running   = {}
+    # jobs queued or running, indexed by the key of their spec
+    self.queue     = collections.deque()
+    self.cond      = threading.Condition()
+    self.job_ids   = itertools.count(1)
+    self.workers   = []
+    for n in range(max(1, jobs)):
+      t = threading.Thread(target=self.worker)
+      t.daemon = True
+      t.start()
+      self.workers.append(t)
+
+  def make_book(self, spec):
+    # Options to build the spec with, raises ValueError when it's invalid
+    if not isinstance(spec, dict):
+      raise ValueError("the book spec must be an object")
+    book = copy_options(self.opts)
+    url = spec.get('url')
+    if isinstance(url, basestring):
+      url = [url]
+    if not url or not isinstance(url, list) or \
+       not all(isinstance(u, basestring) for u in url):
+      raise ValueError("'url' must be a URL or a list of URLs")
+    for u in url:
+      if urlsplit(u)[0] not in ('http', 'https'):
+        raise ValueError("not an http URL: %s" % u)
+    book['url'] = [u.encode('utf-8') for u in url]
+    meta = spec.get('meta', {})
+    if not isinstance(meta, dict) or \
+       not all(isinstance(v, basestring) for v in meta.values()):
+      raise ValueError("'meta' must map names to strings")
+    for m in meta:
+      book['meta'][m.encode('utf-8')] = unicode(meta[m])
+    replace = spec.get('replace', [])
+    if not isinstance(replace, list) or \
+       not all(isinstance(r, list) and len(r) == 2 and
+               all(isinstance(x, basestring) for x in r) for r in replace):
+      raise ValueError("'replace' must be a list of [search, replacement]")
+    for r1, r2 in replace:
+      try:
+        re.compile(r1)
+      except re.error, e:
+        raise ValueError("bad regular expression %s: %s" % (r1, e))
+      book['replace'].append((r1.encode('utf-8'), r2.encode('utf-8')))
+    layout = spec.get('layout', "TopShelf")
+    if layout not in ("TopShelf", None):
+      raise ValueError("unknown layout: %s" % layout)
+    book['layout'] = layout
+    args = spec.get('options', [])
+    if not isinstance(args, list) or \
+       not all(isinstance(a, basestring) for a in args):
+      raise ValueError("'options' must be a list of strings")
+    args = [a.encode('utf-8') for a in args]
+    try:
+      i = parse_options(args, 0, book)
+    except (IndexError, ValueError):
+      raise ValueError("bad options: %s" % " ".join(args))
+    if i < len(args):
+      raise ValueError("unknown option: %s" % args[i])
+    for o in self.server_options:
+      if book[o] != self.opts[o]:
+        raise ValueError("option not allowed here: %s" % o)
+    error = check_parser(book['parser'])
+    if error:
+      raise ValueError(error)
+    return book
+
+  def spec_key(self, book):
+    # Two specs with the same key build the same e-book
+    return json.dumps(dict((k, v) for k, v in book.items()
+                           if k not in ('outfile', 'stats_json')),
+                      sort_keys=True)
+
+  def submit(self, spec):
+    # Returns (job, created)
+    book = self.make_book(spec)
+    key = self.spec_key(book)
+    with self.cond:
+      job = self.running.get(key)
+      if job:
+        return job, False
+      job_id = "%d" % next(self.job_ids)
+      book['outfile']    = os.path.join(self.directory, "%s.epub" % job_id)
+      book['stats_json'] = os.path.join(self.directory, "%s.json" % job_id)
+      job = {
+        'id'       : job_id,
+        'status'   : "queued",
+        'error'    : None,
+        'url'      : book['url'],
+        'submitted': time.time(),
+        'started'  : None,
+        'finished' : None,
+        'stats'    : None}
+      self.jobs[job_id] = job
+      self.running[key] = job
+      self.queue.append((key, job, book))
+      self.cond.notify()
+    return job, True
+
+  def worker(self):
+    while True:
+      with self.cond:
+        while not self.queue:
+          self.cond.wait()
+        key, job, book = self.queue.popleft()
+        job['status']  = "running"
+        job['started'] = time.time()
+      try:
+        ok, outfile = build_book(book, self.shared)
+        error = not ok and "errors downloading %s" % outfile or None
+      except Exception, e:
+        error = "%s: %s" % (e.__class__.__name__, e)
+      stats = None
+      if os.path.exists(book['stats_json']):
+        f = open(book['stats_json'])
+        line = f.read().splitlines()[-1]
+        f.close()
+        os.remove(book['stats_json'])
+        stats = json.loads(line)
+        if self.opts['stats_json']:
+          with stats_lock:
+            f = open(self.opts['stats_json'], "a")
+            f.write(line + "\n")
+            f.close()
+      with self.cond:
+        del self.running[key]
+        job['status']   = error and "failed" or "done"
+        job['error']    = error
+        job['stats']    = stats
+        job['finished'] = time.time()
+
+  def get(self, job_id):
+    with self.cond:
+      job = self.jobs.get(job_id)
+      return job and dict(job)
+
+  def list(self):
+    with self.cond:
+      return [dict(self.jobs[j]) for j in sorted(self.jobs, key=int)]
+
+  def epub_path(self, job_id):
+    return os.path.join(self.directory, "%s.epub" % job_id)
+
+  def delete(self, job_id):
+    # Returns False when the job is still queued or running
+    with self.cond:
+      job = self.jobs.get(job_id)
+      if job is None or job['finished'] is None:
+        return False
+      del self.jobs[job_id]
+    if os.path.exists(self.epub_path(job_id)):
+      os.remove(self.epub_path(job_id))
+    return True
+
+
+class BuildRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  # HTTP front end of the BuildServer in self.server.builds
+
+  protocol_version = "HTTP/1.1"
+
+  def send_body(self, code, body, ctype="application/json"):
+    if ctype == "application/json":
+      body = json.dumps(body, sort_keys=True) + "\n"
+    self.send_response(code)
+    self.send_header("Content-Type", ctype)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    if self.command != "HEAD":
+      self.wfile.write(body)
+
+  def send_error_body(self, code, message):
+    self.send_body(code, {'error': message})
+
+  def route(self):
+    # Returns (job id, rest of the path) for /books/ID[/rest]
+    parts = urlsplit(self.path)[2].strip("/").split("/")
+    if parts[0] != "books":
+      return None, None
+    return (len(parts) > 1 and parts[1] or None), "/".join(parts[2:])
+
+  def do_GET(self):
+    builds = self.server.builds
+    job_id, rest = self.route()
+    if rest is None:
+      return self.send_error_body(404, "not found")
+    if job_id is None:
+      return self.send_body(200, builds.list())
+    job = builds.get(job_id)
+    if job is None or rest not in ("", "epub"):
+      return self.send_error_body(404, "not found")
+    if rest == "":
+      return self.send_body(200, job)
+    if job['status'] != "done":
+      return self.send_error_body(409, "job %s is %s" % (job_id, job['status']))
+    f = open(builds.epub_path(job_id), "rb")
+    data = f.read()
+    f.close()
+    self.send_body(200, data, "application/epub+zip")
+
+  def do_POST(self):
+    job_id, rest = self.route()
+    if rest is None or job_id is not None:
+      return self.send_error_body(404, "not found")
+    length = int(self.headers.getheader("Content-Length") or 0)
+    if length > self.server.builds.max_request:
+      return self.send_error_body(413, "book spec too large")
+    try:
+      job, created = self.server.builds.submit(json.loads(self.rfile.read(length)))
+    except ValueError, e:
+      return self.send_error_body(400, str(e))
+    self.send_body(created and 202 or 200, job)
+
+  def do_DELETE(self):
+    builds = self.server.builds
+    job_id, rest = self.route()
+    if job_id is None or rest or builds.get(job_id) is None:
+      return self.send_error_body(404, "not found")
+    if not builds.delete(job_id):
+      return self.send_error_body(409, "job %s is not finished" % job_id)
+    self.send_body(200, {'id': job_id, 'status': "deleted"})
+
+
+class BuildHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+def serve(opts, shared):
+  host, _, port = opts['serve'].rpartition(":")
+  directory = opts['serve_dir']
+  if directory is None:
+    directory = tempfile.mkdtemp(prefix="topshelf-")
+  elif not os.path.isdir(directory):
+    os.makedirs(directory)
+  shared = dict(shared)
+  if opts['cache_dir']:
+    shared['disk_cache'] = DiskCache(opts['cache_dir'], opts['cache_age'])
+  shared['fetch_cache'] = make_fetch_cache(opts)
+  if opts['visited_file']:
+    try:
+      shared['visited'] = make_visited_set(opts)
+    except (IOError, ValueError), e:
+      print "Can't load %s: %s" % (opts['visited_file'], e)
+      return 1
+  server = BuildHTTPServer((host or "127.0.0.1", int(port)), BuildRequestHandler)
+  server.builds = BuildServer(opts, shared, directory, opts['batch_jobs'])
+  print "Serving on http://%s:%d/books, e-books in %s" % (
+    server.server_address[0], server.server_address[1], directory)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  server.server_close()
+  if 'visited' in shared:
+    shared['visited'].close()
+  if opts['serve_dir'] is None:
+    shutil.rmtree(directory, True)
+  return 0
+
+def main(argv):
+
+  if not soup_ok and not lxml_ok:
+    print "package beautifulSoup not found"
+    return 1
+
+  opts = default_options()
+  try:
+    i = parse_options(argv, 1, opts)
+  except IndexError:
+    print "Missing value for %s" % argv[-1]
+    return 1
+  except ValueError, e:
+    print e
+    return 1
+  if opts['help']:
+    print helpmsg
+    return 0
+
+  error = check_parser(opts['parser'])
+  if error:
+    print error
+    return 1
+
+  #if layout == "TopShelf" and not accept:
+  #  accept = "bigclosetr\.us/topshelf/"
+
+  opts['url'] = argv[i:]
+
+  #remaining_args = argc - i
+  #if remaining_args == 1:
+  #  url = argv[i]
+  #  i = i + 1
+  #  remaining_args = remaining_args - 1
+  #elif remaining_args >= 2:
+  #  outfile = argv[i]
+  #  url = argv[i+1]
+  #  i = i + 2
+  #  remaining_args = remaining_args - 2
+
+  if not len(opts['url']) and not opts['batch'] and not opts['serve']:
+    print "You should specify a URL"
+    return 1
+
+  cj, COOKIEFILE = init_cookies()
+
+  id_url  = opts['id_url']
+  id_data = opts['id_data']
+  if id_url is not None and id_data is not None:
+    r = Request(id_url, id_data);
+    f = urlopen(r)
+    print f.info();
+    f2 = open("login.html", "w");
+    f2.write(f.read())
+    f2.close()
+    if cj is not None:
+      print 'These are the cookies we have received so far :'
+      for index, cookie in enumerate(cj): print index, '  :  ', cookie
+      cj.save(COOKIEFILE)
+
+  shared = {}
+  if opts['pool_size'] > 0:
+    shared['http'] = HTTPPool(opts['pool_size'], cj)
+  if opts['rate'] > 0:
+    shared['rate'] = RateLimiter(opts['rate'])
+  shared['mirrors'] = MirrorSet(opts['mirrors'])
+
+  if opts['serve']:
+    return serve(opts, shared)
+
+  if opts['batch']:
+    return build_batch(opts, shared)
+
+  ok, outfile = build_book(opts, shared)
+  if not ok:
+    return 1
+  return 0
 
 try:
   import Tkinter as Tk